@@ -0,0 +1,49 @@
+import time
+from typing import Dict, List
+
+# =============================================================================
+# Admission control shared by the application and data layers:
+# - WorkLimit bounds the requests a server has taken on and not answered yet;
+#   past the limit new ones are shed with ERROR: BUSY straight away rather
+#   than queued behind work they would only make later
+# - RateLimiter gives every client (peer host) a token bucket: `rate` requests
+#   a second on average, in bursts of up to `burst`; requests over it are shed
+#   the same way. Only the most recently seen MAX_CLIENTS clients are tracked.
+# A limit of 0 turns either off.
+# =============================================================================
+MAX_CLIENTS = 10000
+
+
+class WorkLimit:
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.active = 0
+
+    def acquire(self) -> bool:
+        if self.limit and self.active >= self.limit:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+class RateLimiter:
+    def __init__(self, rate: float = 0, burst: float = 0, max_clients: int = MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_clients = max_clients
+        self.buckets: Dict[str, List[float]] = {}  # client -> [tokens, monotonic time], least recent first
+
+    def allow(self, client: str) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.pop(client, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[client] = [tokens - 1 if allowed else tokens, now]
+        if len(self.buckets) > self.max_clients:
+            del self.buckets[next(iter(self.buckets))]
+        return allowed
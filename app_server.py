@@ -1,7 +1,29 @@
-import socket
+import asyncio
 import argparse
-from typing import List, Dict
+import contextvars
+import heapq
+import json
+import math
+import queue
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Any, List, Dict, Optional, Tuple, Union
 import logging
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+from admission import RateLimiter, WorkLimit
+from listing_query import ListingQuery, formatListingQuery, orderKey, parseListingQuery
+from metrics import Metrics
+from shard_map import ShardMap
+from wire_protocol import (
+    BUSY, DEADLINE_EXCEEDED, HELLO, HELLO_COMPRESS, HELLO_COMPRESS_OK, HELLO_OK, KIND_RESULT, MULTI_SEPARATOR, NOT_MODIFIED,
+    STATS_ESTIMATED, STATS_QUANTILES, Listing, ResultSet, compressFrame, decodeResult, encodeRows, multiCommand,
+    multiQueries, readFrame, splitDeadline, splitIfNoneMatch, statsLines, textFrame, withDeadline,
+)
 
 # Oanh Tran 029661786
 
@@ -15,29 +37,212 @@ PORT = 5002
 DATA_HOST = "127.0.0.1"
 DATA_PORT = 5001
 
-# persistent data socket (created in main) so it can stay connected to data server
-dataSock = None
+# pool of persistent data server connections (created in main)
+POOL_SIZE = 8
+PIPELINE_DEPTH = 8
+DATA_TIMEOUT = 20
+HEALTH_INTERVAL = 10
+DATA_STREAM_LIMIT = 64 * 1024 * 1024  # longest single line in a data server reply
+DATA_PROTOCOL = "text"
+# one replica set per data server shard (a single shard without --shards), and
+# the shard map that routes commands to them
+dataShards: List["ReplicaSet"] = []
+shardMap: Optional[ShardMap] = None
+
+# replica balancing (see ReplicaSet)
+BALANCE = "p2c"
+EWMA_ALPHA = 0.3
+EJECT_SECONDS = 1.0
+EJECT_MAX = 30.0
+LATENCY_WINDOW = 256
+HEDGE_MIN_SAMPLES = 20
+WRITE_COMMANDS = ("RAW_PUT", "RAW_DELETE")
+BUSY_REPLY = BUSY.encode("utf-8")
+# most cache-missing RAW_SEARCHes sent to a shard in one RAW_MULTI (1 = no batching)
+BATCH_SIZE = 32
+
+# per-stage latencies and counters, reported by METRICS with each data server's
+METRICS = Metrics()
+
+# admission control: the budget of a request that doesn't bring a DEADLINE of its
+# own (0 = none), how many cache misses may wait on the data tier at once before
+# more are shed with ERROR: BUSY (0 = no limit), and requests a second allowed from
+# each client host (0 = unlimited) with bursts of up to RATE_BURST
+REQUEST_DEADLINE = DATA_TIMEOUT
+MAX_PENDING = 1024
+RATE_LIMIT = 0
+RATE_BURST = 0
+WORK = WorkLimit(MAX_PENDING)
+RATE_LIMITER = RateLimiter(RATE_LIMIT, RATE_BURST)
+
+# query cache defaults
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 300
+CACHE_POLICY = "lru"
 
 #==============================================================================
 # Interceptor Logger (logs requests + replies)
+# The request path only puts records on an in-memory queue; a background
+# writer thread formats them and appends them in batches to app_server.log,
+# rotating the file by size.
 #==============================================================================
+LOG_FILE = "app_server.log"
+LOG_PAYLOAD = "full"        # full | truncated | summary (row count + bytes + latency)
+LOG_TRUNCATE = 200          # characters of payload kept by the "truncated" policy
+LOG_SAMPLE_RATE = 1.0       # fraction of client requests whose request/replies are logged
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_BATCH = 512
+
+_STOP = object()
+
+
+class DeferredQueueHandler(QueueHandler):
+    # keep the record as-is so its message (and payload) is formatted by the writer thread
+    def prepare(self, record):
+        return record
+
+
+class LogWriter(threading.Thread):
+    def __init__(self, log_queue: queue.SimpleQueue, handler: RotatingFileHandler, batch_size: int = LOG_BATCH):
+        super().__init__(name="app-log-writer", daemon=True)
+        self.queue = log_queue
+        self.handler = handler
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not _STOP]
+            if records:
+                self.write(records)
+            if len(records) < len(batch):
+                return
+
+    def write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.handler.format(record) + "\n")
+            except Exception:
+                self.handler.handleError(record)
+        text = "".join(lines)
+        stream = self.handler.stream
+        if self.handler.maxBytes and stream.tell() and stream.tell() + len(text) >= self.handler.maxBytes:
+            self.handler.doRollover()
+            stream = self.handler.stream
+        stream.write(text)
+        stream.flush()
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self.join()
+        self.handler.close()
+
+
 logger = logging.getLogger("app_server")
 logger.setLevel(logging.INFO)
 
-_file_handler = logging.FileHandler("app_server.log", mode="a", encoding="utf-8")
-_file_handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s"))
-logger.addHandler(_file_handler)
 logger.propagate = False
+# the queue handler is only installed while a writer is draining its queue; with
+# no handler (e.g. app_server imported, not run) records are dropped
+logHandler: Optional[DeferredQueueHandler] = None
+logWriter: Optional[LogWriter] = None
+
+
+def startLogging(path: str = LOG_FILE, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS,
+                 payload: str = LOG_PAYLOAD, sample_rate: float = LOG_SAMPLE_RATE):
+    global logHandler, logWriter, LOG_PAYLOAD, LOG_SAMPLE_RATE
+
+    LOG_PAYLOAD = payload
+    LOG_SAMPLE_RATE = sample_rate
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s"))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logWriter = LogWriter(log_queue, handler)
+    logWriter.start()
+    logHandler = DeferredQueueHandler(log_queue)
+    logger.addHandler(logHandler)
+
+
+def stopLogging():
+    global logHandler, logWriter
+    if logHandler is not None:
+        logger.removeHandler(logHandler)
+        logHandler = None
+    if logWriter is not None:
+        logWriter.stop()
+        logWriter = None
 
 # =============================================================================
 # Interceptor helpers; just formatting the log
+# Each client command decides once whether it is sampled; its request and
+# replies (on both hops) share that decision and its start time.
 # =============================================================================
+_log_context: contextvars.ContextVar = contextvars.ContextVar("log_context", default=(True, None))
+
+def beginRequest():
+    _log_context.set((random.random() < LOG_SAMPLE_RATE, time.perf_counter()))
+
+
+def payloadText(resp) -> str:
+    # replies may be str, bytes, a list of byte buffers, or a decoded binary result
+    if isinstance(resp, ResultSet):
+        resp = f"OK RESULT {len(resp.rows)} VERSION {resp.version} [binary]"
+    elif isinstance(resp, list):
+        resp = b"".join(resp)
+    if isinstance(resp, bytes):
+        resp = resp.decode("utf-8", errors="replace")
+    return resp.replace("\n", "\\n")
+
+def payloadSummary(resp) -> Tuple[int, Optional[int]]:
+    # (row count, bytes on the wire) without joining or decoding the payload
+    if isinstance(resp, ResultSet):
+        return len(resp.rows), None
+    if isinstance(resp, list):
+        head, size = resp[0] if resp else b"", sum(map(len, resp))
+    else:
+        head, size = resp[:64], len(resp)
+    header = head.split(b"\n" if isinstance(head, bytes) else "\n", 1)[0].split()
+    rows = int(header[2]) if len(header) > 2 and header[2].isdigit() else 0
+    return rows, size
+
+
+class LogPayload:
+    # rendered by the writer thread according to LOG_PAYLOAD
+    __slots__ = ("resp", "latency")
+
+    def __init__(self, resp, latency: Optional[float]):
+        self.resp = resp
+        self.latency = latency
+
+    def __str__(self) -> str:
+        if LOG_PAYLOAD == "summary":
+            rows, size = payloadSummary(self.resp)
+            latency = "-" if self.latency is None else f"{self.latency * 1000:.2f}ms"
+            return f"rows={rows} bytes={'-' if size is None else size} latency={latency}"
+        text = payloadText(self.resp)
+        if LOG_PAYLOAD == "truncated" and len(text) > LOG_TRUNCATE:
+            text = f"{text[:LOG_TRUNCATE]}...(+{len(text) - LOG_TRUNCATE} chars)"
+        return text
+
+
 def logRequest(addr, cmd: str):
-    logger.info(f"{addr} | REQUEST | {cmd}")
+    if _log_context.get()[0]:
+        logger.info("%s | REQUEST | %s", addr, cmd)
 
-def logReply(addr, resp: str):
-    one_line = resp.replace("\n", "\\n")
-    logger.info(f"{addr} | REPLY   | {one_line}")
+def logReply(addr, resp, started: Optional[float] = None):
+    sampled, request_started = _log_context.get()
+    if not sampled:
+        return
+    started = request_started if started is None else started
+    latency = None if started is None else time.perf_counter() - started
+    logger.info("%s | REPLY   | %s", addr, LogPayload(resp, latency))
 
 
 # =============================================================================
@@ -47,74 +252,848 @@ def ensureEnd(msg: str) -> str:
     return msg if msg.endswith("\nEND\n") else msg.rstrip("\n") + "\nEND\n"
 
 def errorResponse(message: str) -> str:
+    METRICS.count("errors")
     return ensureEnd(f"ERROR: APPLICATION {message}")
 
+# =============================================================================
+# Deadlines: each client request has one, from its DEADLINE prefix or else
+# --deadline, kept in a context variable for the data tier calls made on its
+# behalf. Waiting for a data connection and for the reply are bounded by what is
+# left of it, and the data server is sent the rest. Running out raises
+# DeadlineExceeded, which unlike a timeout says nothing about the data server,
+# so the replica isn't ejected and the connection stays open.
+# =============================================================================
+_deadline: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    pass
+
+class DataProtocolError(OSError):
+    # a reply this side couldn't read (oversized or malformed frame, or one nobody asked
+    # for): the connection is dropped, but the replica isn't ejected for it
+    pass
+
+def remainingTime() -> Optional[float]:
+    # seconds left of the current request's deadline (None without one)
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        raise DeadlineExceeded
+    return remaining
+
+# =============================================================================
+# One persistent, pipelined connection to the DATA server. Commands are written
+# as soon as they are issued, without waiting for earlier replies; the data
+# server answers a connection's commands in the order they arrive, so a reader
+# task hands each reply to the oldest request still waiting for one. A RAW_MULTI
+# is owed one reply per query and gets them back as a list.
+# Text replies come back as bytes; on a binary connection result sets come back
+# decoded into a ResultSet.
+# =============================================================================
+DataReply = Union[bytes, ResultSet]
+
+class DataConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, binary: bool = False):
+        self.reader = reader
+        self.writer = writer
+        self.binary = binary
+        self.compress = False
+        self.closed = False
+        self._failure: Tuple[type, str] = (ConnectionResetError, "DATA connection is closed")
+        self.sent = 0
+        self._waiting: deque = deque()  # (future, replies owed), oldest first
+        self._received: List[DataReply] = []  # replies so far to the oldest waiting RAW_MULTI
+        self._replies: Optional[asyncio.Task] = None
+
+    @property
+    def inflight(self) -> int:
+        return len(self._waiting)
+
+    async def hello(self, compress: bool = False):
+        # before pipelining starts; stays on the text protocol if the data server doesn't speak binary
+        self.writer.write(((HELLO_COMPRESS if compress else HELLO) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        try:
+            reply = await self.reader.readuntil(b"\nEND\n")
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionResetError("DATA server closed the connection") from e
+        self.binary = reply.startswith(HELLO_OK.encode("utf-8"))
+        self.compress = reply.startswith(HELLO_COMPRESS_OK.encode("utf-8"))
+
+    def start(self):
+        self._replies = asyncio.create_task(self.readReplies())
+
+    async def request(self, cmd: str, budget: Optional[float] = None) -> Union[DataReply, List[DataReply]]:
+        if self.closed:
+            error, reason = self._failure
+            raise error(reason)
+        queries = multiQueries(cmd)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((future, len(queries) or 1))
+        line = cmd.strip() if budget is None else withDeadline(cmd, budget)
+        if self.binary:
+            self.writer.write(textFrame(line))
+        else:
+            self.writer.write((line + "\n").encode("utf-8"))
+        self.sent += 1
+        await self.writer.drain()
+        replies = await future
+        return replies if queries else replies[0]
+
+    async def readReply(self) -> DataReply:
+        if not self.binary:
+            # a line at a time up to the END line, so only a single line is bound by the stream limit
+            lines = []
+            while True:
+                line = await self.reader.readline()
+                if not line.endswith(b"\n"):
+                    raise asyncio.IncompleteReadError(b"".join(lines) + line, None)
+                lines.append(line)
+                if line == b"END\n":
+                    return b"".join(lines)
+        kind, payload = await readFrame(self.reader)
+        return decodeResult(payload) if kind == KIND_RESULT else payload
+
+    async def readReplies(self):
+        reason = "DATA server closed the connection"
+        error = ConnectionResetError
+        try:
+            while True:
+                reply = await self.readReply()
+                if not self._waiting:
+                    reason = "DATA server sent a reply nobody asked for"
+                    error = DataProtocolError
+                    break
+                self._received.append(reply)
+                future, owed = self._waiting[0]
+                if len(self._received) < owed:
+                    continue
+                self._waiting.popleft()
+                replies, self._received = self._received, []
+                if not future.done():  # a request that timed out or was cancelled still has its reply read
+                    future.set_result(replies)
+        except asyncio.IncompleteReadError:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except ConnectionError as e:
+            reason = f"DATA connection failed ({e!r})"
+        except Exception as e:  # oversized line or frame, undecodable result
+            reason = f"DATA reply unreadable ({e!r})"
+            error = DataProtocolError
+        finally:
+            self.close(reason, error)
+
+    def close(self, reason: str = "DATA connection closed", error: type = ConnectionResetError):
+        if self.closed:
+            return
+        self.closed = True
+        self._failure = (error, reason)
+        self.writer.close()
+        if self._replies is not None and self._replies is not asyncio.current_task():
+            self._replies.cancel()
+        # everything still in flight on this connection fails with it
+        while self._waiting:
+            future, _ = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(error(reason))
+
+
+# =============================================================================
+# Bounded pool of pipelined DATA server connections:
+# - at most `size` connections and `size` x `depth` requests in flight
+# - a request goes to the least busy connection; a new connection is opened
+#   (lazily) only while every open one is busy and there is room for it
+# - connections that fail or that the data server closes are dropped
+# - pings idle connections every HEALTH_INTERVAL seconds
+# =============================================================================
+class DataConnectionPool:
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE, timeout: float = DATA_TIMEOUT,
+                 binary: bool = False, shard: int = 0, depth: int = PIPELINE_DEPTH, compress: bool = False):
+        self.host = host
+        self.port = port
+        self.shard = shard
+        self.size = size
+        self.timeout = timeout
+        self.binary = binary or compress
+        self.compress = compress
+        self._conns: List[DataConnection] = []
+        self._opening = 0
+        self._slots = asyncio.Semaphore(size * depth)
+
+    async def _connect(self) -> DataConnection:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, limit=DATA_STREAM_LIMIT), self.timeout
+        )
+        conn = DataConnection(reader, writer)
+        if self.binary:
+            try:
+                await asyncio.wait_for(conn.hello(self.compress), self.timeout)
+            except BaseException:
+                conn.close()
+                raise
+        conn.start()
+        return conn
+
+    async def _open(self) -> DataConnection:
+        self._opening += 1
+        try:
+            conn = await self._connect()
+        finally:
+            self._opening -= 1
+        self._conns.append(conn)
+        return conn
+
+    def _pick(self) -> Optional[DataConnection]:
+        # the least busy open connection, or None when a new one should be opened instead
+        self._conns = [conn for conn in self._conns if not conn.closed]
+        conn = min(self._conns, key=lambda c: c.inflight, default=None)
+        if conn is None or (conn.inflight and len(self._conns) + self._opening < self.size):
+            return None
+        return conn
+
+    async def _roundTrip(self, conn: DataConnection, cmd: str):
+        budget = remainingTime()
+        timeout = self.timeout if budget is None else min(self.timeout, budget)
+        try:
+            return await asyncio.wait_for(conn.request(cmd, budget), timeout)
+        except asyncio.TimeoutError:
+            if timeout != self.timeout:
+                raise DeadlineExceeded from None
+            # an unresponsive data server: fail the requests queued behind this one too
+            conn.close("DATA server timed out")
+            raise
+
+    async def request(self, cmd: str):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), remainingTime())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded from None
+        try:
+            conn = self._pick() or await self._open()
+            reused = conn.sent > 0
+            try:
+                return await self._roundTrip(conn, cmd)
+            except ConnectionError:
+                if not reused or cmd.startswith(WRITE_COMMANDS):
+                    # a write may have been applied before the connection dropped: not resent
+                    raise
+                # stale connection (e.g. data server restarted): retry a read once on a fresh one
+                return await self._roundTrip(await self._open(), cmd)
+        finally:
+            self._slots.release()
+
+    async def warmUp(self):
+        await self._open()
+
+    async def healthCheck(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            for conn in [conn for conn in self._conns if not conn.closed and not conn.inflight]:
+                try:
+                    resp = await self._roundTrip(conn, "RAW_PING")
+                except (OSError, asyncio.TimeoutError):
+                    continue  # the connection has closed itself
+                if resp.startswith(b"OK"):
+                    observeDataVersion(resp, self.shard)
+                else:
+                    conn.close()
+
+
+# =============================================================================
+# Replica sets: a shard can be served by several data server replicas (started
+# with the same --db and --wal, so they share data and writes). Requests are
+# balanced across the replicas that are not ejected:
+# - p2c: pick two at random and use the one with the lower EWMA latency x
+#   (requests in flight + 1)
+# - least-outstanding: the one with the fewest requests in flight (EWMA breaks ties)
+# - a replica that times out or refuses/resets/closes the connection is ejected for
+#   EJECT_SECONDS, doubled for each consecutive failure up to EJECT_MAX, then
+#   readmitted on trial; the request is retried on another replica. Writes are
+#   only retried when the connection was refused, i.e. the write never arrived.
+# - a read that a replica sheds (ERROR: BUSY) is retried on another replica; it
+#   isn't ejected for it
+# - with --hedge, a read still unanswered after the set's p95 latency is also
+#   sent to a second replica that isn't ejected, and the first answer wins
+# - a reply this side can't read (DataProtocolError) drops the connection but
+#   doesn't eject the replica
+# =============================================================================
+# failures that say the replica is down or unresponsive
+PEER_FAILURES = (ConnectionError, asyncio.TimeoutError)
+
+class Replica:
+    def __init__(self, pool: DataConnectionPool):
+        self.pool = pool
+        self.outstanding = 0
+        self.ewma = 0.0  # seconds; 0 until the first answer, so new replicas get tried
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def score(self) -> float:
+        return self.ewma * (self.outstanding + 1)
+
+    async def request(self, cmd: str) -> DataReply:
+        started = time.perf_counter()
+        try:
+            resp = await self.pool.request(cmd)
+        except PEER_FAILURES as e:
+            self.eject(e)
+            raise
+        latency = time.perf_counter() - started
+        self.ewma = latency if self.ewma == 0 else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+        if self.failures:
+            print(f"DATA replica {self.pool.host}:{self.pool.port} readmitted")
+            self.failures = 0
+        return resp
+
+    def release(self, _task=None):
+        self.outstanding -= 1
+
+    def eject(self, error: BaseException):
+        if not self.available(time.monotonic()):
+            return  # requests that were already in flight when it failed
+        self.failures += 1
+        seconds = min(EJECT_SECONDS * 2 ** (self.failures - 1), EJECT_MAX)
+        self.ejected_until = time.monotonic() + seconds
+        print(f"DATA replica {self.pool.host}:{self.pool.port} ejected for {seconds:g}s ({error!r})")
+
+
+class ReplicaSet:
+    def __init__(self, pools: List[DataConnectionPool], shard: int = 0, balance: str = BALANCE,
+                 hedge: bool = False, batch_size: int = BATCH_SIZE):
+        self.replicas = [Replica(pool) for pool in pools]
+        self.shard = shard
+        self.balance = balance
+        self.hedge = hedge
+        self.latencies: deque = deque(maxlen=LATENCY_WINDOW)
+        self.searches = SearchBatch(self, batch_size)
+
+    def choose(self, tried: List[Replica]) -> Optional[Replica]:
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r not in tried and r.available(now)]
+        if not candidates:
+            # everything left is ejected: try the one due back soonest rather than fail
+            waiting = [r for r in self.replicas if r not in tried]
+            return min(waiting, key=lambda r: r.ejected_until) if waiting else None
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.balance == "p2c":
+            a, b = random.sample(candidates, 2)
+            return a if a.score() <= b.score() else b
+        return min(candidates, key=lambda r: (r.outstanding, r.ewma))
+
+    def chooseAvailable(self, tried: List[Replica]) -> Optional[Replica]:
+        # a hedge is only worth sending to a replica that isn't ejected
+        replica = self.choose(tried)
+        return replica if replica is not None and replica.available(time.monotonic()) else None
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    async def attempt(self, replica: Replica, cmd: str) -> DataReply:
+        started = time.perf_counter()
+        resp = await replica.request(cmd)
+        self.latencies.append(time.perf_counter() - started)
+        return resp
+
+    def launch(self, replica: Replica, cmd: str) -> asyncio.Task:
+        # outstanding from the moment the replica is chosen until the attempt ends, however it ends
+        replica.outstanding += 1
+        task = asyncio.create_task(self.attempt(replica, cmd))
+        task.add_done_callback(replica.release)
+        return task
+
+    async def hedged(self, first: Replica, cmd: str, tried: List[Replica]) -> DataReply:
+        delay = self.p95()
+        primary = self.launch(first, cmd)
+        pending = {primary}
+        try:
+            if delay is not None:
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                second = self.chooseAvailable(tried) if not done else None
+                if second is not None:
+                    tried.append(second)
+                    pending.add(self.launch(second, cmd))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            if error is None:
+                return primary.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, cmd: str) -> DataReply:
+        write = cmd.startswith(WRITE_COMMANDS)
+        tried: List[Replica] = []
+        busy: Optional[bytes] = None
+        while True:
+            replica = self.choose(tried)
+            if replica is None:
+                if busy is not None:
+                    return busy
+                raise error
+            tried.append(replica)
+            try:
+                if self.hedge and not write:
+                    resp = await self.hedged(replica, cmd, tried)
+                else:
+                    resp = await self.launch(replica, cmd)
+            except ConnectionRefusedError as e:
+                error = e
+                continue
+            except (OSError, asyncio.TimeoutError) as e:
+                if write:
+                    raise
+                error = e
+                continue
+            if write or not (isinstance(resp, bytes) and resp.startswith(BUSY_REPLY)):
+                return resp
+            busy = resp
+
+
+# =============================================================================
+# Batching: RAW_SEARCHes for a shard that are issued in the same event loop tick
+# (cache misses from different clients, usually) are sent as one RAW_MULTI, so
+# they share a single round trip to the data server, under the latest of their
+# deadlines
+# =============================================================================
+class SearchBatch:
+    def __init__(self, replicas: "ReplicaSet", size: int = BATCH_SIZE):
+        self.replicas = replicas
+        self.size = size
+        self.queued: List[Tuple[str, asyncio.Future, Optional[float]]] = []
+
+    def submit(self, cmd: str) -> asyncio.Future:
+        if MULTI_SEPARATOR in cmd:
+            # it would split into more queries than were submitted, and shift everyone's replies
+            raise ValueError(f"cannot batch a command containing {MULTI_SEPARATOR!r}")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.queued:
+            loop.call_soon(self.flush)
+        self.queued.append((cmd, future, _deadline.get()))
+        if len(self.queued) >= self.size:
+            self.flush()
+        return future
+
+    def flush(self):
+        queued, self.queued = self.queued, []
+        if queued:
+            asyncio.create_task(self.run(queued))
+
+    async def run(self, queued: List[Tuple[str, asyncio.Future, Optional[float]]]):
+        deadlines = [deadline for _, _, deadline in queued]
+        _deadline.set(None if None in deadlines else max(deadlines))
+        try:
+            if len(queued) == 1:
+                replies = [await self.replicas.request(queued[0][0])]
+            else:
+                replies = await self.replicas.request(multiCommand([cmd for cmd, _, _ in queued]))
+            if len(replies) != len(queued):
+                raise ConnectionError(f"DATA server sent {len(replies)} replies to a batch of {len(queued)} queries")
+        except Exception as e:
+            for _, future, _ in queued:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _), reply in zip(queued, replies):
+            if not future.done():
+                future.set_result(reply)
+
+
 # =============================================================================
 # sending commands to the DATA server and receiving responses
 # =============================================================================
-def send(conn, cmd: str) -> str:
+async def send(replicas: ReplicaSet, cmd: str) -> DataReply:
+    started = time.perf_counter()
     try:
         logRequest("APPLICATION->DATA", cmd)
 
-        conn.sendall((cmd.strip() + "\n").encode("utf-8"))
-        data = ""
-        while True:
-            raw = conn.recv(4096)
-            if not raw:
-                break
-            data += raw.decode("utf-8", errors="replace")
-            if "\nEND\n" in data:
-                break
-
-        response = ensureEnd(data)
+        if cmd.startswith("RAW_SEARCH") and replicas.searches.size > 1 and MULTI_SEPARATOR not in cmd:
+            response = await replicas.searches.submit(cmd)
+        else:
+            response = await replicas.request(cmd)
+        METRICS.since("data", started)
+        observeDataVersion(response, replicas.shard)
         # LOG reply coming back from data server
-        logReply("DATA->APPLICATION", response)
+        logReply("DATA->APPLICATION", response, started)
 
         return response
 
-    except socket.timeout:
-        resp = errorResponse("DATA server timed out")
-        logReply("DATA->APPLICATION", resp)
+    except DeadlineExceeded:
+        METRICS.count("expired")
+        resp = ensureEnd(DEADLINE_EXCEEDED).encode("utf-8")
+        logReply("DATA->APPLICATION", resp, started)
+        return resp
+    except asyncio.TimeoutError:
+        resp = errorResponse("DATA server timed out").encode("utf-8")
+        logReply("DATA->APPLICATION", resp, started)
         return resp
     except ConnectionRefusedError:
-        resp = errorResponse("DATA server connection refused")
-        logReply("DATA->APPLICATION", resp)
+        resp = errorResponse("DATA server connection refused").encode("utf-8")
+        logReply("DATA->APPLICATION", resp, started)
         return resp
-    except OSError as e:
-        resp = errorResponse(f"DATA server error ({e})")
-        logReply("DATA->APPLICATION", resp)
+    except (OSError, asyncio.LimitOverrunError) as e:
+        resp = errorResponse(f"DATA server error ({e})").encode("utf-8")
+        logReply("DATA->APPLICATION", resp, started)
         return resp
 
+# =============================================================================
+# Routing across data server shards (--shards):
+# - SEARCH goes to the one shard that owns the city
+# - LIST goes to every shard in parallel; each shard's rows are already sorted, so
+#   they are k-way merged instead of concatenated and re-sorted. A page at
+#   CURSOR c LIMIT n needs the first c + n rows of every shard.
+# - QUERY goes to the owner when all its cities live on one shard, otherwise to
+#   every shard like LIST, merged in the query's order
+# - TEXT goes to every shard like LIST
+# - STATS for a city goes to its owner; STATS for every city (*) goes to every
+#   shard and the shards' aggregates are combined (see gatherStats)
+# - PUT goes to the owner of the listing's city, then the id is deleted from the
+#   other shards in case the listing moved city; DELETE goes to every shard
+# =============================================================================
+def rowSortKey(item: Listing) -> Tuple[float, int]:
+    # the data server's sort order: price ascending, bedrooms descending
+    try:
+        price = float(item.price)
+    except (TypeError, ValueError):
+        price = 1e18
+    try:
+        bedrooms = int(item.bedrooms)
+    except (TypeError, ValueError):
+        bedrooms = 0
+    return (price, -bedrooms)
+
+
+def queryRowKey(query: ListingQuery):
+    # a row's position in the query's ASC order, ties in the data server's order
+    key = orderKey(query)
+
+    def rowKey(item: Listing) -> tuple:
+        price, bedrooms = rowSortKey(item)
+        try:
+            listing_id = int(item.id)
+        except (TypeError, ValueError):
+            listing_id = -1
+        return key(price, -bedrooms, listing_id) + (price, bedrooms)
+    return rowKey
+
+
+def shardRows(resp: DataReply, key=rowSortKey) -> List[Tuple[tuple, Union[bytes, Listing]]]:
+    if isinstance(resp, ResultSet):
+        return [(key(row), row) for row in resp.rows]
+    lines = splitRows(resp)
+    return [(key(row), line) for line, row in zip(lines, parseRows(lines))]
+
+
+def hasNext(resp: DataReply) -> bool:
+    if isinstance(resp, ResultSet):
+        return resp.next_cursor is not None
+    return headerField(resp, b"NEXT") is not None
+
+
+async def gatherRows(cmd: str, offset: int, limit: Optional[int], key=rowSortKey,
+                     reverse: bool = False) -> DataReply:
+    # cmd asks each shard for its first offset + limit rows in the order `key` (reversed) describes
+    replies = await asyncio.gather(*(send(replicas, cmd) for replicas in dataShards))
+    for resp in replies:
+        if isinstance(resp, bytes) and not resp.startswith(b"OK RESULT"):
+            return resp
+    shard_rows = [shardRows(resp, key) for resp in replies]
+    started = time.perf_counter()
+    stop = None if limit is None else offset + limit
+    merged = heapq.merge(*shard_rows, key=lambda pair: pair[0], reverse=reverse)
+    page = [item for _, item in islice(merged, offset, stop)]
+    METRICS.since("merge", started)
+    more = stop is not None and (any(map(hasNext, replies)) or sum(map(len, shard_rows)) > stop)
+    next_cursor = stop if more else None
+    if all(isinstance(resp, ResultSet) for resp in replies):
+        return ResultSet(page, dataTierVersion, next_cursor)
+    lines = [item if isinstance(item, bytes) else formatLine(item) for item in page]
+    header = f"OK RESULT {len(lines)} VERSION {dataTierVersion}"
+    if next_cursor is not None:
+        header += f" NEXT {next_cursor}"
+    return b"".join([(header + "\n").encode("utf-8"), *lines, b"END\n"])
+
+
+async def gatherList(options: List[str]) -> DataReply:
+    paging = dict(zip((name.upper() for name in options[::2]), (int(value) for value in options[1::2])))
+    offset, limit = paging.get("CURSOR", 0), paging.get("LIMIT")
+    cmd = "RAW_LIST" if limit is None else f"RAW_LIST LIMIT {offset + limit}"
+    return await gatherRows(cmd, offset, limit)
+
+
+async def gatherText(options: List[str]) -> DataReply:
+    words, paging = splitPaging(options)
+    offset, limit = paging.get("CURSOR", 0), paging.get("LIMIT")
+    cmd = f"RAW_TEXT {' '.join(words)}" + ("" if limit is None else f" LIMIT {offset + limit}")
+    return await gatherRows(cmd, offset, limit)
+
+
+async def routeQuery(cmd: str) -> DataReply:
+    try:
+        query = parseListingQuery(cmd.split(None, 1)[1] if " " in cmd else "")
+    except ValueError:
+        return await send(dataShards[0], cmd)  # let the data server explain what is wrong
+    owners = {shardMap.owner(city) for city in query.cities}
+    if len(owners) == 1:
+        return await send(dataShards[owners.pop()], cmd)
+    limit = None if query.limit is None else query.offset + query.limit
+    shard_cmd = f"RAW_QUERY {formatListingQuery(query, 0, limit)}"
+    return await gatherRows(shard_cmd, query.offset, query.limit, queryRowKey(query), query.descending)
+
+
+# Combining shard STATS: count, min, max, total, mean and the bedroom counts add up
+# exactly. The quantiles and the histogram are estimated from each shard's
+# percentiles line: every shard's price distribution is taken as linear between
+# its percentiles, and the shards' are added up weighted by their counts. The
+# reply is formatted like a single data server's, and marked ESTIMATED with the
+# estimated fields listed in estimated=.
+STATS_ESTIMATES = [f"{name}_price" for name, _ in STATS_QUANTILES] + ["histogram", "percentiles"]
+
+def statsFields(resp: bytes) -> Dict[str, str]:
+    lines = resp.decode("utf-8", errors="replace").splitlines()[1:]
+    return dict(line.split("=", 1) for line in lines if "=" in line)
+
+def shardBelow(percentiles: List[float], price: float) -> float:
+    # estimated share of a shard's rows priced at or below `price`
+    if price < percentiles[0]:
+        return 0.0
+    i = bisect_right(percentiles, price)
+    if i == len(percentiles):
+        return 1.0
+    low, high = percentiles[i - 1], percentiles[i]
+    return (i - 1 + (price - low) / (high - low)) / (len(percentiles) - 1)
+
+def mergeStats(shards: List[Dict[str, str]]) -> List[str]:
+    count = sum(int(fields["count"]) for fields in shards)
+    shards = [fields for fields in shards if int(fields["count"])]
+    if len(shards) == 1:
+        return [f"{name}={value}" for name, value in shards[0].items()]
+    if not shards:
+        return ["count=0"]
+    low = min(float(fields["min_price"]) for fields in shards)
+    high = max(float(fields["max_price"]) for fields in shards)
+    total = sum(float(fields["total_price"]) for fields in shards)
+    sketches = [(int(fields["count"]), [float(p) for p in fields["percentiles"].split(",")]) for fields in shards]
+
+    def below(price: float) -> float:
+        return sum(n * shardBelow(percentiles, price) for n, percentiles in sketches)
+
+    prices = sorted({price for _, percentiles in sketches for price in percentiles})
+    ranks = [below(price) for price in prices]
+
+    def quantile(percent: float) -> float:
+        # the price with `percent`% of all rows estimated at or below it
+        rank = max(1.0, count * percent / 100)
+        i = min(bisect_left(ranks, rank), len(prices) - 1)
+        if i == 0 or ranks[i] == ranks[i - 1]:
+            return prices[i]
+        return prices[i - 1] + (prices[i] - prices[i - 1]) * (rank - ranks[i - 1]) / (ranks[i] - ranks[i - 1])
+
+    bedrooms: Dict[str, int] = {}
+    for fields in shards:
+        for item in filter(None, fields.get("bedrooms", "").split(",")):
+            beds, _, n = item.partition(":")
+            bedrooms[beds] = bedrooms.get(beds, 0) + int(n)
+    mix = sorted((int(beds), n) for beds, n in bedrooms.items() if beds != "unknown")
+    if "unknown" in bedrooms:
+        mix.append(("unknown", bedrooms["unknown"]))
+    buckets = len(shards[0]["histogram"].split(","))
+    edges = [low + (high - low) * k / buckets for k in range(buckets + 1)] if high > low else [low, high]
+    # rows below each inner edge; the last bucket holds the rest, so the counts add up to count
+    cuts = [0] + [min(round(below(edge - 1e-9)), count) for edge in edges[1:-1]] + [count]
+    histogram = [(edges[k], edges[k + 1], cuts[k + 1] - cuts[k]) for k in range(len(edges) - 1)]
+    lines = statsLines(count, low, high, total, [quantile(percent) for _, percent in STATS_QUANTILES], mix,
+                       histogram, [quantile(p) for p in range(101)])
+    lines.append("estimated=" + ",".join(STATS_ESTIMATES))
+    return lines
+
+async def gatherStats(cmd: str) -> DataReply:
+    replies = await asyncio.gather(*(send(replicas, cmd) for replicas in dataShards))
+    for resp in replies:
+        if not isinstance(resp, bytes) or not resp.startswith(b"OK STATS"):
+            return resp
+    started = time.perf_counter()
+    lines = mergeStats([statsFields(resp) for resp in replies])
+    METRICS.since("merge", started)
+    count = lines[0].split("=", 1)[1]
+    header = f"OK STATS {count} VERSION {dataTierVersion}"
+    if any(line.startswith("estimated=") for line in lines):
+        header += f" {STATS_ESTIMATED}"
+    return ensureEnd(header + "\n" + "\n".join(lines)).encode("utf-8")
+
+
+async def putListing(cmd: str) -> DataReply:
+    try:
+        listing = json.loads(cmd.split(None, 1)[1])
+        city, listing_id = str(listing["city"]), listing["id"]
+    except (IndexError, KeyError, TypeError, ValueError):
+        return await send(dataShards[0], cmd)  # let the data server explain what is wrong
+    owner = shardMap.owner(city)
+    resp = await send(dataShards[owner], cmd)
+    if isinstance(resp, bytes) and resp.startswith(b"OK"):
+        await asyncio.gather(*(send(replicas, f"RAW_DELETE {listing_id}")
+                               for replicas in dataShards if replicas.shard != owner))
+    return resp
+
+
+async def deleteListing(cmd: str) -> DataReply:
+    replies = await asyncio.gather(*(send(replicas, cmd) for replicas in dataShards))
+    return next((resp for resp in replies if resp.startswith(b"OK")), replies[0])
+
+
+async def sendToDataTier(cmd: str) -> DataReply:
+    if len(dataShards) == 1:
+        return await send(dataShards[0], cmd)
+    parts = cmd.split()
+    if parts[0] == "RAW_SEARCH":
+        return await send(dataShards[shardMap.owner(parts[1])], cmd)
+    if parts[0] == "RAW_LIST":
+        return await gatherList(parts[1:])
+    if parts[0] == "RAW_QUERY":
+        return await routeQuery(cmd)
+    if parts[0] == "RAW_TEXT":
+        return await gatherText(parts[1:])
+    if parts[0] == "RAW_STATS":
+        if len(parts) > 1 and parts[1] != "*":
+            return await send(dataShards[shardMap.owner(parts[1])], cmd)
+        return await gatherStats(cmd)
+    if parts[0] == "RAW_PUT":
+        return await putListing(cmd)
+    if parts[0] == "RAW_DELETE":
+        return await deleteListing(cmd)
+    return await send(dataShards[0], cmd)
+
 # =============================================================================
 # Command processing function from Client; and reformat to send to Data Server
+# LIST, SEARCH and TEXT take optional paging: LIMIT <n> CURSOR <cursor>, where the
+# cursor comes from the previous page's "NEXT <cursor>". Each may be given once;
+# a repeat raises ValueError.
 # =============================================================================
+def formatPaging(options: List[str]) -> Optional[str]:
+    if len(options) % 2:
+        return None
+    paging = ""
+    for name, value in zip(options[::2], options[1::2]):
+        if name.upper() not in ("LIMIT", "CURSOR") or not value.isdigit():
+            return None
+        if f" {name.upper()} " in paging:
+            raise ValueError(f"duplicate {name.upper()}")
+        paging += f" {name.upper()} {value}"
+    return paging
+
+def splitPaging(options: List[str]) -> Tuple[List[str], dict]:
+    # TEXT's words and the LIMIT / CURSOR pairs that end them
+    words, paging = list(options), {}
+    while len(words) >= 2 and words[-2].upper() in ("LIMIT", "CURSOR") and words[-1].isdigit():
+        if words[-2].upper() in paging:
+            raise ValueError(f"duplicate {words[-2].upper()}")
+        paging[words[-2].upper()] = int(words[-1])
+        del words[-2:]
+    return words, paging
+
 def formatClientRequest(cmd: str) -> str:
     cmd = cmd.strip()
     parts = cmd.split()
     if not parts:
         return errorResponse("Empty command")
 
-    if cmd.upper() == "LIST":
-        return "RAW_LIST"
+    if parts[0].upper() == "LIST":
+        try:
+            paging = formatPaging(parts[1:])
+        except ValueError as e:
+            return errorResponse(str(e))
+        if paging is None:
+            return errorResponse("Usage: LIST [LIMIT <n>] [CURSOR <cursor>]")
+        return "RAW_LIST" + paging
     if parts[0].upper() == "SEARCH":
-        if len(parts) != 3:
-            return errorResponse("Usage: SEARCH <city> <max_price>")
+        try:
+            paging = formatPaging(parts[3:])
+        except ValueError as e:
+            return errorResponse(str(e))
+        if len(parts) < 3 or paging is None:
+            return errorResponse("Usage: SEARCH <city> <max_price> [LIMIT <n>] [CURSOR <cursor>]")
         city = parts[1]
         max_price = parts[2]
-        return f"RAW_SEARCH {city} {max_price}"
+        if MULTI_SEPARATOR in city:
+            return errorResponse(f"city names cannot contain {MULTI_SEPARATOR!r}")
+        try:
+            if math.isnan(float(max_price)):
+                raise ValueError
+        except ValueError:
+            return errorResponse("Invalid max_price value")
+        return f"RAW_SEARCH {city} {max_price}" + paging
+    if parts[0].upper() == "QUERY":
+        try:
+            query = parseListingQuery(cmd.split(None, 1)[1] if len(parts) > 1 else "")
+        except ValueError as e:
+            return errorResponse(f"{e}. Usage: QUERY [CITY <city>[,<city>...]] [MIN_PRICE <p>] [MAX_PRICE <p>] "
+                                 "[MIN_BEDROOMS <n>] [MAX_BEDROOMS <n>] [ADDRESS <prefix>] [TEXT <words>] "
+                                 "[ORDER PRICE|BEDROOMS|ID [ASC|DESC]] [LIMIT <n>] [CURSOR <cursor>]")
+        return f"RAW_QUERY {formatListingQuery(query)}"
+    if parts[0].upper() == "TEXT":
+        try:
+            words, paging = splitPaging(parts[1:])
+        except ValueError as e:
+            return errorResponse(str(e))
+        if not any(ch.isalnum() for ch in "".join(words)):
+            return errorResponse("Usage: TEXT <word> [<word>...] [LIMIT <n>] [CURSOR <cursor>]; "
+                                 "a word ending in * matches a prefix")
+        return f"RAW_TEXT {' '.join(words)}" + "".join(f" {name} {value}" for name, value in paging.items())
+    if parts[0].upper() == "STATS":
+        try:
+            if len(parts) > 3 or (len(parts) == 3 and math.isnan(float(parts[2]))):
+                raise ValueError
+        except ValueError:
+            return errorResponse("Usage: STATS [<city>|*] [<max_price>]")
+        return " ".join(["RAW_STATS", *(parts[1:] or ["*"])])
+    # writes: PUT {"id": 7, "city": ..., ...} adds or replaces listing 7, DELETE 7 removes it
+    if parts[0].upper() == "PUT":
+        listing = cmd.split(None, 1)[1] if len(parts) > 1 else ""
+        if not listing.startswith("{"):
+            return errorResponse('Usage: PUT {"id": <id>, "city": ..., "address": ..., "price": ..., "bedrooms": ...}')
+        return f"RAW_PUT {listing}"
+    if parts[0].upper() == "DELETE":
+        if len(parts) != 2:
+            return errorResponse("Usage: DELETE <id>")
+        return f"RAW_DELETE {parts[1]}"
 
 
     return errorResponse("Unknown command")
 
 # =============================================================================
-# Upon receiving response from data server, process and format data
-# before sending to client; sort by price ascending and bedrooms descending
+# Upon receiving response from data server, keep each row's wire line as the
+# bytes it arrived in; rows arrive sorted by price ascending and bedrooms
+# descending from the data server's index and the client format is the same,
+# so lines are only parsed into Listings when the cache needs their fields
 # =============================================================================
-def parseRows(resp: str) -> List[Dict]:
-    lines = resp.splitlines()
-    rows: List[Dict] = []
-    for line in lines:
-        line = line.strip()
+def splitRows(resp: bytes) -> List[bytes]:
+    body = resp.split(b"\n", 1)[1] if resp.startswith(b"OK RESULT") else resp
+    lines = body.splitlines(keepends=True)
+    if lines and lines[-1].strip() == b"END":
+        lines.pop()
+    return [line for line in lines if line.strip()]
+
+def parseRows(lines: List[bytes]) -> List[Listing]:
+    started = time.perf_counter()
+    rows: List[Listing] = []
+    for raw in lines:
+        line = raw.decode("utf-8", errors="replace").strip()
         if not line or line == "END" or line.startswith("OK RESULT"):
             continue
         parts = [p for p in line.split(";") if p]
@@ -144,123 +1123,793 @@ def parseRows(resp: str) -> List[Dict]:
                 pass
 
         if item:
-            rows.append(item)
+            rows.append(Listing(item.get("id"), item.get("city"), item.get("address"),
+                                item.get("price"), item.get("bedrooms")))
 
+    METRICS.since("parse_rows", started)
     return rows
 
-def dataResponseSort(rows: List[Dict]) -> List[Dict]:
-    # price ascending, bedrooms descending
-    return sorted(rows, key=lambda x: (x.get("price", 10**18), -x.get("bedrooms", 0)))
-
-def responseFormatter(rows: List[Dict]) -> str:
-    msg = f"OK RESULT {len(rows)}\n"
-    for item in rows:
-        msg += (
-            f"id={item.get('id')};"
-            f"city={item.get('city')};"
-            f"address={item.get('address')};"
-            f"price={item.get('price')};"
-            f"bedrooms={item.get('bedrooms')}\n"
+def formatLine(item: Listing) -> bytes:
+    return (
+        f"id={item.id};"
+        f"city={item.city};"
+        f"address={item.address};"
+        f"price={item.price};"
+        f"bedrooms={item.bedrooms}\n"
+    ).encode("utf-8")
+
+# replies are lists of byte buffers so cached lines are written without copying
+def responseFormatter(lines: List[bytes], next_cursor: Optional[int] = None, version: int = 0) -> List[bytes]:
+    started = time.perf_counter()
+    header = f"OK RESULT {len(lines)} VERSION {version}"
+    if next_cursor is not None:
+        header += f" NEXT {next_cursor}"
+    response = [(header + "\n").encode("utf-8"), *lines, b"END\n"]
+    METRICS.since("format", started)
+    return response
+
+# =============================================================================
+# Query cache:
+# - LRU or LFU eviction within a byte budget
+# - per-entry TTL
+# - entries are tagged with the data version they were built from; a newer
+#   version reported by the data server invalidates everything older
+# =============================================================================
+class CacheEntry:
+    __slots__ = ("value", "size", "expires", "version", "hits")
+
+    def __init__(self, value: Any, size: int, expires: float, version: int):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.version = version
+        self.hits = 0
+
+
+class QueryCache:
+    def __init__(self, max_bytes: int = CACHE_BYTES, ttl: float = CACHE_TTL, policy: str = CACHE_POLICY):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"unknown cache policy {policy!r}")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.version = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # lru: key order is recency; lfu: hit count -> keys in recency order
+        self._entries: Dict[str, CacheEntry] = {}
+        self._order: "OrderedDict[str, None]" = OrderedDict()
+        self._freq: Dict[int, "OrderedDict[str, None]"] = {}
+        self._min_freq = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _link(self, key: str, entry: CacheEntry):
+        if self.policy == "lru":
+            self._order[key] = None
+        else:
+            self._freq.setdefault(entry.hits, OrderedDict())[key] = None
+            if entry.hits < self._min_freq or len(self._entries) == 1:
+                self._min_freq = entry.hits
+
+    def _unlink(self, key: str, entry: CacheEntry):
+        if self.policy == "lru":
+            del self._order[key]
+            return
+        bucket = self._freq[entry.hits]
+        del bucket[key]
+        if not bucket:
+            del self._freq[entry.hits]
+            if self._min_freq == entry.hits and self._freq:
+                self._min_freq = min(self._freq)
+
+    def _victim(self) -> str:
+        if self.policy == "lru":
+            return next(iter(self._order))
+        return next(iter(self._freq[self._min_freq]))
+
+    def _remove(self, key: str) -> CacheEntry:
+        entry = self._entries.pop(key)
+        self._unlink(key, entry)
+        self.bytes -= entry.size
+        return entry
+
+    def _lookup(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic() or entry.version < self.version:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._unlink(key, entry)
+        entry.hits += 1
+        self._link(key, entry)
+        return entry
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.value
+
+    def put(self, key: str, value: Any, version: int, ttl: Optional[float] = None, size: Optional[int] = None):
+        size = len(key) + (len(value) if size is None else size)
+        if size > self.max_bytes or version < self.version:
+            return
+        if key in self._entries:
+            self._remove(key)
+        entry = CacheEntry(value, size, time.monotonic() + (self.ttl if ttl is None else ttl), version)
+        self._entries[key] = entry
+        self._link(key, entry)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(self._victim())
+            self.evictions += 1
+
+    def observeVersion(self, version: int):
+        if version <= self.version:
+            return
+        self.version = version
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        self._order.clear()
+        self._freq.clear()
+        self._min_freq = 0
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries), "bytes": self.bytes,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "expirations": self.expirations, "invalidations": self.invalidations,
+        }
+
+
+# =============================================================================
+# Query structure: ("LIST", None, None, cursor, limit) or
+# ("SEARCH", casefolded city, max_price, cursor, limit); limit is None unpaged
+# =============================================================================
+Query = Tuple[str, Optional[str], Optional[float], int, Optional[int]]
+
+def parseQueryPaging(options: List[str]) -> Optional[Tuple[int, Optional[int]]]:
+    # the data server's paging rules: LIMIT above 0, each of LIMIT and CURSOR at most once
+    if len(options) % 2:
+        return None
+    paging = {}
+    for name, value in zip(options[::2], options[1::2]):
+        name = name.upper()
+        if name not in ("LIMIT", "CURSOR") or name in paging or not value.isdigit():
+            return None
+        paging[name] = int(value)
+    if paging.get("LIMIT") == 0:
+        return None
+    return paging.get("CURSOR", 0), paging.get("LIMIT")
+
+def parseQuery(cmd: str) -> Optional[Query]:
+    parts = cmd.split()
+    if parts and parts[0].upper() == "LIST":
+        paging = parseQueryPaging(parts[1:])
+        return ("LIST", None, None) + paging if paging is not None else None
+    if len(parts) >= 3 and parts[0].upper() == "SEARCH":
+        paging = parseQueryPaging(parts[3:])
+        try:
+            max_price = float(parts[2])
+        except ValueError:
+            return None
+        if paging is None or math.isnan(max_price):
+            return None
+        return ("SEARCH", parts[1].casefold(), max_price) + paging
+    return None
+
+def isComplete(query: Query, result: "CachedResult") -> bool:
+    # every row of the query: unpaged, or a first page with no next one
+    return query[3] == 0 and result.next_cursor is None
+
+
+# =============================================================================
+# Cached query result: rows sorted by price, kept in the form they arrived in
+# (text wire lines or decoded binary Listings). The other form, the encoded
+# text reply, the binary frame and its compressed form are each built once, on
+# first use, so cache hits never re-encode or re-compress.
+# =============================================================================
+ROW_BYTES = 200  # rough in-memory cost of one cached row (line/record + parsed Listing)
+
+def rowPrice(item: Listing) -> float:
+    try:
+        return float(item.price)
+    except (TypeError, ValueError):
+        return float("inf")
+
+def inCityIndex(item: Listing, city: str) -> bool:
+    # the data server's city index: rows with a string city and a numeric price
+    if not isinstance(item.city, str) or item.city.casefold() != city:
+        return False
+    try:
+        return not math.isnan(float(item.price))
+    except (TypeError, ValueError):
+        return False
+
+def typedCityName(city: str) -> bool:
+    # whether a non-string city (a number, true/false/null, a list or object) reads as
+    # `city` once the wire has turned it into text; the data server's city index
+    # leaves those rows out, so a SEARCH for such a name can't be cut from a LIST
+    if city in ("none", "true", "false") or city[:1] in ("[", "{"):
+        return True
+    try:
+        float(city)
+    except ValueError:
+        return False
+    return True
+
+
+class CachedResult:
+    __slots__ = ("next_cursor", "version", "_lines", "_rows", "_response", "_frame", "_compressed", "_prices")
+
+    def __init__(self, lines: Optional[List[bytes]] = None, next_cursor: Optional[int] = None,
+                 rows: Optional[List[Listing]] = None, version: int = 0):
+        self.next_cursor = next_cursor
+        self.version = version
+        self._lines = lines
+        self._rows = rows
+        self._response: Optional[List[bytes]] = None
+        self._frame: Optional[List[bytes]] = None
+        self._compressed: Optional[List[bytes]] = None
+        self._prices: Optional[List[float]] = None
+
+    def __len__(self) -> int:
+        return len(self._lines if self._lines is not None else self._rows)
+
+    @property
+    def lines(self) -> List[bytes]:
+        if self._lines is None:
+            self._lines = [formatLine(item) for item in self._rows]
+        return self._lines
+
+    @property
+    def rows(self) -> List[Listing]:
+        if self._rows is None:
+            self._rows = parseRows(self._lines)
+        return self._rows
+
+    @property
+    def response(self) -> List[bytes]:
+        if self._response is None:
+            self._response = responseFormatter(self.lines, self.next_cursor, self.version)
+        return self._response
+
+    @property
+    def frame(self) -> List[bytes]:
+        if self._frame is None:
+            rows = self.rows
+            started = time.perf_counter()
+            self._frame = encodeRows(rows, self.version, self.next_cursor)
+            METRICS.since("format", started)
+        return self._frame
+
+    @property
+    def compressed(self) -> List[bytes]:
+        # the frame for clients that negotiated compression, compressed once per cached result
+        if self._compressed is None:
+            frame = self.frame
+            started = time.perf_counter()
+            self._compressed = compressFrame(frame)
+            METRICS.since("compress", started)
+        return self._compressed
+
+    @property
+    def size(self) -> int:
+        payload = sum(map(len, self._lines)) if self._lines is not None else 0
+        return payload + ROW_BYTES * len(self)
+
+    def _slice(self, start: int, stop: int, next_cursor: Optional[int] = None) -> "CachedResult":
+        return CachedResult(
+            self._lines[start:stop] if self._lines is not None else None, next_cursor,
+            self._rows[start:stop] if self._rows is not None else None, self.version,
         )
-    msg += "END\n"
-    return msg
+
+    def upTo(self, max_price: float) -> "CachedResult":
+        if self._prices is None:
+            self._prices = [rowPrice(item) for item in self.rows]
+        return self._slice(0, bisect_right(self._prices, max_price))
+
+    def page(self, cursor: int, limit: Optional[int]) -> "CachedResult":
+        # the page of a complete result at CURSOR cursor LIMIT limit, as the data server pages it
+        start = min(cursor, len(self))
+        end = len(self) if limit is None else min(len(self), start + limit)
+        if start == 0 and end == len(self):
+            return self
+        return self._slice(start, end, end if end < len(self) else None)
+
+    def inCity(self, city: str) -> "CachedResult":
+        positions = [i for i, item in enumerate(self.rows) if inCityIndex(item, city)]
+        return CachedResult(
+            [self._lines[i] for i in positions] if self._lines is not None else None, None,
+            [self._rows[i] for i in positions], self.version,
+        )
+
+
+class CachedReply:
+    # a cached reply that isn't a result set (STATS): its text, and the TEXT frame and
+    # compressed frame binary clients get, each built once
+    __slots__ = ("text", "version", "_frame", "_compressed")
+
+    def __init__(self, text: bytes, version: int = 0):
+        self.text = text
+        self.version = version
+        self._frame: Optional[List[bytes]] = None
+        self._compressed: Optional[List[bytes]] = None
+
+    @property
+    def response(self) -> List[bytes]:
+        return [self.text]
+
+    @property
+    def frame(self) -> List[bytes]:
+        if self._frame is None:
+            self._frame = [textFrame(self.text.decode("utf-8", errors="replace"))]
+        return self._frame
+
+    @property
+    def compressed(self) -> List[bytes]:
+        if self._compressed is None:
+            self._compressed = compressFrame(self.frame)
+        return self._compressed
+
+    @property
+    def size(self) -> int:
+        return len(self.text)
+
+
+# =============================================================================
+# Result cache: a QueryCache of CachedResults that also tracks which complete
+# SEARCH (per city) and LIST results it holds - unpaged, or a first page that
+# had no next one. A SEARCH miss is answered from the cheapest complete
+# superset: the same city with a higher max_price, or else a complete LIST
+# result filtered the way the data server indexes cities; a LIST miss from a
+# complete LIST. Paged misses get their page of it.
+# =============================================================================
+class ResultCache(QueryCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.derived_hits = 0
+        # casefolded city -> {max_price: cache key}
+        self._searches: Dict[str, Dict[float, str]] = {}
+        self._lists: Dict[str, None] = {}
+        self._queries: Dict[str, Query] = {}
+
+    def _remove(self, key: str) -> CacheEntry:
+        entry = super()._remove(key)
+        query = self._queries.pop(key, None)
+        if query is not None and query[0] == "SEARCH":
+            keys = self._searches[query[1]]
+            keys.pop(query[2], None)
+            if not keys:
+                del self._searches[query[1]]
+        elif query is not None:
+            del self._lists[key]
+        return entry
+
+    def putResult(self, key: str, result: CachedResult, version: int, query: Optional[Query]):
+        self.put(key, result, version, size=result.size)
+        if key not in self._entries or query is None or not isComplete(query, result):
+            return
+        self._queries[key] = query
+        if query[0] == "SEARCH":
+            self._searches.setdefault(query[1], {})[query[2]] = key
+        else:
+            self._lists[key] = None
+
+    def observeVersion(self, version: int):
+        if version > self.version:
+            self._searches.clear()
+            self._lists.clear()
+            self._queries.clear()
+        super().observeVersion(version)
+
+    def _list(self) -> Optional[CachedResult]:
+        for key in list(self._lists):
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry.value
+        return None
+
+    def _superset(self, city: str, max_price: float) -> Optional[CachedResult]:
+        keys = self._searches.get(city, {})
+        for price in sorted(p for p in keys if p >= max_price):
+            entry = self._lookup(keys[price])
+            if entry is not None:
+                return entry.value.upTo(max_price)
+        result = self._list() if not typedCityName(city) else None
+        if result is not None:
+            return result.upTo(max_price).inCity(city)
+        return None
+
+    def lookup(self, key: str, query: Optional[Query]) -> Optional[CachedResult]:
+        result = self.get(key)
+        if result is not None or query is None:
+            return result
+        result = self._superset(query[1], query[2]) if query[0] == "SEARCH" else self._list()
+        if result is None:
+            return None
+        result = result.page(query[3], query[4])
+        self.putResult(key, result, result.version, query)
+        self.derived_hits += 1
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        stats = super().stats()
+        stats["derived_hits"] = self.derived_hits
+        return stats
+
+
+CACHE = ResultCache()
+
+
+# =============================================================================
+# data server reply header fields: "OK RESULT <n> VERSION <v> [NEXT <cursor>]";
+# the data version token is carried by every reply
+# =============================================================================
+def headerField(resp: bytes, name: bytes) -> Optional[str]:
+    header = resp.split(b"\n", 1)[0].split()
+    if name not in header:
+        return None
+    i = header.index(name) + 1
+    return header[i].decode("utf-8", errors="replace") if i < len(header) else None
+
+def responseVersion(resp: bytes) -> Optional[int]:
+    try:
+        return int(headerField(resp, b"VERSION"))
+    except (TypeError, ValueError):
+        return None
+
+# With shards, each data server has its own version. The data tier's version
+# moves forward whenever any shard's does (and equals the data server's version
+# when there is only one), and it is what cached results are tagged with.
+# A replica that hasn't caught up yet can answer from an older version than its
+# shard has already reported; handleClient doesn't cache such a reply.
+shardVersions: Dict[int, int] = {}
+dataTierVersion = 0
+_stale_shards: contextvars.ContextVar = contextvars.ContextVar("stale_shards", default=None)
+
+def observeDataVersion(resp: DataReply, shard: int = 0) -> int:
+    global dataTierVersion
+    version = resp.version if isinstance(resp, ResultSet) else responseVersion(resp)
+    if version is not None and version > shardVersions.get(shard, 0):
+        shardVersions[shard] = version
+        dataTierVersion = max(version, dataTierVersion + 1)
+        CACHE.observeVersion(dataTierVersion)
+    elif version is not None and version < shardVersions.get(shard, 0):
+        stale = _stale_shards.get()
+        if stale is not None:
+            stale.add(shard)
+    return dataTierVersion
+
+# =============================================================================
+# Replies to a client in its negotiated protocol: text as-is, or wrapped in a
+# TEXT frame / sent as a RESULT frame after HELLO BINARY
+# =============================================================================
+def writeText(writer: asyncio.StreamWriter, reply, binary: bool, compress: bool = False):
+    if isinstance(reply, bytes):
+        reply = reply.decode("utf-8", errors="replace")
+    buffers = [textFrame(reply)] if binary else [reply.encode("utf-8")]
+    if binary and compress:
+        buffers = compressFrame(buffers)
+    METRICS.count("bytes_out", sum(map(len, buffers)))
+    writer.writelines(buffers)
+
+def writeResult(writer: asyncio.StreamWriter, result: Union[CachedResult, CachedReply], binary: bool,
+                compress: bool = False):
+    if binary:
+        logReply("APPLICATION->CLIENT",
+                 result.response if isinstance(result, CachedReply) else f"OK RESULT {len(result)} [binary]")
+        buffers = result.compressed if compress else result.frame
+    else:
+        logReply("APPLICATION->CLIENT", result.response)
+        buffers = result.response
+    METRICS.count("bytes_out", sum(map(len, buffers)))
+    writer.writelines(buffers)
+
+def writeNotModified(writer: asyncio.StreamWriter, version: int, binary: bool, compress: bool = False):
+    # the client's copy (IF-NONE-MATCH) is still current: a one-line reply instead of the result
+    METRICS.count("not_modified")
+    reply = ensureEnd(f"{NOT_MODIFIED} VERSION {version}")
+    logReply("APPLICATION->CLIENT", reply)
+    writeText(writer, reply, binary, compress)
+
+# =============================================================================
+# METRICS: this server's stage latencies and counters, then those of every data
+# server replica (RAW_METRICS), one line each:
+#   <source> pid=... uptime_s=... <counter>=<value> ...
+#   <source> stage=<stage> count=... mean_ms=... p50_ms=... p95_ms=... p99_ms=... max_ms=...
+# where source is "app" or "data HOST:PORT". App stages: parse (the command),
+# cache (lookup), data (one data server round trip), merge (shard results),
+# parse_rows, format (reply encoding), send (write + drain), total.
+# =============================================================================
+async def metricsReport() -> str:
+    cache = {f"cache_{name}": value for name, value in CACHE.stats().items()}
+    lines = METRICS.report("app", {**cache, "joined": INFLIGHT.joined, "pending": WORK.active,
+                                   "data_version": dataTierVersion})
+    replicas = [replica for replicas in dataShards for replica in replicas.replicas]
+    replies = await asyncio.gather(*(replica.pool.request("RAW_METRICS") for replica in replicas),
+                                   return_exceptions=True)
+    for replica, reply in zip(replicas, replies):
+        source = f"data {replica.pool.host}:{replica.pool.port}"
+        if isinstance(reply, bytes) and reply.startswith(b"OK METRICS"):
+            text = reply.decode("utf-8", errors="replace")
+            lines += [source + line[len("data"):] for line in text.splitlines() if line.startswith("data ")]
+        else:
+            lines.append(f"{source} unavailable")
+    return ensureEnd("OK METRICS\n" + "\n".join(lines))
 
 # =============================================================================
-CACHE: Dict[str, str] = {}
+# Fetching a query's result from the data tier on a cache miss. Concurrent
+# identical misses (a popular query right after a restart or after it expired)
+# share one fetch: the first starts it, the rest wait for its result instead of
+# each sending the same command to the data tier. Fetches are keyed by the
+# data version too, so a request that arrives after a write never joins a fetch
+# that started before it.
+# =============================================================================
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Tuple[str, int], asyncio.Task] = {}
+        self.joined = 0  # requests answered by another request's fetch
+
+    async def do(self, key: Tuple[str, int], fetch):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.calls.pop(key) if self.calls.get(key) is done else None)
+        else:
+            self.joined += 1
+        # shielded: a waiter that goes away doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+
+INFLIGHT = SingleFlight()
+
+
+async def fetchResult(formatted_cmd: str, cache_key: str, query,
+                      cacheable: bool) -> Union[bytes, CachedResult, CachedReply]:
+    # the result to send the client, or the data tier's reply as-is when it isn't a result set (or STATS)
+    stale: set = set()
+    _stale_shards.set(stale)
+    data_response = await sendToDataTier(formatted_cmd)
+
+    if isinstance(data_response, bytes) and data_response.startswith(b"OK STATS"):
+        # tagged with this server's data version, like results, for IF-NONE-MATCH
+        header, _, body = data_response.partition(b"\n")
+        fields = header.split()  # OK STATS <count> VERSION <v> [ESTIMATED]
+        header = b" ".join([b"OK STATS %s VERSION %d" % (fields[2], dataTierVersion), *fields[5:]]) + b"\n"
+        result = CachedReply(header + body, dataTierVersion)
+    elif isinstance(data_response, bytes) and not data_response.startswith(b"OK RESULT"):
+        return data_response
+    elif isinstance(data_response, ResultSet):
+        # keep rows as they arrived: text lines or decoded binary rows
+        # (data server already sorts by price asc, bedrooms desc)
+        result = CachedResult(None, data_response.next_cursor, data_response.rows, dataTierVersion)
+    else:
+        next_cursor = headerField(data_response, b"NEXT")
+        result = CachedResult(splitRows(data_response), int(next_cursor) if next_cursor else None,
+                              version=dataTierVersion)
+    # cache valid commands, tagged with the data version they came from
+    if cacheable and not stale:
+        CACHE.putResult(cache_key, result, result.version, query)
+    return result
 
 # =============================================================================
 # Handle one client connection (multiple commands until QUIT and close only client connection)
-# so it does not require reconnection per command
+# so it does not require reconnection per command; each client is its own task on the event loop
 # =============================================================================
-def handleClient(conn: socket.socket):
-    with conn:
+async def handleClient(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    METRICS.count("connections")
+    peer = writer.get_extra_info("peername")
+    client = peer[0] if peer else ""
+    binary = False  # switched on by the HELLO BINARY handshake
+    compress = False  # and compression by HELLO BINARY COMPRESS
+    try:
         #interpret commands from client
-        buffer = ""
-
         while True:
-            data = conn.recv(4096)
-            if not data:
+            try:
+                if binary:
+                    _, data = await readFrame(reader)
+                else:
+                    data = await reader.readline()
+                    if not data.endswith(b"\n"):
+                        return
+            except (ConnectionError, ValueError, asyncio.IncompleteReadError):
                 return
-            buffer += data.decode("utf-8", errors="replace")
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                cmd = line.strip()
+            started = time.perf_counter()
+            line = data.decode("utf-8", errors="replace").rstrip("\n")
+            cmd = line.strip()
 
-                if cmd == "":
-                    continue
+            if cmd == "":
+                continue
 
-                # LOG REQUEST
-                logRequest("CLIENT->APPLICATION", line)
+            # the request's deadline: its own DEADLINE <ms> prefix, or --deadline
+            try:
+                budget, cmd = splitDeadline(cmd)
+            except ValueError as e:
+                writeText(writer, errorResponse(str(e)), binary, compress)
+                await writer.drain()
+                continue
+            if budget is None and REQUEST_DEADLINE:
+                budget = REQUEST_DEADLINE
+            _deadline.set(None if budget is None else started + budget)
 
-                # QUIT AND CLOSE CONNECTION
-                if cmd.upper() == "QUIT":
-                    reply = "QUITTING: OK BYE....\nEND\n"
-                    logReply("APPLICATION->CLIENT", reply)
-                    conn.sendall(reply.encode("utf-8"))
-                    print('Closing Client Connection...')
-                    conn.close()
-                    return
+            # IF-NONE-MATCH <version>: the data version of the client's own copy of the result
+            try:
+                known_version, cmd = splitIfNoneMatch(cmd)
+            except ValueError as e:
+                writeText(writer, errorResponse(str(e)), binary, compress)
+                await writer.drain()
+                continue
 
-                formatted_cmd = formatClientRequest(cmd)
+            # METRICS is answered here, outside the request stages it reports
+            if cmd.upper() == "METRICS":
+                writeText(writer, await metricsReport(), binary, compress)
+                await writer.drain()
+                continue
+            METRICS.count("requests")
+            METRICS.count("bytes_in", len(data))
 
-                if formatted_cmd.startswith("ERROR: APPLICATION"):
-                    reply = formatted_cmd
-                    logReply("APPLICATION->CLIENT", reply)
-                    conn.sendall(reply.encode("utf-8"))
-                    continue
+            # LOG REQUEST
+            beginRequest()
+            logRequest("CLIENT->APPLICATION", line)
 
-                cache_key = " ".join(cmd.upper().split())
-                if cache_key in CACHE:
-                    print(f"Cache hit for query: {cmd}")
-                    reply = CACHE[cache_key]
-                    logReply("APPLICATION->CLIENT", reply)
-                    conn.sendall(reply.encode("utf-8"))
-                    continue
+            if not binary and cmd.upper() in (HELLO, HELLO_COMPRESS):
+                compress = cmd.upper() == HELLO_COMPRESS
+                reply = ensureEnd(HELLO_COMPRESS_OK if compress else HELLO_OK)
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                binary = True
+                continue
+
+            # QUIT AND CLOSE CONNECTION
+            if cmd.upper() == "QUIT":
+                reply = "QUITTING: OK BYE....\nEND\n"
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                print('Closing Client Connection...')
+                return
+
+            if not RATE_LIMITER.allow(client):
+                METRICS.count("rate_limited")
+                reply = ensureEnd(f"{BUSY} rate limit exceeded")
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                continue
 
-                # call data server
-                data_response = send(dataSock, formatted_cmd)
+            formatted_cmd = formatClientRequest(cmd)
+            parsed = METRICS.since("parse", started)
 
-                if data_response.startswith("ERROR"):
-                    reply = ensureEnd(data_response)
-                    logReply("APPLICATION->CLIENT", reply)
-                    conn.sendall(reply.encode("utf-8"))
+            if formatted_cmd.startswith("ERROR: APPLICATION"):
+                reply = formatted_cmd
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                continue
+
+            cacheable = cmd.upper().startswith(("LIST", "SEARCH", "QUERY", "TEXT", "STATS"))
+            cache_key = " ".join(cmd.upper().split())
+            query = parseQuery(cmd)
+            cached = CACHE.lookup(cache_key, query) if cacheable else None
+            looked_up = METRICS.since("cache", parsed)
+            if cached is not None:
+                print(f"Cache hit for query: {cmd}")
+                if cached.version == known_version:
+                    writeNotModified(writer, known_version, binary, compress)
+                    await writer.drain()
+                    METRICS.since("total", started)
                     continue
+                writeResult(writer, cached, binary, compress)
+                await writer.drain()
+                METRICS.since("send", looked_up)
+                METRICS.since("total", started)
+                continue
 
-                # parse -> sort -> format
-                try:
-                    rows = parseRows(data_response)
-                    sorted_rows = dataResponseSort(rows)
-                    response = responseFormatter(sorted_rows)
-                except Exception as e:
-                    response = errorResponse("Internal processing error")
-                    print(f"[APP ERROR] {e}")
-                # cache valid commands
-                if cmd.upper().startswith(("LIST", "SEARCH")):
-                    CACHE[cache_key] = response
-                reply = ensureEnd(response)
+            # a miss waits on the data tier; past --max-pending of those, shed it instead
+            if not WORK.acquire():
+                METRICS.count("shed")
+                reply = ensureEnd(f"{BUSY} too many requests waiting on the data tier")
                 logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                continue
 
-                conn.sendall(reply.encode("utf-8"))
+            # call data server; identical concurrent misses share one call
+            try:
+                if cacheable:
+                    result = await INFLIGHT.do((cache_key, dataTierVersion),
+                                               lambda: fetchResult(formatted_cmd, cache_key, query, True))
+                else:
+                    result = await fetchResult(formatted_cmd, cache_key, query, False)
+            except Exception as e:
+                reply = errorResponse("Internal processing error")
+                print(f"[APP ERROR] {e}")
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                continue
+            finally:
+                WORK.release()
+
+            if not isinstance(result, (CachedResult, CachedReply)):
+                reply = result
+                logReply("APPLICATION->CLIENT", reply)
+                writeText(writer, reply, binary, compress)
+                await writer.drain()
+                continue
+
+            sending = time.perf_counter()
+            if result.version == known_version:
+                writeNotModified(writer, known_version, binary, compress)
+            else:
+                writeResult(writer, result, binary, compress)
+            await writer.drain()
+            METRICS.since("send", sending)
+            METRICS.since("total", started)
+    except ConnectionError:
+        return
+    finally:
+        writer.close()
 
 # =============================================================================
-# TCP server for receiving commands from clients and sending responses back
+# TCP server for receiving commands from clients and sending responses back;
+# the asyncio event loop serves every client connection concurrently
 # =============================================================================
-def startTcp(host: str, port: int):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind((host, port))
-        server.listen()
-        print(f"APPLICATION listening on {host}:{port}...")
-
-        while True:
-            conn, addr = server.accept()
-            handleClient(conn)
+async def startTcp(host: str, port: int):
+    server = await asyncio.start_server(handleClient, host, port, reuse_address=True, backlog=1024)
+    health = [asyncio.create_task(replica.pool.healthCheck())
+              for replicas in dataShards for replica in replicas.replicas]
+    print(f"APPLICATION listening on {host}:{port}...")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            for task in health:
+                task.cancel()
 
 # =============================================================================
 # Main
 # =============================================================================
+async def connectData(shards: List[List[Tuple[str, int]]], pool_size: int, protocol: str = DATA_PROTOCOL,
+                      balance: str = BALANCE, hedge: bool = False, depth: int = PIPELINE_DEPTH,
+                      batch_size: int = BATCH_SIZE, timeout: float = DATA_TIMEOUT):
+    for shard, endpoints in enumerate(shards):
+        pools = []
+        for host, port in endpoints:
+            pool = DataConnectionPool(host, port, pool_size, timeout, binary=(protocol == "binary"), shard=shard,
+                                      depth=depth, compress=(protocol == "compressed"))
+            pools.append(pool)
+            try:
+                await pool.warmUp()
+                print(f"Connected to DATA server at {host}:{port}")
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"DATA server at {host}:{port} not reachable yet ({e}); will reconnect on demand")
+        dataShards.append(ReplicaSet(pools, shard, balance, hedge, batch_size))
+
+
+async def serve(args):
+    shards = shardMap.replicas if shardMap else [[(args.data_host, args.data_port)]]
+    await connectData(shards, args.pool_size, args.data_protocol, args.balance, args.hedge,
+                      args.pipeline_depth, args.batch_size, args.data_timeout)
+    await startTcp(args.host, args.port)
+
+
 def main():
-    global dataSock
+    global CACHE, shardMap, REQUEST_DEADLINE
 
     parser = argparse.ArgumentParser(description="Application Layer Server")
     parser.add_argument("--host", default=HOST, help="Host to listen on")
@@ -269,16 +1918,77 @@ def main():
     # configurable Data Server endpoint (defaults)
     parser.add_argument("--data-host", default=DATA_HOST, help="Data server host to connect to")
     parser.add_argument("--data-port", type=int, default=DATA_PORT, help="Data server port to connect to")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="Maximum number of persistent DATA server connections")
+    parser.add_argument("--pipeline-depth", type=int, default=PIPELINE_DEPTH,
+                        help="Requests each DATA server connection may have in flight at once")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="Most SEARCH cache misses sent to a data server in one RAW_MULTI (1 = no batching)")
+    parser.add_argument("--data-protocol", choices=("text", "binary", "compressed"), default=DATA_PROTOCOL,
+                        help="Wire protocol to negotiate with the DATA server (compressed: binary frames, "
+                             "zlib-compressed when large)")
+    parser.add_argument("--shards", nargs="+", metavar="HOST:PORT[+HOST:PORT...][=CITY,...]",
+                        help="Data server shards (replaces --data-host/--data-port), each one server or "
+                             "replicas joined by +; cities not listed are spread over the shards without "
+                             "a list by a hash of the city name")
+    parser.add_argument("--balance", choices=("p2c", "least-outstanding"), default=BALANCE,
+                        help="How reads pick a replica within a shard")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a read to a second replica when the first is slower than the shard's p95")
 
-    args = parser.parse_args()
+    parser.add_argument("--data-timeout", type=float, default=DATA_TIMEOUT,
+                        help="Seconds to wait for a DATA server reply before giving up on the server")
 
-    dataSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    dataSock.settimeout(20)
+    # admission control
+    parser.add_argument("--deadline", type=float, default=REQUEST_DEADLINE,
+                        help="Seconds a request without a DEADLINE of its own may take (0 = no deadline)")
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING,
+                        help="Cache misses that may wait on the data tier at once before more are shed "
+                             "with ERROR: BUSY (0 = no limit)")
+    parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT,
+                        help="Requests per second allowed from each client host (0 = unlimited)")
+    parser.add_argument("--rate-burst", type=float, default=RATE_BURST,
+                        help="Requests a client host may send at once above --rate-limit (default: one second's worth)")
 
-    dataSock.connect((args.data_host, args.data_port))
-    print(f"Connected to DATA server at {args.data_host}:{args.data_port}")
+    # query cache configuration
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_BYTES, help="Query cache byte budget")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL, help="Seconds a cached query stays valid")
+    parser.add_argument("--cache-policy", choices=("lru", "lfu"), default=CACHE_POLICY,
+                        help="Query cache eviction policy")
 
-    startTcp(args.host, args.port)
+    # request/reply log
+    parser.add_argument("--log-payload", choices=("full", "truncated", "summary"), default=LOG_PAYLOAD,
+                        help="How much of each reply to log: full body, truncated, or row count + bytes + latency")
+    parser.add_argument("--log-sample", type=float, default=LOG_SAMPLE_RATE,
+                        help="Fraction of client requests to log (0-1)")
+    parser.add_argument("--log-max-bytes", type=int, default=LOG_MAX_BYTES,
+                        help="Rotate app_server.log when it reaches this size (0 = never)")
+    parser.add_argument("--log-backups", type=int, default=LOG_BACKUPS,
+                        help="Number of rotated log files to keep")
+
+    args = parser.parse_args()
+    if args.pipeline_depth < 1 or args.batch_size < 1:
+        parser.error("--pipeline-depth and --batch-size must be at least 1")
+    if args.data_timeout <= 0 or min(args.deadline, args.max_pending, args.rate_limit, args.rate_burst) < 0:
+        parser.error("need --data-timeout > 0 and --deadline, --max-pending, --rate-limit, --rate-burst >= 0")
+    REQUEST_DEADLINE = args.deadline
+    WORK.limit = args.max_pending
+    RATE_LIMITER.rate = args.rate_limit
+    RATE_LIMITER.burst = args.rate_burst or max(args.rate_limit, 1)
+    if args.shards:
+        try:
+            shardMap = ShardMap(args.shards)
+        except ValueError as e:
+            parser.error(str(e))
+    CACHE = ResultCache(args.cache_bytes, args.cache_ttl, args.cache_policy)
+    startLogging(LOG_FILE, args.log_max_bytes, args.log_backups, args.log_payload, args.log_sample)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopLogging()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
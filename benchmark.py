@@ -0,0 +1,544 @@
+import argparse
+import asyncio
+import json
+import math
+import mmap
+import os
+import random
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+from metrics import Histogram
+from wire_protocol import (BUSY, DEADLINE_EXCEEDED, HELLO, HELLO_COMPRESS, HELLO_OK, KIND_RESULT, MAX_FRAME,
+                           RESULT_HEADER, readFrame, textFrame, withDeadline)
+
+# =============================================================================
+# Load generator and benchmark for the three tiers.
+#
+#   python benchmark.py generate --rows 1000000 --skew 1.1 --out bench.json
+#   python benchmark.py run --db bench.json --clients 32 --duration 30 --output result.json
+#
+# generate writes a synthetic listings file: cities drawn from a Zipf
+# distribution (--skew 0 is uniform), per-city price levels and street-name
+# addresses. run starts a data server and an application server on it (or uses
+# an application server that is already running, --target), then drives it
+# with --clients connections:
+#   - closed loop (default): each connection sends its next request as soon as
+#     the previous reply arrives
+#   - open loop (--rate R): R requests per second are scheduled at fixed times
+#     whether or not earlier ones finished, and latency is measured from the
+#     scheduled time, so queueing behind a slow server is counted in it
+# Requests are LIST/SEARCH pages in the --mix proportions; a --hit-ratio share
+# repeat a small hot set of queries (cache hits once warm) and the rest are
+# unique (always a cache miss and a data tier round trip). Throughput, latency
+# percentiles per kind, the servers' memory and their METRICS are printed as
+# JSON (and written to --output) so runs can be compared.
+# =============================================================================
+HOST = "127.0.0.1"
+DATA_PORT = 6101
+APP_PORT = 6102
+START_TIMEOUT = 600.0  # seconds to wait for the servers' ports; loading 10^7 rows takes a while
+
+CITIES = ["LA", "SanDiego", "SanJose", "SanFrancisco", "Fresno", "Sacramento", "LongBeach", "Oakland",
+          "Bakersfield", "Anaheim", "SantaAna", "Riverside", "Stockton", "Irvine", "ChulaVista", "Fremont",
+          "SanBernardino", "Modesto", "Fontana", "Oxnard", "MorenoValley", "Glendale", "HuntingtonBeach",
+          "SantaClarita", "GardenGrove", "Oceanside", "RanchoCucamonga", "SantaRosa", "Ontario", "ElkGrove"]
+STREETS = ["Ocean", "Pine", "Elm", "Sunset", "Hollywood", "Vine", "Bay", "Harbor", "Main", "Oak", "Maple",
+           "Cedar", "Park", "Lake", "Hill", "Washington", "Lincoln", "Jefferson", "Madison", "Mission",
+           "Broadway", "Palm", "Willow", "Spruce", "Valley", "Canyon", "Mesa", "Vista", "Ridge", "Sierra",
+           "Pacific", "Atlantic", "Garfield", "Grand", "Central", "College", "Orange", "Lemon", "Walnut", "Cherry"]
+SUFFIXES = ["St", "Ave", "Blvd", "Rd", "Dr", "Ln", "Way", "Ct", "Pl"]
+BEDROOMS = [0, 1, 2, 3, 4, 5]
+BEDROOM_WEIGHTS = [4, 22, 34, 26, 10, 4]
+CHUNK = 10000  # rows generated per batch of random draws
+
+PERCENTILES = (50, 90, 95, 99, 99.9)
+HOT_SET = 64
+PAGE_SIZE = 50
+
+
+# =============================================================================
+# Synthetic listings
+# =============================================================================
+def cityNames(count: int) -> List[str]:
+    return [CITIES[i % len(CITIES)] + (str(i // len(CITIES) + 1) if i >= len(CITIES) else "") for i in range(count)]
+
+
+def zipfWeights(count: int, skew: float) -> List[float]:
+    return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    cities = cityNames(args.cities)
+    weights = list(accumulate(zipfWeights(len(cities), args.skew)))
+    levels = {city: rng.uniform(1200, 5000) for city in cities}  # each city's typical rent
+    started = time.perf_counter()
+    with open(args.out, "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for first in range(1, args.rows + 1, CHUNK):
+            n = min(CHUNK, args.rows + 1 - first)
+            picked = rng.choices(cities, cum_weights=weights, k=n)
+            streets = rng.choices(STREETS, k=n)
+            suffixes = rng.choices(SUFFIXES, k=n)
+            bedrooms = rng.choices(BEDROOMS, weights=BEDROOM_WEIGHTS, k=n)
+            lines = []
+            for i in range(n):
+                city, beds = picked[i], bedrooms[i]
+                price = round(levels[city] * (0.6 + 0.15 * beds) * rng.lognormvariate(0, 0.25) / 10) * 10
+                lines.append(f'  {{"id": {first + i}, "city": "{city}", '
+                             f'"address": "{rng.randint(1, 9999)} {streets[i]} {suffixes[i]}", '
+                             f'"price": {price}, "bedrooms": {beds}}}')
+            f.write(",\n".join(lines))
+            f.write(",\n" if first + n <= args.rows else "\n")
+        f.write("]\n")
+    print(json.dumps({"out": args.out, "rows": args.rows, "cities": len(cities), "skew": args.skew,
+                      "bytes": os.path.getsize(args.out), "seconds": round(time.perf_counter() - started, 2)}))
+
+
+# =============================================================================
+# What the workload queries: the file's cities (by how many listings each has)
+# and a sample of its prices, found by scanning the raw JSON instead of parsing it
+# =============================================================================
+CITY_FIELD = re.compile(rb'"city"\s*:\s*"((?:[^"\\]|\\.)*)"')
+PRICE_FIELD = re.compile(rb'"price"\s*:\s*(-?[0-9][0-9.eE+-]*)')
+PRICE_SAMPLE = 10000
+
+
+def scanListings(path: str) -> Tuple[Counter, List[float]]:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        cities = Counter(json.loads(b'"' + m.group(1) + b'"') for m in CITY_FIELD.finditer(data))
+        step = max(1, sum(cities.values()) // PRICE_SAMPLE)
+        prices = []
+        for i, m in enumerate(PRICE_FIELD.finditer(data)):
+            if i % step == 0:
+                prices.append(float(m.group(1)))
+    # SEARCH splits on spaces, so cities with one can't be searched for
+    cities = Counter({city: n for city, n in cities.items() if city and " " not in city})
+    if not cities or not prices:
+        raise SystemExit(f"{path} has no listings with a city and a price to query")
+    return cities, prices
+
+
+# =============================================================================
+# Workload: each request is a LIST or SEARCH page, either one of the hot set
+# (repeated, so cached after its first use) or a unique one that misses the
+# cache. A unique SEARCH gets a max price no other request uses; a unique LIST
+# page becomes the QUERY with the same order under a max price of its own
+# (LIST pages differ only by cursor, and deep cursors cost the data server more).
+# =============================================================================
+class Workload:
+    def __init__(self, cities: Counter, prices: List[float], mix: Dict[str, float], hit_ratio: float,
+                 hot_set: int, page_size: int, seed: int):
+        self.rng = random.Random(seed)
+        self.cities = list(cities)
+        self.weights = list(accumulate(cities.values()))
+        self.prices = sorted(prices)
+        self.kinds = list(mix)
+        self.mix = list(accumulate(mix.values()))
+        self.hit_ratio = hit_ratio
+        self.paging = f" LIMIT {page_size}" if page_size else ""
+        self.page_size = page_size
+        self.unique = 0
+        self.hot = [self.query(kind, hot=True) for kind in self.pick(hot_set)]
+
+    def pick(self, n: int) -> List[str]:
+        return self.rng.choices(self.kinds, cum_weights=self.mix, k=n)
+
+    def maxPrice(self, unique: bool) -> str:
+        price = int(self.rng.choice(self.prices))
+        if not unique:
+            return str(price)
+        self.unique += 1
+        return f"{price}.{self.unique}1"  # distinct digits, so a distinct float, ending in 1 so none collide
+
+    def query(self, kind: str, hot: bool) -> Tuple[str, str]:
+        if kind == "list" and hot:
+            page = self.rng.randrange(4) if self.page_size else 0
+            return kind, "LIST" + self.paging + (f" CURSOR {page * self.page_size}" if page else "")
+        if kind == "list":
+            return kind, f"QUERY MAX_PRICE {self.maxPrice(True)}" + self.paging
+        city = self.rng.choices(self.cities, cum_weights=self.weights)[0]
+        return kind, f"SEARCH {city} {self.maxPrice(not hot)}" + self.paging
+
+    def next(self) -> Tuple[str, str, bool]:
+        # (kind, command, hot)
+        if self.rng.random() < self.hit_ratio:
+            kind, cmd = self.rng.choice(self.hot)
+            return kind, cmd, True
+        kind, cmd = self.query(self.pick(1)[0], hot=False)
+        return kind, cmd, False
+
+
+# =============================================================================
+# Client connections speaking the text protocol or binary frames (optionally
+# compressed), as client.py does, on asyncio streams
+# =============================================================================
+class Connection:
+    def __init__(self, reader, writer, binary: bool):
+        self.reader, self.writer, self.binary = reader, writer, binary
+        self.deadline = 0.0  # seconds sent as each request's DEADLINE (0 = none)
+
+    @classmethod
+    async def open(cls, host: str, port: int, protocol: str, deadline: float = 0) -> "Connection":
+        reader, writer = await asyncio.open_connection(host, port, limit=MAX_FRAME)
+        conn = cls(reader, writer, False)
+        if protocol != "text":
+            reply, _ = await conn.request(HELLO_COMPRESS if protocol == "compressed" else HELLO)
+            if not reply.startswith(HELLO_OK):
+                raise ConnectionError(f"the application server refused {protocol} frames: {reply.strip()}")
+            conn.binary = True
+        conn.deadline = deadline
+        return conn
+
+    async def request(self, cmd: str) -> Tuple[str, int]:
+        # (reply, or its header line for results; bytes read)
+        if self.deadline:
+            cmd = withDeadline(cmd, self.deadline)
+        if self.binary:
+            self.writer.write(textFrame(cmd))
+            kind, payload = await readFrame(self.reader)
+            if kind == KIND_RESULT:
+                return f"OK RESULT {RESULT_HEADER.unpack_from(payload, 0)[3]}", len(payload)
+            return payload.decode("utf-8", errors="replace"), len(payload)
+        self.writer.write(cmd.encode("utf-8") + b"\n")
+        reply = await self.reader.readuntil(b"\nEND\n")
+        return reply[:reply.find(b"\n") + 1].decode("utf-8", errors="replace"), len(reply)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+# =============================================================================
+# Results: a latency histogram per kind and overall, counted only once the
+# warm-up is over. Requests the servers shed (ERROR: BUSY) or gave up on
+# (ERROR: DEADLINE EXCEEDED) are counted apart from other errors.
+# =============================================================================
+class Results:
+    def __init__(self):
+        self.latency: Dict[str, Histogram] = {"all": Histogram()}
+        self.requests = Counter()
+        self.errors = Counter()
+        self.shed = 0
+        self.expired = 0
+        self.reply_bytes = 0  # as decoded, so compression doesn't shrink it
+        self.recording = False
+        self.started = self.finished = 0.0
+
+    def record(self, kind: str, hot: bool, seconds: float, reply: Optional[str], size: int):
+        if not self.recording:
+            return
+        for name in ("all", kind):
+            self.latency.setdefault(name, Histogram()).record(seconds)
+        self.requests[kind] += 1
+        self.requests["hot" if hot else "cold"] += 1
+        self.reply_bytes += size
+        if reply is not None and reply.startswith(BUSY):
+            self.shed += 1
+        elif reply is not None and reply.startswith(DEADLINE_EXCEEDED):
+            self.expired += 1
+        elif reply is None or not reply.startswith("OK"):
+            self.errors[kind] += 1
+
+    def summary(self) -> dict:
+        elapsed = max(self.finished - self.started, 1e-9)
+        total = self.latency["all"].count
+        return {
+            "seconds": round(elapsed, 3),
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 1),
+            "errors": sum(self.errors.values()),
+            "shed": self.shed,
+            "expired": self.expired,
+            "hot_requests": self.requests["hot"],
+            "cold_requests": self.requests["cold"],
+            "reply_bytes": self.reply_bytes,
+            "latency_ms": {name: latencySummary(h) for name, h in self.latency.items()},
+            "errors_by_kind": dict(self.errors),
+        }
+
+
+def latencySummary(histogram: Histogram) -> dict:
+    summary = {"count": histogram.count, "mean": round(histogram.total / max(histogram.count, 1) / 1000, 3)}
+    for p in PERCENTILES:
+        summary[f"p{p:g}".replace(".", "")] = round(histogram.percentile(p) * 1000, 3)
+    summary["max"] = round(histogram.max / 1000, 3)
+    return summary
+
+
+async def issue(conn: Connection, workload: Workload, results: Results, scheduled: float) -> bool:
+    # False once the connection is broken; the failed request counts as an error
+    kind, cmd, hot = workload.next()
+    try:
+        reply, size = await conn.request(cmd)
+    except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        results.record(kind, hot, time.perf_counter() - scheduled, None, 0)
+        return False
+    results.record(kind, hot, time.perf_counter() - scheduled, reply, size)
+    return True
+
+
+async def closedLoop(conns: List[Connection], workload: Workload, results: Results, stop: float):
+    async def drive(conn):
+        while time.perf_counter() < stop:
+            if not await issue(conn, workload, results, time.perf_counter()):
+                return
+    await asyncio.gather(*(drive(conn) for conn in conns))
+
+
+async def openLoop(conns: List[Connection], workload: Workload, results: Results, stop: float, rate: float):
+    # request i is due at start + i / rate; it waits for a free connection, and that wait is part of its latency
+    due: asyncio.Queue = asyncio.Queue()
+
+    async def drive(conn):
+        while True:
+            scheduled = await due.get()
+            if scheduled is None or not await issue(conn, workload, results, scheduled):
+                return
+
+    drivers = [asyncio.ensure_future(drive(conn)) for conn in conns]
+    start, i = time.perf_counter(), 0
+    while True:
+        scheduled = start + i / rate
+        if scheduled >= stop:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        due.put_nowait(scheduled)
+        i += 1
+    for _ in drivers:
+        due.put_nowait(None)
+    await asyncio.gather(*drivers)
+
+
+async def drive(args, workload: Workload, host: str, port: int) -> Results:
+    conns = await asyncio.gather(*(Connection.open(host, port, args.protocol, args.deadline) for _ in range(args.clients)))
+    results = Results()
+    try:
+        for recording, seconds in ((False, args.warmup), (True, args.duration)):
+            if seconds <= 0:
+                continue
+            results.recording = recording
+            results.started = time.perf_counter()
+            stop = results.started + seconds
+            if args.rate:
+                await openLoop(conns, workload, results, stop, args.rate)
+            else:
+                await closedLoop(conns, workload, results, stop)
+            results.finished = time.perf_counter()
+    finally:
+        await asyncio.gather(*(conn.close() for conn in conns))
+    return results
+
+
+# =============================================================================
+# Servers: started as subprocesses in a scratch directory (app_server.log lands
+# there), ready once their port accepts connections. Memory is read from /proc
+# for each server and the workers it forked: resident now and the peak (VmHWM).
+# =============================================================================
+def startServer(argv: List[str], port: int, cwd: str, name: str, timeout: float) -> subprocess.Popen:
+    log = open(os.path.join(cwd, f"{name}.out"), "wb")
+    proc = subprocess.Popen([sys.executable, *argv], cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.monotonic() + timeout
+    while True:
+        if proc.poll() is not None:
+            raise SystemExit(f"{name} exited with {proc.returncode}; see {os.path.join(cwd, name + '.out')}")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return proc
+        except OSError:
+            if time.monotonic() > deadline:
+                proc.kill()
+                raise SystemExit(f"{name} did not open port {port} within {timeout:.0f}s")
+            time.sleep(0.1)
+
+
+def stopServer(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def processTree(pid: int) -> List[int]:
+    pids, i = [pid], 0
+    while i < len(pids):
+        try:
+            for task in os.listdir(f"/proc/{pids[i]}/task"):
+                with open(f"/proc/{pids[i]}/task/{task}/children") as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+        i += 1
+    return pids
+
+
+def memory(pid: int) -> Optional[dict]:
+    # kB summed over the process and its children (forked workers share pages, so this overcounts them)
+    usage = {"processes": 0, "rss_kb": 0, "peak_rss_kb": 0}
+    for process in processTree(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        usage["processes"] += 1
+        usage["rss_kb"] += int(status.get("VmRSS", "0 kB").split()[0])
+        usage["peak_rss_kb"] += int(status.get("VmHWM", "0 kB").split()[0])
+    return usage if usage["processes"] else None
+
+
+def fetchMetrics(host: str, port: int) -> List[str]:
+    try:
+        with socket.create_connection((host, port), timeout=10) as s:
+            s.sendall(b"METRICS\n")
+            data = b""
+            while not data.endswith(b"END\n"):
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            s.sendall(b"QUIT\n")
+    except OSError as e:
+        return [f"unavailable ({e})"]
+    return [line for line in data.decode("utf-8", errors="replace").splitlines()
+            if line and line not in ("OK METRICS", "END")]
+
+
+def parseMix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, sep, weight = part.partition("=")
+        kind = kind.strip().lower()
+        if kind not in ("list", "search") or not sep:
+            raise argparse.ArgumentTypeError(f"{part!r} is not list=<weight> or search=<weight>")
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{weight!r} is not a number") from None
+        if mix[kind] < 0 or math.isnan(mix[kind]):
+            raise argparse.ArgumentTypeError(f"{part!r} needs a weight of 0 or more")
+    mix = {kind: weight for kind, weight in mix.items() if weight}
+    if not mix:
+        raise argparse.ArgumentTypeError("the mix needs a kind with a positive weight")
+    return mix
+
+
+def run(args):
+    db = os.path.abspath(args.db)
+    cities, prices = scanListings(db)
+    workload = Workload(cities, prices, args.mix, args.hit_ratio, args.hot_set, args.page_size, args.seed)
+    servers: Dict[str, subprocess.Popen] = {}
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    if args.target:
+        host, _, port = args.target.rpartition(":")
+        port = int(port)
+    else:
+        host, port = HOST, args.app_port
+    try:
+        if not args.target:
+            servers["data"] = startServer(
+                [os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_server.py"),
+                 "--port", str(args.data_port), "--db", db, *shlex.split(args.data_args)],
+                args.data_port, scratch, "data_server", args.start_timeout)
+            servers["app"] = startServer(
+                [os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_server.py"),
+                 "--port", str(port), "--data-port", str(args.data_port), "--log-payload", "summary",
+                 *shlex.split(args.app_args)],
+                port, scratch, "app_server", args.start_timeout)
+        started = {name: memory(proc.pid) for name, proc in servers.items()}
+        results = asyncio.run(drive(args, workload, host, port))
+        report = {
+            "config": {key: value for key, value in vars(args).items() if key != "func"},
+            "rows": sum(cities.values()),
+            "cities": len(cities),
+            "mode": "open" if args.rate else "closed",
+            **results.summary(),
+            "servers": {name: {"loaded": started[name], "after": memory(proc.pid)} for name, proc in servers.items()},
+            "metrics": fetchMetrics(host, port),
+        }
+    finally:
+        for proc in reversed(list(servers.values())):
+            stopServer(proc)
+    shutil.rmtree(scratch, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+# =============================================================================
+# Main with argparse
+# =============================================================================
+def main():
+    parser = argparse.ArgumentParser(description="Home Listings load generator and benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write a synthetic listings file")
+    gen.add_argument("--rows", type=int, default=100000, help="listings to write (10^3 - 10^7)")
+    gen.add_argument("--cities", type=int, default=len(CITIES), help="distinct cities")
+    gen.add_argument("--skew", type=float, default=1.0,
+                     help="Zipf exponent of the city distribution (0 = uniform; larger = a few big cities)")
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--out", default="bench_listings.json")
+    gen.set_defaults(func=generate)
+
+    bench = commands.add_parser("run", help="start the servers on a listings file and measure them under load")
+    bench.add_argument("--db", default="bench_listings.json", help="listings file (e.g. from generate)")
+    bench.add_argument("--target", metavar="HOST:PORT",
+                       help="benchmark an application server that is already running instead of starting one")
+    bench.add_argument("--data-port", type=int, default=DATA_PORT)
+    bench.add_argument("--app-port", type=int, default=APP_PORT)
+    bench.add_argument("--data-args", default="", help='extra data_server.py arguments, e.g. "--workers 4"')
+    bench.add_argument("--app-args", default="", help='extra app_server.py arguments, e.g. "--data-protocol binary"')
+    bench.add_argument("--start-timeout", type=float, default=START_TIMEOUT)
+    bench.add_argument("--clients", type=int, default=16, help="concurrent client connections")
+    bench.add_argument("--rate", type=float, default=0,
+                       help="open loop: requests per second in total (default: closed loop)")
+    bench.add_argument("--duration", type=float, default=10.0, help="seconds measured")
+    bench.add_argument("--warmup", type=float, default=2.0, help="seconds of load before measuring")
+    bench.add_argument("--mix", type=parseMix, default=parseMix("list=1,search=4"),
+                       help="request proportions, e.g. list=1,search=4")
+    bench.add_argument("--hit-ratio", type=float, default=0.8,
+                       help="share of requests repeating the hot set (cache hits) rather than unique misses")
+    bench.add_argument("--hot-set", type=int, default=HOT_SET, help="distinct queries in the hot set")
+    bench.add_argument("--page-size", type=int, default=PAGE_SIZE, help="LIMIT per request (0 = whole results)")
+    bench.add_argument("--protocol", choices=("text", "binary", "compressed"), default="text",
+                       help="client to application server protocol")
+    bench.add_argument("--deadline", type=float, default=0,
+                       help="seconds sent as each request's DEADLINE (default: none, the server's --deadline applies)")
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--output", help="also write the JSON results here")
+    bench.set_defaults(func=run)
+
+    args = parser.parse_args()
+    if args.command == "generate" and not 1 <= args.rows <= 10 ** 8:
+        parser.error("--rows must be between 1 and 10^8")
+    if args.command == "run":
+        if args.clients < 1 or args.duration <= 0 or args.rate < 0 or not 0 <= args.hit_ratio <= 1:
+            parser.error("need --clients >= 1, --duration > 0, --rate >= 0 and --hit-ratio between 0 and 1")
+        if args.hot_set < 1 or args.page_size < 0 or args.deadline < 0:
+            parser.error("need --hot-set >= 1 and --page-size, --deadline >= 0")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
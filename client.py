@@ -1,6 +1,13 @@
 import socket
+import shlex
+import sys
 import time
 import argparse
+from collections import OrderedDict, deque
+
+from listing_query import queryClauses
+from wire_protocol import (HELLO, HELLO_COMPRESS, HELLO_COMPRESS_OK, HELLO_OK, IF_NONE_MATCH, KIND_RESULT,
+                           NOT_MODIFIED, ResultSet, decodeResult, recvFrame, textFrame, withDeadline)
 
 #=============================================================================
 # Oanh Tran 029661786
@@ -13,16 +20,43 @@ import argparse
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 5002
 
+# rows requested per page for LIST/SEARCH/QUERY/TEXT (0 = whole result in one reply)
+DEFAULT_PAGE_SIZE = 50
+
+# seconds the servers get to answer each request (sent as its DEADLINE; 0 = none);
+# the socket gives up DEADLINE_GRACE seconds after that
+REQUEST_DEADLINE = 10.0
+DEADLINE_GRACE = 5.0
+
+# replies kept by the local result cache (0 = no cache), and how many commands
+# --batch sends ahead of the replies it has read
+CACHE_ENTRIES = 256
+BATCH_WINDOW = 32
+
+
+COLUMNS = ["id", "city", "address", "price", "bedrooms"]
 
 #=============================================================================
-# Print response from server in a nice format
+# Print response from server in a nice format; pages after the first reuse
+# (and widen) the first page's column widths and skip the header.
+# Binary results arrive already decoded, so only text replies are parsed here.
 #=============================================================================
-def printQuery(resp: str):
+def printQuery(resp, widths: dict = None):
+    first_page = widths is None
+    if isinstance(resp, ResultSet):
+        if first_page and not resp.rows:
+            print("No homes found matching your criteria.")
+            return
+        return printTable([row._asdict() for row in resp.rows], widths)
+
     resp = resp.strip()
     if "QUITTING" in resp:
         return
+    if resp.startswith("ERROR"):  # e.g. ERROR: BUSY (try again later) or ERROR: DEADLINE EXCEEDED
+        print(resp.rsplit("END", 1)[0].strip())
+        return
 
-    if "OK RESULT 0" in resp:
+    if first_page and resp.startswith("OK RESULT 0"):
         print("No homes found matching your criteria.")
         return
 
@@ -39,58 +73,279 @@ def printQuery(resp: str):
                 item[k.strip()] = v.strip()
         if item:
             rows.append(item)
+    return printTable(rows, widths)
+
 
-    cols = ["id", "city", "address", "price", "bedrooms"]
-    widths = {c: len(c) for c in cols}
+def printTable(rows: list, widths: dict = None):
+    cols = COLUMNS
+    first_page = widths is None
+    if first_page:
+        widths = {c: len(c) for c in cols}
 
     for r in rows:
         for c in cols:
             widths[c] = max(widths[c], len(str(r.get(c, ""))))
 
-    header = " | ".join(c.ljust(widths[c]) for c in cols)
-    sep = "-+-".join("-" * widths[c] for c in cols)
+    if first_page:
+        header = " | ".join(c.ljust(widths[c]) for c in cols)
+        sep = "-+-".join("-" * widths[c] for c in cols)
 
-    print(header)
-    print(sep)
+        print(header)
+        print(sep)
 
     for r in rows:
         print(" | ".join(str(r.get(c, "")).ljust(widths[c]) for c in cols))
+    return widths
 
 
 #=============================================================================
-# Sending commands and receiving response from application
+# Sending commands and receiving response from application; after the
+# HELLO BINARY handshake (--binary) commands and replies travel as frames.
+# Every command carries the time left for it as a DEADLINE prefix.
 #=============================================================================
-def run(sock, cmd):
-    sock.sendall((cmd.strip() + "\n").encode())
+def sendCommand(sock, cmd, binary=False):
+    if REQUEST_DEADLINE:
+        cmd = withDeadline(cmd, REQUEST_DEADLINE)
+    if binary:
+        sock.sendall(textFrame(cmd.strip()))
+    else:
+        sock.sendall((cmd.strip() + "\n").encode())
+
+
+class Replies:
+    # reads replies off the socket in the order they come; a text reply ends at
+    # its END line, and anything read past it is kept for the next one
+    def __init__(self, sock, binary=False):
+        self.sock = sock
+        self.binary = binary
+        self.buffer = bytearray()
+
+    def next(self):
+        if self.binary:
+            kind, payload = recvFrame(self.sock)
+            if kind == KIND_RESULT:
+                return decodeResult(payload)
+            return payload.decode("utf-8", errors="replace")
+        scanned = 0
+        while True:
+            end = self.buffer.find(b"\nEND\n", max(scanned - 4, 0))
+            if end >= 0:
+                reply = bytes(self.buffer[:end + 5])
+                del self.buffer[:end + 5]
+                return reply.decode("utf-8", errors="replace")
+            scanned = len(self.buffer)
+            chunk = self.sock.recv(65536)
+            if not chunk:  # closed: whatever arrived
+                reply, self.buffer = bytes(self.buffer), bytearray()
+                return reply.decode("utf-8", errors="replace")
+            self.buffer += chunk
+
+
+def request(sock, cmd, binary=False):
+    sendCommand(sock, cmd, binary)
+    return Replies(sock, binary).next()
+
+
+#=============================================================================
+# Local result cache: LIST/SEARCH/QUERY/TEXT/STATS replies are kept by command
+# (least recently used dropped first) with the data version they carry. The
+# same command is then sent as IF-NONE-MATCH <version> <command>, and while the
+# listings haven't changed the server answers NOT MODIFIED instead of sending
+# the rows again.
+#=============================================================================
+CACHEABLE = ("LIST", "SEARCH", "QUERY", "TEXT", "STATS")
+
+def replyVersion(resp):
+    if isinstance(resp, ResultSet):
+        return resp.version
+    header = resp.split("\n", 1)[0].split()
+    if resp.startswith(("OK RESULT", "OK STATS")) and "VERSION" in header[:-1]:
+        value = header[header.index("VERSION") + 1]
+        return int(value) if value.isdigit() else None
+    return None
+
+
+class ResultCache:
+    def __init__(self, entries=CACHE_ENTRIES):
+        self.entries = entries
+        self.replies = OrderedDict()  # command -> (version, reply)
+        self.revalidated = 0  # replies answered NOT MODIFIED
+
+    def key(self, cmd):
+        return " ".join(cmd.upper().split())
+
+    def prepare(self, cmd):
+        # (the command to send, the kept (version, reply) it revalidates, or None)
+        kept = None
+        if self.entries and cmd.strip().upper().startswith(CACHEABLE):
+            kept = self.replies.get(self.key(cmd))
+        if kept is None:
+            return cmd, None
+        return f"{IF_NONE_MATCH} {kept[0]} {cmd.strip()}", kept
+
+    def resolve(self, cmd, resp, kept):
+        # the reply to show: the kept one when the server says it is still current
+        key = self.key(cmd)
+        if kept is not None and isinstance(resp, str) and resp.startswith(NOT_MODIFIED):
+            self.revalidated += 1
+            if key in self.replies:
+                self.replies.move_to_end(key)
+            return kept[1]
+        version = replyVersion(resp) if self.entries and cmd.strip().upper().startswith(CACHEABLE) else None
+        if version is not None:
+            self.replies[key] = (version, resp)
+            self.replies.move_to_end(key)
+            while len(self.replies) > self.entries:
+                self.replies.popitem(last=False)
+        return resp
+
+
+RESULTS = ResultCache()
+
+
+def cachedRequest(sock, cmd, binary=False):
+    sent, kept = RESULTS.prepare(cmd)
+    return RESULTS.resolve(cmd, request(sock, sent, binary), kept)
+
+
+def socketTimeout():
+    return REQUEST_DEADLINE + DEADLINE_GRACE if REQUEST_DEADLINE else None
+
+
+def negotiateBinary(sock, compress=False) -> bool:
+    reply = request(sock, HELLO_COMPRESS if compress else HELLO)
+    if compress and not reply.startswith(HELLO_COMPRESS_OK) and reply.startswith(HELLO_OK):
+        print("Application server does not support compression; using uncompressed binary frames.")
+    if reply.startswith(HELLO_OK):
+        return True
+    print("Application server does not support the binary protocol; using text.")
+    return False
+
+
+def nextCursor(resp):
+    if isinstance(resp, ResultSet):
+        return resp.next_cursor
+    header = resp.split("\n", 1)[0].split()
+    if resp.startswith("OK RESULT") and "NEXT" in header[:-1]:
+        return header[header.index("NEXT") + 1]
+    return None
 
-    data = ""
-    while True:
-        chunk = sock.recv(4096).decode()
-        if not chunk:
-            break
-        data += chunk
-        if "\nEND\n" in data or data.startswith("ERROR: APPLICATION"):
-            break
 
+#=============================================================================
+# With a page size, LIST/SEARCH/QUERY/TEXT are fetched LIMIT rows at a time and each page
+# is printed as soon as it arrives, following NEXT cursors until the last page
+#=============================================================================
+def run(sock, cmd, page_size=0, binary=False):
     print(f"\n> {cmd}")
-    printQuery(data)
+    if not page_size:
+        printQuery(cachedRequest(sock, cmd, binary))
+        return
+
+    widths = None
+    cursor = None
+    while True:
+        page_cmd = f"{cmd} LIMIT {page_size}"
+        if cursor is not None:
+            page_cmd += f" CURSOR {cursor}"
+        resp = cachedRequest(sock, page_cmd, binary)
+        widths = printQuery(resp, widths)
+        cursor = nextCursor(resp)
+        if cursor is None or widths is None:
+            break
 
 
 #=============================================================================
 # Client Search/List commands
 #=============================================================================
-def search(sock, city, max_price):
+def search(sock, city, max_price, page_size=DEFAULT_PAGE_SIZE, binary=False):
     start_time = time.perf_counter()
     city = city.replace(" ", "")
-    run(sock, f"SEARCH {city} {max_price}")
+    run(sock, f"SEARCH {city} {max_price}", page_size, binary)
     end_time = time.perf_counter()
     print(f"\nSearch completed in {(end_time - start_time) * 1000:.2f} ms.")
 
 
-def listHomes(sock):
+def advancedSearch(sock, options, page_size=DEFAULT_PAGE_SIZE, binary=False):
+    # a QUERY with a LIMIT of its own is fetched as a single page
+    start_time = time.perf_counter()
+    run(sock, f"QUERY {options}".strip(), 0 if "LIMIT" in queryClauses(options) else page_size, binary)
+    end_time = time.perf_counter()
+    print(f"\nQuery completed in {(end_time - start_time) * 1000:.2f} ms.")
+
+
+def textSearch(sock, words, page_size=DEFAULT_PAGE_SIZE, binary=False):
+    start_time = time.perf_counter()
+    run(sock, f"TEXT {words}", page_size, binary)
+    end_time = time.perf_counter()
+    print(f"\nAddress search completed in {(end_time - start_time) * 1000:.2f} ms.")
+
+
+def marketStats(sock, city, max_price, binary=False):
+    start_time = time.perf_counter()
+    cmd = " ".join(["STATS", city.replace(" ", "") or "*", *([max_price] if max_price else [])])
+    print(f"\n> {cmd}")
+    printStats(cachedRequest(sock, cmd, binary))
+    end_time = time.perf_counter()
+    print(f"\nStatistics completed in {(end_time - start_time) * 1000:.2f} ms.")
+
+
+#=============================================================================
+# Print a STATS reply: count, price summary, bedroom mix and a price histogram
+#=============================================================================
+def printStats(resp):
+    if not resp.startswith("OK STATS"):
+        print(resp.rsplit("END", 1)[0].strip())
+        return
+    fields = dict(line.split("=", 1) for line in resp.splitlines()[1:] if "=" in line)
+    if fields.get("count", "0") == "0":
+        print("No homes found matching your criteria.")
+        return
+    # estimated fields (STATS combined across shards) are shown with a ~
+    estimated = fields.get("estimated", "").split(",")
+    shown = {name: ("~" if name in estimated else "") + value for name, value in fields.items()}
+    print(f"Homes:        {shown['count']}")
+    print(f"Price range:  {shown['min_price']} - {shown['max_price']}")
+    print(f"Average:      {shown['mean_price']}")
+    print(f"Median:       {shown['median_price']} (middle half {shown['p25_price']} - {shown['p75_price']})")
+    mix = [item.split(":") for item in fields["bedrooms"].split(",") if item]
+    print("Bedrooms:     " + ", ".join(f"{beds}: {n}" for beds, n in mix))
+    print("Prices:")
+    buckets = [item.rsplit(":", 1) for item in fields["histogram"].split(",")]
+    widest = max(int(n) for _, n in buckets) or 1
+    for label, n in buckets:
+        print(f"  {label:>19} {'#' * round(30 * int(n) / widest):<30} {n}")
+    if "histogram" in estimated:
+        print("(histogram counts are estimated across shards)")
+
+
+def queryOptions():
+    # build QUERY options from prompts; blank answers leave a filter out
+    prompts = [
+        ("CITY", "Cities, comma separated (blank for any): "),
+        ("MIN_PRICE", "Minimum price: "), ("MAX_PRICE", "Maximum price: "),
+        ("MIN_BEDROOMS", "Minimum bedrooms: "), ("MAX_BEDROOMS", "Maximum bedrooms: "),
+        ("ADDRESS", "Address starts with: "),
+        ("TEXT", "Address contains the words (end a word with * for a prefix): "),
+    ]
+    options = []
+    for name, prompt in prompts:
+        value = input(prompt).strip()
+        if value:
+            options.append(f"{name} {shlex.quote(value.replace(', ', ',') if name == 'CITY' else value)}")
+    order = input("Sort by price, bedrooms or id (blank for price): ").strip()
+    if order:
+        descending = input("Descending? (y/N): ").strip().lower().startswith("y")
+        options.append(f"ORDER {order} {'DESC' if descending else 'ASC'}")
+    limit = input("Maximum results (blank for all): ").strip()
+    if limit:
+        options.append(f"LIMIT {limit}")
+    return " ".join(options)
+
+
+def listHomes(sock, page_size=DEFAULT_PAGE_SIZE, binary=False):
     start_time = time.perf_counter()
     print("-----------------------------Listing all homes: ------------------------------")
-    run(sock, "LIST")
+    run(sock, "LIST", page_size, binary)
     end_time = time.perf_counter()
     print(f"\nTotal time: {(end_time - start_time) * 1000:.2f} ms\n")
 
@@ -98,11 +353,14 @@ def listHomes(sock):
 #=============================================================================
 # Client Menu (persistent socket)
 #=============================================================================
-def ClientMenu(host, port):
+def ClientMenu(host, port, page_size=DEFAULT_PAGE_SIZE, binary=False, compress=False):
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(socketTimeout())
             s.connect((host, port))
             print(f"Connected to application layer at {host}:{port}")
+            if binary:
+                binary = negotiateBinary(s, compress)
 
             while True:
                 print("\n-----------------------------------")
@@ -111,14 +369,17 @@ def ClientMenu(host, port):
                 print("Please choose one of the options below:")
                 print("  1. View all home listings")
                 print("  2. Search for a home")
-                print("  3. Exit")
+                print("  3. Advanced search")
+                print("  4. Search by address")
+                print("  5. Price statistics")
+                print("  6. Exit")
                 print("-----------------------------------")
 
-                choice = input("Your choice (1-3): ").strip()
+                choice = input("Your choice (1-6): ").strip()
 
                 if choice == "1":
                     print("\nFetching all available homes...\n")
-                    listHomes(s)
+                    listHomes(s, page_size, binary)
 
                 elif choice == "2":
                     print("\nSearch for a home")
@@ -136,14 +397,41 @@ def ClientMenu(host, port):
 
                     print("-----------------------------------------------")
                     print(f"\nSearching homes in {city} under {max_price}...")
-                    search(s, city, max_price)
+                    search(s, city, max_price, page_size, binary)
 
                 elif choice == "3":
-                    run(s, "QUIT")
+                    print("\nAdvanced search")
+                    print("---------------")
+                    advancedSearch(s, queryOptions(), page_size, binary)
+
+                elif choice == "4":
+                    print("\nSearch by address")
+                    print("-----------------")
+                    words = input("Street, neighborhood or number (end a word with * for a prefix): ").strip()
+                    if not words:
+                        print("Please enter at least one word.")
+                        continue
+                    textSearch(s, words, page_size, binary)
+
+                elif choice == "5":
+                    print("\nPrice statistics")
+                    print("----------------")
+                    city = input("City (blank for all cities): ").strip()
+                    max_price = input("Maximum price (blank for any): ").strip()
+                    try:
+                        if max_price:
+                            float(max_price)
+                    except ValueError:
+                        print("Please enter a valid number for the price.")
+                        continue
+                    marketStats(s, city, max_price, binary)
+
+                elif choice == "6":
+                    run(s, "QUIT", binary=binary)
                     break
 
                 else:
-                    print("Invalid selection. Please choose 1, 2, or 3.")
+                    print("Invalid selection. Please choose 1, 2, 3, 4, 5, or 6.")
 
             print("Bye!")
 
@@ -155,19 +443,137 @@ def ClientMenu(host, port):
         print(f"Socket error: {e}")
 
 
+#=============================================================================
+# --batch FILE (- for stdin): one command per line, blank lines and # comments
+# skipped, up to a QUIT. Commands are pipelined over the one connection: up to
+# BATCH_WINDOW are sent before their replies are read, and replies are printed
+# in order as they arrive. --repeat runs the file again every --interval
+# seconds, revalidating against the local cache, so unchanged results cost a
+# NOT MODIFIED line each.
+#=============================================================================
+def readBatch(path):
+    commands = []
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.upper() == "QUIT":
+                break
+            commands.append(line)
+    return commands
+
+
+def printReply(cmd, resp):
+    print(f"\n> {cmd}")
+    if isinstance(resp, str) and resp.startswith("OK STATS"):
+        printStats(resp)
+    elif isinstance(resp, ResultSet) or resp.startswith("OK RESULT"):
+        printQuery(resp)
+    else:
+        print(resp.rsplit("END", 1)[0].strip())
+
+
+def runBatch(sock, commands, binary=False, window=BATCH_WINDOW):
+    replies = Replies(sock, binary)
+    waiting = deque()  # (command, kept reply) sent and not yet answered, oldest first
+    revalidated = RESULTS.revalidated
+    start_time = time.perf_counter()
+    for cmd in commands:
+        sent, kept = RESULTS.prepare(cmd)
+        sendCommand(sock, sent, binary)
+        waiting.append((cmd, kept))
+        if len(waiting) < window:
+            continue
+        cmd, kept = waiting.popleft()
+        printReply(cmd, RESULTS.resolve(cmd, replies.next(), kept))
+    while waiting:
+        cmd, kept = waiting.popleft()
+        printReply(cmd, RESULTS.resolve(cmd, replies.next(), kept))
+    end_time = time.perf_counter()
+    print(f"\n{len(commands)} commands in {(end_time - start_time) * 1000:.2f} ms "
+          f"({RESULTS.revalidated - revalidated} not modified).")
+
+
+def batchClient(host, port, path, binary=False, compress=False, repeat=1, interval=0.0):
+    try:
+        commands = readBatch(path)
+    except OSError as e:
+        print(f"ERROR: Could not read {path} ({e}).")
+        return
+    try:
+        with socket.create_connection((host, port), socketTimeout()) as s:
+            if binary:
+                binary = negotiateBinary(s, compress)
+            for run_number in range(repeat):
+                if run_number:
+                    time.sleep(interval)
+                runBatch(s, commands, binary)
+            request(s, "QUIT", binary)
+    except ConnectionRefusedError:
+        print("ERROR: Could not connect to Application Server.")
+    except socket.timeout:
+        print("ERROR: Connection timed out.")
+    except OSError as e:
+        print(f"Socket error: {e}")
+
+
+#=============================================================================
+# --metrics: print the servers' stage latencies and counters (METRICS) and exit
+#=============================================================================
+def showMetrics(host, port):
+    try:
+        with socket.create_connection((host, port), socketTimeout()) as s:
+            reply = request(s, "METRICS")
+            request(s, "QUIT")
+    except OSError as e:
+        print(f"ERROR: Could not get metrics from the Application Server ({e}).")
+        return
+    print(reply.rsplit("END", 1)[0].rstrip())
+
+
 #=============================================================================
 # Main with argparse
 #=============================================================================
 def main():
+    global REQUEST_DEADLINE
     parser = argparse.ArgumentParser(description="Home Listings Client")
     parser.add_argument("--host", default=DEFAULT_HOST,
                         help=f"Application server host (default: {DEFAULT_HOST})")
     parser.add_argument("--port", type=int, default=DEFAULT_PORT,
                         help=f"Application server port (default: {DEFAULT_PORT})")
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE,
+                        help=f"Rows fetched per page for LIST/SEARCH/QUERY, 0 for no paging (default: {DEFAULT_PAGE_SIZE})")
+    parser.add_argument("--binary", action="store_true",
+                        help="Negotiate the binary wire protocol with the application server")
+    parser.add_argument("--compress", action="store_true",
+                        help="Negotiate binary frames with large replies zlib-compressed (implies --binary)")
+    parser.add_argument("--deadline", type=float, default=REQUEST_DEADLINE,
+                        help=f"Seconds the servers get to answer each request, 0 for no deadline (default: {REQUEST_DEADLINE:g})")
+    parser.add_argument("--cache-entries", type=int, default=CACHE_ENTRIES,
+                        help=f"Results kept locally and revalidated with IF-NONE-MATCH, 0 for none (default: {CACHE_ENTRIES})")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Send the commands in FILE (- for stdin), one per line, pipelined, print the replies and exit")
+    parser.add_argument("--repeat", type=int, default=1, help="With --batch, how many times to run the file (default: 1)")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="With --batch, seconds to wait between runs (default: 0)")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Print the servers' per-stage latencies and counters and exit")
 
     args = parser.parse_args()
+    if args.deadline < 0 or args.cache_entries < 0 or args.repeat < 1 or args.interval < 0:
+        parser.error("need --deadline, --cache-entries, --interval >= 0 and --repeat >= 1")
+    REQUEST_DEADLINE = args.deadline
+    RESULTS.entries = args.cache_entries
 
-    ClientMenu(args.host, args.port)
+    if args.metrics:
+        showMetrics(args.host, args.port)
+        return
+    if args.batch:
+        batchClient(args.host, args.port, args.batch, args.binary or args.compress, args.compress,
+                    args.repeat, args.interval)
+        return
+    ClientMenu(args.host, args.port, args.page_size, args.binary or args.compress, args.compress)
 
 
 if __name__ == "__main__":
@@ -2,6 +2,33 @@ from socket import *
 import json
 import argparse
 import socket
+import asyncio
+import contextlib
+import gc
+import heapq
+import math
+import mmap
+import os
+import re
+import signal
+import struct
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, islice
+
+try:  # log lock shared by forked workers; POSIX only, like --workers
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from admission import RateLimiter, WorkLimit
+from listing_query import ListingQuery, orderKey, parseListingQuery
+from metrics import Metrics
+from shard_map import ShardMap
+from wire_protocol import (BUSY, DEADLINE_EXCEEDED, HELLO, HELLO_COMPRESS, HELLO_COMPRESS_OK, HELLO_OK, MULTI, RECORD,
+                           STATS_QUANTILES, compressFrames, multiQueries, packRecord, readFrame, recordFields,
+                           resultFrame, splitDeadline, statsLines, textFrame)
 
 #Data layer contains the data that a client wants to manipulate through the application components
 # =============================================================================
@@ -12,6 +39,24 @@ import socket
 # DATA LAYER:
 HOST = "127.0.0.1"
 PORT = 5001
+BACKLOG = 128
+WATCH_INTERVAL = 2.0
+
+# per-stage latencies and counters of this process, reported by RAW_METRICS
+METRICS = Metrics()
+METERED_COMMANDS = ("RAW_LIST", "RAW_SEARCH", "RAW_QUERY", "RAW_TEXT", "RAW_STATS", MULTI, "RAW_PUT", "RAW_DELETE")
+
+# admission control, per process (each --workers worker has its own): requests
+# read but not answered yet, across connections, before new ones get ERROR: BUSY;
+# requests a second per client host (0 = unlimited); requests read ahead of the
+# one being answered on a connection. Health checks and RAW_METRICS are exempt.
+MAX_QUEUE = 1024
+RATE_LIMIT = 0
+RATE_BURST = 0
+READ_AHEAD = 64
+CONTROL_COMMANDS = ("RAW_PING", "RAW_METRICS")
+WORK = WorkLimit(MAX_QUEUE)
+RATE_LIMITER = RateLimiter(RATE_LIMIT, RATE_BURST)
 
 
 
@@ -25,35 +70,201 @@ def ensureEnd(msg: str) -> str:
 # 1. create server socket and use TCP
 # 2. set socket option to allow re use of the same address
 # 3. attach socket to port and IP address
-# 4. allow five incoming connections to wait; one client at a time
-# 5. accept new connection from app server to talk to data server through connection socket
+# 4. listen with a --backlog sized queue of pending connections
+# 5. serve every connection from the application layer concurrently on an event loop;
+#    with --workers N, fork N processes that share the listening socket and the
+#    loaded index (copy-on-write) so throughput scales with cores; each worker
+#    watches the db file and reloads its own index
+# 6. admit or shed (ERROR: BUSY) each request as it is read, and answer those whose
+#    DEADLINE has passed by the time their turn comes without running them
 # ==============================================================================
+async def readRequests(reader: asyncio.StreamReader, requests: asyncio.Queue, room: asyncio.Semaphore, peer: str):
+    # reads a connection's requests as they arrive, so time spent queued here counts
+    # against their deadlines, and admits or sheds each one on arrival. At most
+    # READ_AHEAD requests wait unanswered; past that the socket isn't read, so TCP
+    # pushes back on the sender. None marks the end of the connection.
+    binary = False
+    try:
+        while True:
+            await room.acquire()
+            try:
+                if binary:
+                    _, data = await readFrame(reader)
+                else:
+                    data = await reader.readline()
+                    if not data.endswith(b"\n"):
+                        break
+            except ValueError:  # line longer than the stream limit, or oversized frame
+                break
+            arrived = time.perf_counter()
+            try:
+                budget, request = splitDeadline(data.decode("utf-8", errors="replace"))
+            except ValueError as e:
+                METRICS.count("errors")
+                requests.put_nowait(("", arrived, None, False, f"ERROR: {e}"))
+                continue
+            if not request and budget is None:  # a blank line
+                room.release()
+                continue
+            if not request:  # a DEADLINE prefix with nothing after it still gets its reply
+                METRICS.count("errors")
+                requests.put_nowait(("", arrived, None, False, "ERROR: malformed command"))
+                continue
+            deadline = None if budget is None else arrived + budget
+            admitted, refusal = False, None
+            if not binary and request.upper() in (HELLO, HELLO_COMPRESS):
+                binary = True
+            elif request.split(None, 1)[0].upper() in CONTROL_COMMANDS:
+                pass
+            elif not RATE_LIMITER.allow(peer):
+                METRICS.count("rate_limited")
+                refusal = f"{BUSY} rate limit exceeded"
+            elif not WORK.acquire():
+                METRICS.count("shed")
+                refusal = f"{BUSY} work queue is full"
+            else:
+                admitted = True
+            requests.put_nowait((request, arrived, deadline, admitted, refusal))
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        requests.put_nowait(None)
 
-def runServer(host, port, listings):
+
+async def handleConnection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, dataset):
+    peer = writer.get_extra_info("peername")
+    print(f"Connection from {peer}")
+    METRICS.count("connections")
+    binary = False  # switched on by the HELLO BINARY handshake
+    compress = False  # and compression by HELLO BINARY COMPRESS
+    requests: asyncio.Queue = asyncio.Queue()
+    room = asyncio.Semaphore(READ_AHEAD)
+    reading = asyncio.create_task(readRequests(reader, requests, room, peer[0] if peer else ""))
+    try:
+        while True:
+            item = await requests.get()
+            if item is None:
+                break
+            request, arrived, deadline, admitted, refusal = item
+            try:
+                if not binary and request.upper() in (HELLO, HELLO_COMPRESS):
+                    compress = request.upper() == HELLO_COMPRESS
+                    writer.writelines(textReply(HELLO_COMPRESS_OK if compress else HELLO_OK))
+                    await writer.drain()
+                    binary = True
+                    continue
+                started = time.perf_counter()
+                if refusal is not None or (deadline is not None and started >= deadline):
+                    # answered without running it: once per query of a RAW_MULTI
+                    if refusal is None:
+                        METRICS.count("expired")
+                        refusal = DEADLINE_EXCEEDED
+                    writer.writelines(textReply(refusal, binary) * (len(multiQueries(request)) or 1))
+                    await writer.drain()
+                    continue
+                METRICS.observe("queue", started - arrived)
+                try:
+                    reply = await handleCommand(request, dataset, binary)
+                    if compress:
+                        compressing = time.perf_counter()
+                        reply = compressFrames(reply)
+                        METRICS.since("compress", compressing)
+                except Exception as e:
+                    # answered with an error (once per query of a RAW_MULTI) rather than
+                    # dropping the connection and the requests pipelined behind it
+                    print(f"Request {request[:100]!r} failed: {e!r}")
+                    reply = formatError(f"internal error ({e})", binary) * (len(multiQueries(request)) or 1)
+                handled = time.perf_counter()
+                # replies are lists of pre-encoded buffers, written without joining them
+                writer.writelines(reply)
+                await writer.drain()
+            finally:
+                room.release()
+                if admitted:
+                    WORK.release()
+            command = request.split(None, 1)[0].upper()
+            if command in METERED_COMMANDS:
+                METRICS.observe("command", handled - started)
+                METRICS.observe(command.lower(), handled - started)
+                METRICS.since("send", handled)
+                METRICS.count("requests")
+                METRICS.count("bytes_out", sum(map(len, reply)))
+    except ConnectionError:
+        pass
+    finally:
+        reading.cancel()
+        writer.close()
+        # work admitted but never answered no longer counts against the limit
+        while not requests.empty():
+            item = requests.get_nowait()
+            if item is not None and item[3]:
+                WORK.release()
+
+
+async def serveForever(server: socket.socket, dataset):
+    loop_server = await asyncio.start_server(
+        lambda r, w: handleConnection(r, w, dataset), sock=server
+    )
+    watcher = asyncio.create_task(dataset.watch()) if dataset.watch_interval > 0 else None
+    try:
+        async with loop_server:
+            await loop_server.serve_forever()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+            try:
+                await watcher
+            except asyncio.CancelledError:
+                pass
+
+
+def runWorker(server: socket.socket, dataset):
+    try:
+        asyncio.run(serveForever(server, dataset))
+    except KeyboardInterrupt:
+        pass
+
+
+def stopServer(signum, frame):
+    raise SystemExit(0)
+
+
+def runServer(host, port, dataset, workers: int = 1, backlog: int = BACKLOG):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((host, port))
-    server.listen(5)
+    server.listen(backlog)
+    server.setblocking(False)
     print(f"Data Server listening on {host}:{port}")
-    while True:
-        conn, addr = server.accept()
-        print(f"Connection from {addr}")
-        with conn:
-            buffer = ""
-            while True:
-                data = conn.recv(4096)
-                if not data:
-                    break
-                buffer += data.decode("utf-8", errors="replace")
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    request = line.strip()
-                    if not request:
-                        continue
-                    response = processCommand(request, listings)
-                    conn.sendall(
-                        ensureEnd(response).encode("utf-8")
-                    )
+    if workers <= 1:
+        runWorker(server, dataset)
+        return
+
+    # keep the loaded index out of the collector so forked workers don't touch
+    # (and copy) its pages
+    gc.freeze()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            runWorker(server, dataset)
+            os._exit(0)
+        children.append(pid)
+    print(f"Started {workers} workers: {children}")
+
+    signal.signal(signal.SIGTERM, stopServer)
+    try:
+        for _ in children:
+            os.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 
 # =============================================================================
@@ -72,83 +283,1588 @@ def loadJSON(db_file: str) -> list[dict]:
 
 
 
-# =======================================================================================
-# querying data: simple filtering based on city and price; no formatting
-# =======================================================================================
-def searchRawData(listings, city, max_price):
-    results = []
+# =============================================================================
+# Sharding (--shards): each data server holds only the cities the shard map gives
+# it. Listings without a string city go by str(city), so every listing has exactly
+# one owner and LIST across all shards returns each listing once.
+# =============================================================================
+def shardFilter(shard_map: ShardMap, host: str, port: int):
+    shard = shard_map.find(host, port)
+    if shard is None:
+        raise ValueError(f"{host}:{port} is not in the shard map")
+    return lambda item: shard_map.owner(str(item.get("city"))) == shard
+
+
+def shardSlice(listings: list[dict], owns) -> list[dict]:
+    return listings if owns is None else [item for item in listings if owns(item)]
+
+
+# =============================================================================
+# Index built once at startup:
+# - every listing sorted by price ascending, bedrooms descending (RAW_LIST)
+# - case-folded city -> that city's listings in the same order, with the prices
+#   in their own column so RAW_SEARCH can bisect to the max_price cutoff
+# - bedroom count -> those listings, the same way (for RAW_QUERY)
+# =============================================================================
+UNPRICED = 1e18  # sort key price of rows without a numeric price, so they come last
+
+
+def sortKey(item: dict):
+    try:
+        price = float(item.get("price", UNPRICED))
+    except (TypeError, ValueError):
+        price = UNPRICED
+    try:
+        bedrooms = int(item.get("bedrooms", 0))
+    except (TypeError, ValueError):
+        bedrooms = 0
+    return (price, -bedrooms)
+
+
+# =============================================================================
+# Paging: "... LIMIT <n> CURSOR <c>". The cursor is the offset of the next row in
+# the result's sort order; it is returned as "NEXT <c>" while rows remain.
+# =============================================================================
+def parsePaging(options: list[str]) -> tuple[int, int | None]:
+    if len(options) % 2:
+        raise ValueError("paging options are LIMIT <n> and CURSOR <cursor>")
+    offset, limit = 0, None
+    seen = set()
+    for name, value in zip(options[::2], options[1::2]):
+        name = name.upper()
+        if name in seen:
+            raise ValueError(f"duplicate {name}")
+        seen.add(name)
+        if name == "LIMIT" and value.isdigit() and int(value) > 0:
+            limit = int(value)
+        elif name == "CURSOR" and value.isdigit():
+            offset = int(value)
+        else:
+            raise ValueError(f"Invalid {name} value")
+    return offset, limit
+
+
+def pageSlice(stop: int, offset: int, limit) -> tuple[int, int, int | None]:
+    # rows [start, end) of a result with `stop` rows, and the next cursor if any
+    start = min(offset, stop)
+    end = stop if limit is None else min(stop, start + limit)
+    return start, end, (end if end < stop else None)
+
+
+# =============================================================================
+# Columnar listing store: every listing, sorted by sortKey, laid out as one flat
+# buffer of fixed-width columns. The same buffer is written to a snapshot file by
+# --build-snapshot and memory-mapped back by --snapshot, so a restart does no
+# parsing and forked workers share the mapped pages through the page cache.
+#
+#   header       magic | byte order mark | data version | row count
+#   sections     (offset, length) for each of SNAPSHOT_SECTIONS, then their bytes,
+#                each padded to 8 bytes
+#   ids, prices, bedrooms   i64 / f64 / i64 per row (the binary protocol's numbers)
+#   city codes              u32 per row into the interned city name table
+#   addresses, lines        offset-indexed utf-8; lines are each row's text reply line
+#   groups                  case-folded city -> row positions and prices, in sort
+#                           order, for RAW_SEARCH to bisect, and running sums of
+#                           those prices for RAW_STATS
+#   bedroom groups          bedroom count -> row positions and prices, likewise
+#   mix groups              (city, bedroom count) -> row positions and prices, for
+#                           RAW_STATS's bedroom counts
+#   price sums              running sums of every priced row's price
+#   terms, postings         sorted address terms -> posting list blocks (see the
+#                           address text index below)
+# =============================================================================
+SNAPSHOT_MAGIC = b"LSTSNAP4"
+OLD_SNAPSHOT_MAGICS = (b"LSTSNAP1", b"LSTSNAP2", b"LSTSNAP3")
+BYTE_ORDER_MARK = 0x01020304
+SNAPSHOT_HEADER = struct.Struct("=8sIqQ")
+SECTION_ENTRY = struct.Struct("=QQ")
+SNAPSHOT_SECTIONS = (
+    ("ids", "q"), ("prices", "d"), ("bedrooms", "q"), ("city_codes", "I"),
+    ("city_offsets", "Q"), ("city_bytes", "B"),
+    ("address_offsets", "Q"), ("address_bytes", "B"),
+    ("line_offsets", "Q"), ("line_bytes", "B"),
+    ("group_key_offsets", "Q"), ("group_key_bytes", "B"),
+    ("group_offsets", "Q"), ("group_rows", "I"), ("group_prices", "d"),
+    ("bedroom_keys", "q"), ("bedroom_offsets", "Q"), ("bedroom_rows", "I"), ("bedroom_prices", "d"),
+    ("term_offsets", "Q"), ("term_bytes", "B"), ("term_counts", "Q"), ("term_blocks", "Q"),
+    ("block_firsts", "I"), ("block_widths", "B"), ("block_offsets", "Q"), ("posting_bytes", "B"),
+    ("group_sums", "d"), ("price_sums", "d"),
+    ("mix_cities", "I"), ("mix_bedrooms", "q"), ("mix_offsets", "Q"), ("mix_rows", "I"), ("mix_prices", "d"),
+)
+
+
+def encodeListing(item: dict) -> bytes:
+    return (
+        f"id={item.get('id')};"
+        f"city={item.get('city')};"
+        f"address={item.get('address')};"
+        f"price={item.get('price')};"
+        f"bedrooms={item.get('bedrooms')}\n"
+    ).encode("utf-8")
+
+
+def packStrings(strings) -> tuple[array, bytes]:
+    # offset-indexed string table: string i is data[offsets[i]:offsets[i + 1]]
+    offsets, data = array("Q", [0]), bytearray()
+    for text in strings:
+        data += text if isinstance(text, bytes) else text.encode("utf-8")
+        offsets.append(len(data))
+    return offsets, bytes(data)
+
+
+def packGroups(groups: dict, prices) -> tuple[array, array, array]:
+    # offsets, row positions and their prices for groups of positions, in sort order
+    group_rows = array("I", (position for positions in groups.values() for position in positions))
+    group_offsets = array("Q", [0])
+    for positions in groups.values():
+        group_offsets.append(group_offsets[-1] + len(positions))
+    return group_offsets, group_rows, array("d", (prices[position] for position in group_rows))
+
+
+def prefixSums(prices) -> array:
+    # sums[i] is the total of prices[:i]
+    return array("d", accumulate(prices, initial=0.0))
+
+
+def packPostings(postings: dict, sections: dict):
+    # term -> ascending positions, as the term and posting sections
+    terms = sorted(postings)
+    counts, term_blocks = array("Q"), array("Q", [0])
+    firsts, widths, offsets, data = array("I"), bytearray(), array("Q", [0]), bytearray()
+    for term in terms:
+        positions = postings[term]
+        counts.append(len(positions))
+        for start in range(0, len(positions), POSTING_BLOCK):
+            chunk = positions[start:start + POSTING_BLOCK]
+            width, gaps = packBlock(chunk)
+            firsts.append(chunk[0])
+            widths.append(width)
+            data += gaps
+            offsets.append(len(data))
+        term_blocks.append(len(firsts))
+    sections["term_offsets"], sections["term_bytes"] = packStrings(terms)
+    sections["term_counts"], sections["term_blocks"] = counts, term_blocks
+    sections["block_firsts"], sections["block_widths"] = firsts, bytes(widths)
+    sections["block_offsets"], sections["posting_bytes"] = offsets, bytes(data)
+
+
+def buildSnapshot(listings: list[dict], version: int = 0) -> bytes:
+    rows = sorted(listings, key=sortKey)
+    ids, prices, bedrooms, city_codes = array("q"), array("d"), array("q"), array("I")
+    names: dict[str, int] = {}
+    groups: dict[str, list[int]] = {}
+    bedroom_groups: dict[int, list[int]] = {}
+    mix_groups: dict[tuple[str, int], list[int]] = {}
+    postings: dict[str, list[int]] = {}
+    for position, item in enumerate(rows):
+        listing_id, price, beds = recordFields(item.get("id"), item.get("price"), item.get("bedrooms"))
+        ids.append(listing_id)
+        prices.append(price)
+        bedrooms.append(beds)
+        city = item.get("city")
+        city_codes.append(names.setdefault(str(city), len(names)))
+        # rows without a string city or a numeric price can never match a search
+        if isinstance(city, str) and not math.isnan(price):
+            groups.setdefault(city.casefold(), []).append(position)
+        if beds != -1 and not math.isnan(price):
+            bedroom_groups.setdefault(beds, []).append(position)
+            if isinstance(city, str):
+                mix_groups.setdefault((city.casefold(), beds), []).append(position)
+        if not math.isnan(price):
+            for term in set(addressTerms(str(item.get("address")))):
+                postings.setdefault(term, []).append(position)
+
+    sections = {"ids": ids, "prices": prices, "bedrooms": bedrooms, "city_codes": city_codes}
+    sections["group_offsets"], sections["group_rows"], sections["group_prices"] = packGroups(groups, prices)
+    sections["group_sums"] = array("d")
+    for i in range(len(groups)):
+        start, end = sections["group_offsets"][i], sections["group_offsets"][i + 1]
+        sections["group_sums"] += prefixSums(sections["group_prices"][start:end])
+    sections["price_sums"] = prefixSums(price for price in prices if not math.isnan(price))
+    city_numbers = {city: i for i, city in enumerate(groups)}
+    sections["mix_cities"] = array("I", (city_numbers[city] for city, _ in mix_groups))
+    sections["mix_bedrooms"] = array("q", (beds for _, beds in mix_groups))
+    sections["mix_offsets"], sections["mix_rows"], sections["mix_prices"] = packGroups(mix_groups, prices)
+    sections["bedroom_keys"] = array("q", bedroom_groups)
+    (sections["bedroom_offsets"], sections["bedroom_rows"],
+     sections["bedroom_prices"]) = packGroups(bedroom_groups, prices)
+    sections["city_offsets"], sections["city_bytes"] = packStrings(names)
+    sections["address_offsets"], sections["address_bytes"] = packStrings(str(item.get("address")) for item in rows)
+    sections["line_offsets"], sections["line_bytes"] = packStrings(encodeListing(item) for item in rows)
+    sections["group_key_offsets"], sections["group_key_bytes"] = packStrings(groups)
+    packPostings(postings, sections)
+
+    table_size = SNAPSHOT_HEADER.size + SECTION_ENTRY.size * len(SNAPSHOT_SECTIONS)
+    out = bytearray(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, BYTE_ORDER_MARK, version, len(rows)))
+    out += bytes(table_size - len(out))
+    for i, (name, _) in enumerate(SNAPSHOT_SECTIONS):
+        data = sections[name]
+        data = data.tobytes() if isinstance(data, array) else data
+        out += bytes(-len(out) % 8)  # keep every column 8-byte aligned
+        SECTION_ENTRY.pack_into(out, SNAPSHOT_HEADER.size + i * SECTION_ENTRY.size, len(out), len(data))
+        out += data
+    return bytes(out)
+
+
+def writeSnapshot(path: str, snapshot: bytes):
+    # write beside the target and rename, so a running server never maps a partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(snapshot)
+    os.replace(tmp, path)
+
+
+def unpackStrings(offsets, data) -> list[str]:
+    return [str(data[offsets[i]:offsets[i + 1]], "utf-8") for i in range(len(offsets) - 1)]
+
+
+class ListingStore:
+    # typed, zero-copy views over a snapshot buffer (bytes or a read-only mmap)
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        magic, mark, self.version, count = SNAPSHOT_HEADER.unpack_from(view, 0)
+        if magic in OLD_SNAPSHOT_MAGICS:
+            raise ValueError("snapshot is in an older format; rebuild it with --build-snapshot")
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a listings snapshot")
+        if mark != BYTE_ORDER_MARK:
+            raise ValueError("snapshot was built on a machine with a different byte order")
+        for i, (name, typecode) in enumerate(SNAPSHOT_SECTIONS):
+            offset, length = SECTION_ENTRY.unpack_from(view, SNAPSHOT_HEADER.size + i * SECTION_ENTRY.size)
+            section = view[offset:offset + length]
+            setattr(self, name, section if typecode == "B" else section.cast(typecode))
+        if len(self.ids) != count:
+            raise ValueError("snapshot is truncated")
+        self.buffer = buffer
+        self.city_names = unpackStrings(self.city_offsets, self.city_bytes)  # interned, one str per city
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def line(self, position: int) -> memoryview:
+        return self.line_bytes[self.line_offsets[position]:self.line_offsets[position + 1]]
+
+    def record(self, position: int) -> bytes:
+        return RECORD.pack(self.ids[position], self.prices[position], self.bedrooms[position])
+
+    def strings(self, position: int) -> tuple[str, str]:
+        address = self.address_bytes[self.address_offsets[position]:self.address_offsets[position + 1]]
+        return self.city_names[self.city_codes[position]], str(address, "utf-8")
+
+    def groups(self):
+        # (case-folded city, its row positions, their prices, their prices' running sums)
+        for i, key in enumerate(unpackStrings(self.group_key_offsets, self.group_key_bytes)):
+            start, end = self.group_offsets[i], self.group_offsets[i + 1]
+            yield key, self.group_rows[start:end], self.group_prices[start:end], self.group_sums[start + i:end + i + 1]
+
+    def bedroomGroups(self):
+        # (bedroom count, its row positions, their prices)
+        for i, key in enumerate(self.bedroom_keys):
+            start, end = self.bedroom_offsets[i], self.bedroom_offsets[i + 1]
+            yield key, self.bedroom_rows[start:end], self.bedroom_prices[start:end]
+
+    def mixGroups(self):
+        # ((case-folded city, bedroom count), its row positions, their prices)
+        cities = unpackStrings(self.group_key_offsets, self.group_key_bytes)
+        for i, (city, beds) in enumerate(zip(self.mix_cities, self.mix_bedrooms)):
+            start, end = self.mix_offsets[i], self.mix_offsets[i + 1]
+            yield (cities[city], beds), self.mix_rows[start:end], self.mix_prices[start:end]
+
+    def priced(self) -> int:
+        # rows without a numeric price sort last; the rows before them
+        count = len(self)
+        while count and math.isnan(self.prices[count - 1]):
+            count -= 1
+        return count
+
+
+class Rows:
+    # every row the index has loaded: the snapshot's rows at positions [0, base), then
+    # rows added by reloads. Append-only, so an older index never sees a position change.
+    def __init__(self, store: ListingStore):
+        self.store = store
+        self.base = len(store)
+        self.added_lines: list[bytes] = []
+        self.added_records: list[bytes] = []
+        self.added_strings: list[tuple[str, str]] = []
+        self.added_keys: list[tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return self.base + len(self.added_lines)
+
+    def line(self, position: int):
+        if position < self.base:
+            return self.store.line(position)
+        return self.added_lines[position - self.base]
+
+    def record(self, position: int) -> bytes:
+        if position < self.base:
+            return self.store.record(position)
+        return self.added_records[position - self.base]
+
+    def strings(self, position: int) -> tuple[str, str]:
+        if position < self.base:
+            return self.store.strings(position)
+        return self.added_strings[position - self.base]
+
+    def numbers(self, position: int) -> tuple[int, float, int]:
+        # id, price, bedrooms as the binary protocol carries them (-1 / NaN when not numeric)
+        if position < self.base:
+            store = self.store
+            return store.ids[position], store.prices[position], store.bedrooms[position]
+        return RECORD.unpack(self.added_records[position - self.base])
+
+    def sortKey(self, position: int) -> tuple[float, int]:
+        if position >= self.base:
+            return self.added_keys[position - self.base]
+        price, bedrooms = self.store.prices[position], self.store.bedrooms[position]
+        return (UNPRICED if math.isnan(price) else price, 0 if bedrooms == -1 else -bedrooms)
+
+    def append(self, item: dict) -> int:
+        self.added_lines.append(encodeListing(item))
+        self.added_records.append(packRecord(item.get("id"), item.get("price"), item.get("bedrooms")))
+        self.added_strings.append((str(item.get("city")), str(item.get("address"))))
+        self.added_keys.append(sortKey(item))
+        return len(self) - 1
+
+
+class Columns:
+    # result rows in sort order, given as positions into Rows; result rows
+    # [start, end) come out in the wire form each protocol needs. `order` is None
+    # while the rows are exactly the snapshot's, in which case the text lines of
+    # consecutive rows are one contiguous slice of the line column.
+    __slots__ = ("rows", "order")
+
+    def __init__(self, rows: Rows, order=None):
+        self.rows = rows
+        self.order = order
+
+    def __len__(self) -> int:
+        return self.rows.base if self.order is None else len(self.order)
+
+    def positions(self, start: int, end: int):
+        return range(start, end) if self.order is None else self.order[start:end]
+
+    def lines(self, start: int, end: int) -> list:
+        if self.order is None:
+            store = self.rows.store
+            return [store.line_bytes[store.line_offsets[start]:store.line_offsets[end]]] if start < end else []
+        return [self.rows.line(position) for position in self.positions(start, end)]
+
+    def records(self, start: int, end: int) -> list[bytes]:
+        return [self.rows.record(position) for position in self.positions(start, end)]
+
+    def strings(self, start: int, end: int) -> list[tuple[str, str]]:
+        return [self.rows.strings(position) for position in self.positions(start, end)]
+
+
+class PriceIndex(Columns):
+    # rows in sort order and, in step with them, their sort key prices. Rows without
+    # a numeric price come last and may be left out of the prices.
+    __slots__ = ("prices", "sums")
+
+    def __init__(self, rows: Rows, order, prices, sums=None):
+        super().__init__(rows, order)
+        self.prices = prices
+        self.sums = sums  # running sums of the prices; from the snapshot, or built on first use
+
+    def total(self, start: int, end: int) -> float:
+        # the sum of the prices of rows [start, end)
+        if self.sums is None:
+            self.sums = prefixSums(self.prices)
+        return self.sums[end] - self.sums[start]
+
+    def upTo(self, max_price: float) -> int:
+        # number of rows priced at or below max_price
+        return bisect_right(self.prices, max_price)
+
+    def between(self, min_price: float, max_price: float) -> tuple[int, int]:
+        # rows [start, end) priced within [min_price, max_price], never the unpriced ones
+        end = bisect_right(self.prices, max_price) if max_price < UNPRICED else bisect_left(self.prices, UNPRICED)
+        return min(bisect_left(self.prices, min_price), end), end
+
+
+# =============================================================================
+# Address text index (RAW_TEXT, QUERY TEXT): every address is split into
+# case-folded words, and each word maps to the positions of the rows whose address
+# holds it - its posting list. Terms are kept sorted, so a prefix is a bisect and
+# a walk over the neighbouring terms. A posting list is stored in blocks of
+# POSTING_BLOCK positions: the block's first position, then the gaps to the
+# positions after it, packed 1, 2 or 4 bytes each - whatever its largest gap
+# needs. An intersection walks the rarest list and looks each candidate up in the
+# others by bisecting their block starts, so it only decodes the blocks that may
+# hold a candidate. Only priced rows are indexed, as for the groups.
+# =============================================================================
+POSTING_BLOCK = 128
+GAP_TYPECODES = {1: "B", 2: "H", 4: "I"}
+
+
+TERM_PATTERN = re.compile(r"[^\W_]+")
+
+
+def addressTerms(address: str) -> list[str]:
+    return TERM_PATTERN.findall(address.casefold())
+
+
+def textTerms(text: str) -> list[tuple[str, bool]]:
+    # (term, is a prefix) for each word of a TEXT query
+    terms = []
+    for word in text.split():
+        words = addressTerms(word)
+        terms += [(term, False) for term in words]
+        if words and word.endswith("*"):
+            terms[-1] = (words[-1], True)
+    return terms
+
+
+def packBlock(positions: list[int]) -> tuple[int, bytes]:
+    if len(positions) == 1:
+        return 1, b""
+    gaps = [b - a for a, b in zip(positions, positions[1:])]
+    largest = max(gaps, default=0)
+    width = 1 if largest < 1 << 8 else 2 if largest < 1 << 16 else 4
+    return width, array(GAP_TYPECODES[width], gaps).tobytes()
+
+
+class StoredBlocks:
+    # a posting list's blocks in the snapshot: (gap width, packed gaps) each
+    __slots__ = ("widths", "offsets", "data", "start", "end")
+
+    def __init__(self, widths, offsets, data, start: int, end: int):
+        self.widths, self.offsets, self.data = widths, offsets, data
+        self.start, self.end = start, end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __getitem__(self, i: int) -> tuple[int, memoryview]:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        i += self.start
+        return self.widths[i], self.data[self.offsets[i]:self.offsets[i + 1]]
+
+
+class Posting:
+    # one term's row positions, ascending, in blocks (see above)
+    __slots__ = ("firsts", "blocks", "count")
+
+    def __init__(self, firsts, blocks, count: int):
+        self.firsts = firsts  # first position of each block
+        self.blocks = blocks  # per block: (gap width, packed gaps)
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def block(self, i: int) -> list[int]:
+        width, data = self.blocks[i]
+        gaps = array(GAP_TYPECODES[width])
+        gaps.frombytes(data)
+        return list(accumulate(gaps, initial=self.firsts[i]))
+
+    def positions(self) -> list[int]:
+        return [position for i in range(len(self.firsts)) for position in self.block(i)]
+
+    def intersect(self, candidates: list[int]) -> list[int]:
+        # the ascending candidates that are in this list
+        found, current, block = [], -1, frozenset()
+        for position in candidates:
+            i = bisect_right(self.firsts, position) - 1
+            if i != current and i >= 0:
+                current, block = i, frozenset(self.block(i))
+            if position in block:
+                found.append(position)
+        return found
+
+    def copy(self) -> "Posting":
+        return Posting(editable(self.firsts, "I"), list(self.blocks), self.count)
+
+    # in-place edits, for a copy (see TextEdits)
+    def add(self, position: int):
+        i = max(bisect_right(self.firsts, position) - 1, 0)
+        block = self.block(i) if self.firsts else []
+        insort(block, position)
+        if not self.firsts:
+            self.firsts.append(position)
+            self.blocks.append(packBlock(block))
+        elif len(block) > POSTING_BLOCK:
+            self.firsts[i] = block[0]
+            self.blocks[i] = packBlock(block[:POSTING_BLOCK])
+            self.firsts.insert(i + 1, block[POSTING_BLOCK])
+            self.blocks.insert(i + 1, packBlock(block[POSTING_BLOCK:]))
+        else:
+            self.firsts[i] = block[0]
+            self.blocks[i] = packBlock(block)
+        self.count += 1
+
+    def remove(self, position: int):
+        i = bisect_right(self.firsts, position) - 1
+        block = self.block(i) if i >= 0 else []
+        j = bisect_left(block, position)
+        if j == len(block) or block[j] != position:
+            return
+        del block[j]
+        if block:
+            self.firsts[i] = block[0]
+            self.blocks[i] = packBlock(block)
+        else:
+            del self.firsts[i]
+            del self.blocks[i]
+        self.count -= 1
+
+
+class StoredTerms:
+    # the snapshot's sorted terms, as a sequence to bisect without unpacking them all
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets, data):
+        self.offsets, self.data = offsets, data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+
+class TextIndex:
+    # address term -> Posting: the snapshot's terms, looked up by bisecting them, and
+    # the posting lists reloads have changed since (empty for a term that is gone)
+    __slots__ = ("store", "terms", "changed", "added")
+
+    def __init__(self, store, changed: dict = None, added: list = None):
+        self.store = store
+        self.terms = StoredTerms(store.term_offsets, store.term_bytes)
+        self.changed = changed or {}  # term -> Posting
+        self.added = added or []  # sorted terms of `changed` that the snapshot doesn't have
+
+    def stored(self, term: str) -> Posting | None:
+        i = bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return None
+        return self.storedAt(i)
+
+    def storedAt(self, i: int) -> Posting:
+        store = self.store
+        start, end = store.term_blocks[i], store.term_blocks[i + 1]
+        blocks = StoredBlocks(store.block_widths, store.block_offsets, store.posting_bytes, start, end)
+        return Posting(store.block_firsts[start:end], blocks, store.term_counts[i])
+
+    def posting(self, term: str) -> Posting | None:
+        posting = self.changed[term] if term in self.changed else self.stored(term)
+        return posting if posting is not None and len(posting) else None
+
+    def matching(self, term: str, prefix: bool) -> list[Posting]:
+        if not prefix:
+            posting = self.posting(term)
+            return [posting] if posting is not None else []
+        found = []
+        i = bisect_left(self.terms, term)
+        while i < len(self.terms):
+            stored = self.terms[i]
+            if not stored.startswith(term):
+                break
+            posting = self.changed[stored] if stored in self.changed else self.storedAt(i)
+            if len(posting):
+                found.append(posting)
+            i += 1
+        i = bisect_left(self.added, term)
+        while i < len(self.added) and self.added[i].startswith(term):
+            if len(self.changed[self.added[i]]):
+                found.append(self.changed[self.added[i]])
+            i += 1
+        return found
+
+    def lookup(self, terms: list[tuple[str, bool]]) -> list[list[Posting]]:
+        # per query term, the posting lists it matches, rarest term first
+        return sorted((self.matching(term, prefix) for term, prefix in terms),
+                      key=lambda postings: sum(map(len, postings)))
+
+    @staticmethod
+    def search(groups: list[list[Posting]]) -> list[int]:
+        # ascending positions of the rows that are in some posting list of every group
+        if not groups or not groups[0]:
+            return []
+        first = groups[0]
+        found = first[0].positions() if len(first) == 1 else sorted({p for posting in first for p in posting.positions()})
+        for postings in groups[1:]:
+            if not found:
+                break
+            if len(postings) == 1:
+                found = postings[0].intersect(found)
+            else:
+                found = sorted({p for posting in postings for p in posting.intersect(found)})
+        return found
+
+
+class ListingIndex:
+    # never modified once built: a reload builds a new index that shares everything
+    # the change didn't touch, so a query holding the old one is never disturbed
+    __slots__ = ("rows", "all", "cities", "bedrooms", "mix", "text", "version", "keys")
+
+    def __init__(self, rows: Rows, all_rows: PriceIndex, cities: dict, bedrooms: dict, mix: dict, text: TextIndex,
+                 version: int, keys=None):
+        self.rows = rows
+        self.all = all_rows
+        self.cities = cities  # case-folded city -> PriceIndex
+        self.bedrooms = bedrooms  # bedroom count -> PriceIndex
+        self.mix = mix  # (case-folded city, bedroom count) -> PriceIndex
+        self.text = text
+        self.version = version  # data-version token sent with every reply
+        self.keys = keys  # listing key -> live positions, built on the first reload
+
+    def replace(self, version: int, keys=None) -> "ListingIndex":
+        # the same listings under another version
+        return ListingIndex(self.rows, self.all, self.cities, self.bedrooms, self.mix, self.text, version, keys)
+
+    @classmethod
+    def fromStore(cls, store: ListingStore) -> "ListingIndex":
+        rows = Rows(store)
+        cities = {city: PriceIndex(rows, order, prices, sums) for city, order, prices, sums in store.groups()}
+        bedrooms = {beds: PriceIndex(rows, order, prices) for beds, order, prices in store.bedroomGroups()}
+        mix = {key: PriceIndex(rows, order, prices) for key, order, prices in store.mixGroups()}
+        everything = PriceIndex(rows, None, store.prices[:store.priced()], store.price_sums)
+        return cls(rows, everything, cities, bedrooms, mix, TextIndex(store), store.version)
+
+
+def buildIndex(listings: list[dict], version: int = 0) -> ListingIndex:
+    return ListingIndex.fromStore(ListingStore(buildSnapshot(listings, version)))
+
+
+def loadSnapshot(path: str) -> ListingIndex:
+    # map the file read-only; the mapping stays open for as long as the index lives
+    with open(path, "rb") as f:
+        return ListingIndex.fromStore(ListingStore(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+
+
+# =============================================================================
+# data version: the db file's modification time (ns), so every worker that loads
+# the same file reports the same token and an edited file always reports a newer one
+# =============================================================================
+def dataVersion(db_file: str) -> int:
+    try:
+        return os.stat(db_file).st_mtime_ns
+    except OSError:
+        return 0
+
+
+# =============================================================================
+# Hot reload: diff the db file against the live index by listing id and build a
+# new index that re-sorts only what changed:
+# - an unchanged id keeps its row; a changed or removed id's rows leave the
+#   all-rows order, their city and their bedroom group, and new rows are inserted
+#   at their sort position
+# - groups with no changes keep their PriceIndex object as-is; the all-rows order
+#   and each changed group are copied before being edited (copy-on-write)
+# - the finished index replaces the live one in a single assignment, so a query
+#   always runs against one complete version
+# Rows replaced by a reload stay in Rows, unreferenced, until the next restart.
+# =============================================================================
+def readJSON(db_file: str) -> list[dict]:
+    # strict load for reloads: a missing or half-written file must not look like "no listings"
+    with open(db_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("listings file must hold a JSON array")
+    return data
+
+
+def listingKey(listing_id: int, line) -> object:
+    # the listing id, or the whole line for rows without an integer id
+    return listing_id if listing_id != -1 else bytes(line)
+
+
+def liveKeys(index: ListingIndex) -> dict:
+    if index.keys is None:
+        keys: dict = {}
+        for position in index.all.positions(0, len(index.all)):
+            listing_id = RECORD.unpack(index.rows.record(position))[0]
+            keys.setdefault(listingKey(listing_id, index.rows.line(position)), []).append(position)
+        index.keys = keys
+    return index.keys
+
+
+def editable(column, typecode: str) -> array:
+    # a private, growable copy of an order or price column
+    copy = array(typecode)
+    copy.frombytes(memoryview(column).cast("B"))
+    return copy
+
+
+def removeRow(order: array, prices, rows: Rows, position: int) -> bool:
+    key = rows.sortKey(position)
+    i = bisect_left(order, key, key=rows.sortKey)
+    while i < len(order) and order[i] != position and rows.sortKey(order[i]) == key:
+        i += 1
+    if i == len(order) or order[i] != position:
+        return False
+    del order[i]
+    if prices is not None:
+        del prices[i]
+    return True
+
+
+def insertRow(order: array, prices, rows: Rows, position: int):
+    i = bisect_right(order, rows.sortKey(position), key=rows.sortKey)
+    order.insert(i, position)
+    if prices is not None:
+        prices.insert(i, rows.sortKey(position)[0])
+
+
+def itemKey(item: dict) -> object:
+    listing_id = recordFields(item.get("id"), None, None)[0]
+    return listingKey(listing_id, b"" if listing_id != -1 else encodeListing(item))
+
+
+def diffListings(index: ListingIndex, listings: list[dict]):
+    # rows to drop and rows to add to turn `index` into `listings`, keyed by id
+    rows = index.rows
+    old_keys = liveKeys(index)
+    new_rows: dict = {}
     for item in listings:
-        try:
-            if item.get("city", "").lower() == city.lower() and float(item.get("price", 1e18)) <= float(max_price):
-                results.append(item)
-        except:
+        line = encodeListing(item)
+        key = listingKey(recordFields(item.get("id"), None, None)[0], line)
+        new_rows.setdefault(key, []).append((line, item))
+
+    counts = {"added": 0, "updated": 0, "removed": 0}
+    removed, added = [], []
+    keys = dict(old_keys)
+    for key, positions in old_keys.items():
+        if key not in new_rows:
+            counts["removed"] += 1
+            removed.extend(positions)
+            del keys[key]
+    for key, entries in new_rows.items():
+        positions = old_keys.get(key)
+        if positions is not None:
+            if [bytes(rows.line(p)) for p in positions] == [line for line, _ in entries]:
+                continue
+            counts["updated"] += 1
+            removed.extend(positions)
+        else:
+            counts["added"] += 1
+        keys[key] = [rows.append(item) for _, item in entries]
+        added.extend(zip(keys[key], (item for _, item in entries)))
+    return removed, added, keys, counts
+
+
+class GroupEdits:
+    # copy-on-write changes to a dict of PriceIndexes (cities or bedroom counts): a
+    # group is copied on its first change, and groups left empty are dropped
+    def __init__(self, rows: Rows, groups: dict):
+        self.rows = rows
+        self.groups = dict(groups)
+        self.copied: set = set()
+
+    def group(self, key) -> PriceIndex:
+        if key not in self.copied:
+            current = self.groups.get(key)
+            self.groups[key] = PriceIndex(
+                self.rows,
+                editable(current.order, "I") if current else array("I"),
+                editable(current.prices, "d") if current else array("d"),
+            )
+            self.copied.add(key)
+        return self.groups[key]
+
+    def remove(self, key, position: int):
+        if key in self.groups:
+            group = self.group(key)
+            removeRow(group.order, group.prices, self.rows, position)
+
+    def insert(self, key, position: int):
+        group = self.group(key)
+        insertRow(group.order, group.prices, self.rows, position)
+
+    def result(self) -> dict:
+        for key in self.copied:
+            if not len(self.groups[key]):
+                del self.groups[key]
+        return self.groups
+
+
+class TextEdits:
+    # copy-on-write changes to a TextIndex, in the same way: a posting list is
+    # copied on its first change, and left empty when its last row goes
+    def __init__(self, text: TextIndex):
+        self.text = text
+        self.changed = dict(text.changed)
+        self.added = text.added
+        self.copied: set = set()
+
+    def posting(self, term: str) -> Posting:
+        if term not in self.copied:
+            current = self.text.posting(term)
+            self.changed[term] = current.copy() if current else Posting(array("I"), [], 0)
+            self.copied.add(term)
+            if current is None and self.text.stored(term) is None and term not in self.text.changed:
+                if self.added is self.text.added:
+                    self.added = list(self.added)
+                insort(self.added, term)
+        return self.changed[term]
+
+    def remove(self, address: str, position: int):
+        for term in set(addressTerms(address)):
+            if self.text.posting(term) is not None or term in self.copied:
+                self.posting(term).remove(position)
+
+    def insert(self, address: str, position: int):
+        for term in set(addressTerms(address)):
+            self.posting(term).add(position)
+
+    def result(self) -> TextIndex:
+        return TextIndex(self.text.store, self.changed, self.added)
+
+
+def rebuildIndex(index: ListingIndex, removed: list[int], added: list, keys: dict, version: int) -> ListingIndex:
+    rows = index.rows
+    if not removed and not added:
+        return index.replace(version, keys)
+
+    if index.all.order is None:
+        order = array("I", range(rows.base))
+        prices = array("d", (rows.sortKey(position)[0] for position in range(rows.base)))
+    else:
+        order, prices = editable(index.all.order, "I"), editable(index.all.prices, "d")
+    cities = GroupEdits(rows, index.cities)
+    bedrooms = GroupEdits(rows, index.bedrooms)
+    mix = GroupEdits(rows, index.mix)
+    text = TextEdits(index.text)
+
+    for position in removed:
+        removeRow(order, prices, rows, position)
+        city, address = rows.strings(position)
+        beds = rows.numbers(position)[2]
+        cities.remove(city.casefold(), position)
+        bedrooms.remove(beds, position)
+        mix.remove((city.casefold(), beds), position)
+        text.remove(address, position)
+    for position, item in added:
+        insertRow(order, prices, rows, position)
+        _, price, beds = recordFields(None, item.get("price"), item.get("bedrooms"))
+        city = item.get("city")
+        # same rules as buildSnapshot: only rows with a numeric price are grouped
+        if math.isnan(price):
             continue
-    return results
+        if isinstance(city, str):
+            cities.insert(city.casefold(), position)
+        if beds != -1:
+            bedrooms.insert(beds, position)
+            if isinstance(city, str):
+                mix.insert((city.casefold(), beds), position)
+        text.insert(str(item.get("address")), position)
+
+    return ListingIndex(rows, PriceIndex(rows, order, prices), cities.result(), bedrooms.result(), mix.result(),
+                        text.result(), version, keys)
+
+
+def applyListings(index: ListingIndex, listings: list[dict], version: int) -> tuple[ListingIndex, dict]:
+    removed, added, keys, counts = diffListings(index, listings)
+    if not removed and not added:
+        return index, counts
+    return rebuildIndex(index, removed, added, keys, version), counts
+
+
+def applyRecords(index: ListingIndex, records: list[dict], version: int) -> ListingIndex:
+    # write-ahead log records, in log order; only the last record for an id matters
+    rows = index.rows
+    keys = dict(liveKeys(index))
+    final: dict = {}
+    for record in records:
+        final[record["id"]] = record.get("listing")
+    removed, added = [], []
+    for key, item in final.items():
+        removed.extend(keys.pop(key, ()))
+        if item is not None:
+            position = rows.append(item)
+            keys[key] = [position]
+            added.append((position, item))
+    return rebuildIndex(index, removed, added, keys, version)
+
+
+# =============================================================================
+# Write path: RAW_PUT <listing JSON> adds or replaces the listing with that id,
+# RAW_DELETE <id> removes it. A write is acknowledged once it is in the write-ahead
+# log (--wal) and applied to the index:
+# - the log holds one JSON record per line and is only ever appended to
+# - appends that arrive while a write + fsync is in flight are queued and go out
+#   together in the next one (group commit), so one fsync covers many writes
+# - a RAW_DELETE is instead written on its own, under the log lock, once the
+#   index has caught up with the log and still has the id
+# - the index follows the log: after each commit the new lines are read back and
+#   applied incrementally, and each worker also tails the log (every
+#   --watch-interval) to pick up writes accepted by the other workers
+# - the data version is the db file's version plus the log's length in bytes, so
+#   every worker that has applied the same records reports the same version
+# - once the log passes --compact-bytes (or on ADMIN COMPACT) it is folded into a
+#   new db file (and --snapshot file, if any) and replaced by an empty log
+# Log appends and compaction take an exclusive lock on <wal>.lock so workers
+# never interleave a batch with a compaction.
+# =============================================================================
+COMPACT_BYTES = 4 * 1024 * 1024
+
+
+def parseWrite(command: str, argument: str) -> dict:
+    # the log record for a RAW_PUT / RAW_DELETE argument; raises ValueError if invalid
+    if command == "RAW_PUT":
+        try:
+            listing = json.loads(argument)
+        except json.JSONDecodeError:
+            raise ValueError("PUT requires a listing as a JSON object")
+        if not isinstance(listing, dict):
+            raise ValueError("PUT requires a listing as a JSON object")
+        listing_id = listing.get("id")
+    else:
+        listing, listing_id = None, int(argument) if argument.strip().isdigit() else None
+    if not isinstance(listing_id, int) or isinstance(listing_id, bool) or listing_id < 0:
+        raise ValueError("listing id must be a non-negative integer")
+    return {"id": listing_id, "listing": listing}
+
+
+def replayLog(listings: list[dict], records: list[dict]) -> list[dict]:
+    by_key: dict = {}
+    for item in listings:
+        by_key.setdefault(itemKey(item), []).append(item)
+    for record in records:
+        if record.get("listing") is None:
+            by_key.pop(record["id"], None)
+        else:
+            by_key[record["id"]] = [record["listing"]]
+    return [item for items in by_key.values() for item in items]
+
+
+def readLog(path: str, offset: int = 0) -> tuple[list[dict], int, int | None]:
+    # complete records from `offset` on, the offset after them, and the log's inode
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return [], 0, None
+    with f:
+        inode = os.fstat(f.fileno()).st_ino
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1  # a torn final line is left for the next read
+    records = []
+    for line in data[:end].splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            print(f"Skipping unreadable record in {path}")
+    return records, offset + end, inode
+
+
+def writeJSON(path: str, listings: list[dict]):
+    # same layout as listings.json: one listing per line
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("[\n" + ",\n".join("  " + json.dumps(item) for item in listings) + "\n]\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def lockedFile(path: str):
+    # exclusive lock on <path>.lock, opened per use so each forked worker holds its own
+    with open(f"{path}.lock", "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class WriteAheadLog:
+    def __init__(self, path: str):
+        self.path = path
+        self.pending: list[tuple[bytes, asyncio.Future]] = []
+        self.committer = None
+
+    def writeLocked(self, data: bytes):
+        # the caller holds the log lock
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def writeBatch(self, data: bytes):
+        with lockedFile(self.path):
+            self.writeLocked(data)
+
+    async def append(self, record: dict):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((json.dumps(record) + "\n").encode("utf-8"), future))
+        if self.committer is None or self.committer.done():
+            self.committer = asyncio.create_task(self.commit())
+        await future
+
+    async def commit(self):
+        while self.pending:
+            batch, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self.writeBatch, b"".join(line for line, _ in batch))
+                error = None
+            except OSError as e:
+                error = e
+            for _, future in batch:
+                if future.done():  # the writer went away
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    def compact(self, db_file: str, snapshot_file: str | None, version: int, owns=None):
+        # fold the log into the db file (and snapshot), then start a new, empty log.
+        # Shards can share one db file: only this shard's listings are replayed, the
+        # rest are written back untouched, and the db lock keeps shards from racing.
+        with lockedFile(self.path), lockedFile(db_file):
+            try:
+                listings = readJSON(db_file)
+            except FileNotFoundError:
+                listings = []
+            others = [item for item in listings if owns is not None and not owns(item)]
+            mine = [item for item in listings if owns is None or owns(item)]
+            records, _, _ = readLog(self.path)
+            mine = replayLog(mine, records)
+            writeJSON(db_file, others + mine)
+            if snapshot_file:
+                writeSnapshot(snapshot_file, buildSnapshot(mine, max(dataVersion(db_file), version)))
+            with open(f"{self.path}.tmp", "wb"):
+                pass
+            os.replace(f"{self.path}.tmp", self.path)
+            return len(records)
+
+
+class Dataset:
+    # the live index plus what's needed to keep it in step with the db file and log
+    def __init__(self, index: ListingIndex, db_file: str, watch_interval: float = 0,
+                 wal: WriteAheadLog | None = None, snapshot_file: str | None = None,
+                 compact_bytes: int = COMPACT_BYTES, owns=None):
+        self.index = index
+        self.db_file = db_file
+        self.watch_interval = watch_interval  # seconds between file checks; 0 = ADMIN RELOAD only
+        self.seen_mtime = index.version  # db file mtime the index reflects
+        self.wal = wal
+        self.wal_offset = 0  # log bytes applied to the index
+        self.wal_inode = None
+        self.snapshot_file = snapshot_file
+        self.compact_bytes = compact_bytes
+        self.compactor = None
+        self.owns = owns  # listing -> bool for a shard's slice; None serves every listing
+        self.lock = asyncio.Lock()
+
+    def applyLog(self) -> bool:
+        # apply records appended since the last call; False if the log was replaced
+        records, end, inode = readLog(self.wal.path, self.wal_offset)
+        if self.wal_inode is not None and inode != self.wal_inode:
+            return False
+        self.wal_inode = inode
+        if end > self.wal_offset:
+            version = self.index.version + end - self.wal_offset
+            self.index = applyRecords(self.index, records, version)
+            self.wal_offset = end
+        return True
+
+    def reloadFiles(self) -> dict:
+        mtime = dataVersion(self.db_file)
+        listings = shardSlice(readJSON(self.db_file), self.owns)
+        records, end, inode = readLog(self.wal.path) if self.wal else ([], 0, None)
+        current = self.index
+        index, counts = applyListings(current, replayLog(listings, records), current.version)
+        if index is not current or mtime != self.seen_mtime or inode != self.wal_inode:
+            # monotonically increasing even if the file's mtime moves backwards
+            base = mtime if mtime > current.version else current.version + 1
+            index = index.replace(base + end, index.keys)
+        self.index = index
+        self.seen_mtime = mtime
+        self.wal_offset, self.wal_inode = end, inode
+        return counts
+
+    async def reload(self) -> dict:
+        async with self.lock:
+            return await asyncio.to_thread(self.reloadFiles)
+
+    async def catchUp(self):
+        async with self.lock:
+            if not await asyncio.to_thread(self.applyLog):
+                await asyncio.to_thread(self.reloadFiles)
+
+    def deleteLogged(self, record: dict) -> bool:
+        # whether the id is live is decided under the log lock, after applying
+        # everything logged so far (by every worker), so a DELETE sees a sibling's
+        # recent PUT and a second DELETE of the same id is refused
+        with lockedFile(self.wal.path):
+            if not self.applyLog():
+                self.reloadFiles()
+            if record["id"] not in liveKeys(self.index):
+                return False
+            self.wal.writeLocked((json.dumps(record) + "\n").encode("utf-8"))
+        if not self.applyLog():
+            self.reloadFiles()
+        return True
+
+    async def write(self, record: dict) -> bool:
+        # False for a delete of an id that isn't live; puts go through group commit
+        if record["listing"] is None:
+            async with self.lock:
+                if not await asyncio.to_thread(self.deleteLogged, record):
+                    return False
+        else:
+            await self.wal.append(record)
+            await self.catchUp()
+        if self.wal_offset >= self.compact_bytes and (self.compactor is None or self.compactor.done()):
+            self.compactor = asyncio.create_task(self.compact())
+        return True
+
+    async def compact(self) -> int:
+        try:
+            folded = await asyncio.to_thread(self.wal.compact, self.db_file, self.snapshot_file,
+                                             self.index.version, self.owns)
+        finally:
+            await self.reload()
+        print(f"Compacted {folded} log records into {self.db_file}")
+        return folded
+
+    def filesChanged(self) -> bool:
+        mtime = dataVersion(self.db_file)
+        if mtime != 0 and mtime != self.seen_mtime:
+            return True
+        if self.wal is None:
+            return False
+        try:
+            stat = os.stat(self.wal.path)
+        except OSError:
+            return False
+        return stat.st_ino != self.wal_inode or stat.st_size > self.wal_offset
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            if not self.filesChanged():
+                continue
+            try:
+                if dataVersion(self.db_file) == self.seen_mtime:
+                    await self.catchUp()
+                    continue
+                counts = await self.reload()
+                print(f"Reloaded {self.db_file}: version {self.index.version} {counts}")
+            except (OSError, ValueError) as e:
+                # keep serving the current index; retry when the file changes again
+                self.seen_mtime = dataVersion(self.db_file)
+                print(f"Reload of {self.db_file} failed: {e}")
+
+
+# =======================================================================================
+# querying data: look up the city and bisect its prices at the max_price cutoff;
+# matches are the first `count` rows of the returned columns
+# =======================================================================================
+def searchRawData(index: ListingIndex, city, max_price) -> tuple[Columns | None, int]:
+    city_index = index.cities.get(city.casefold())
+    if city_index is None:
+        return None, 0
+    return city_index, city_index.upTo(float(max_price))
+
+
+# =======================================================================================
+# Aggregates (RAW_STATS [<city>|*] [<max_price>]) over one city's listings, or every
+# city's (*), priced at or below max_price. They are read off the price-sorted columns
+# the searches bisect, so no row is visited: the count is a bisect, min, max and the
+# quantiles (nearest rank) are positions in the column, the mean comes from its
+# running sums, each histogram bucket is a bisect at its lower edge, and the bedroom
+# counts bisect the city's per bedroom count columns. Reply, one field per line:
+#   OK STATS <count> VERSION <v>
+#   count, min_price, max_price, mean_price, total_price, p10/p25/median/p75/p90_price,
+#   bedrooms=<n>:<count>,... (unknown:<count> for rows without a number),
+#   histogram=<low>-<high>:<count>,... (STATS_BUCKETS equal widths),
+#   percentiles=<p0>,<p1>,...,<p100>
+# =======================================================================================
+STATS_BUCKETS = 10
+
+
+def quantile(prices, count: int, percent: float) -> float:
+    # the smallest of the first `count` prices with `percent`% of them at or below it
+    return prices[max(1, math.ceil(count * percent / 100)) - 1]
+
+
+def statsRawData(index: ListingIndex, city: str, max_price: float) -> tuple[int, list[str]]:
+    if city == "*":
+        column, bedrooms = index.all, index.bedrooms
+    else:
+        key = city.casefold()
+        column = index.cities.get(key)
+        bedrooms = {beds: index.mix[key, beds] for beds in index.bedrooms if (key, beds) in index.mix}
+    count = column.between(-math.inf, max_price)[1] if column is not None else 0
+    if not count:
+        return 0, ["count=0"]
+    prices = column.prices
+    low, high = prices[0], prices[count - 1]
+    total = column.total(0, count)
+    quantiles = [quantile(prices, count, percent) for _, percent in STATS_QUANTILES]
+
+    mix = {beds: group.upTo(max_price) for beds, group in sorted(bedrooms.items())}
+    mix = {beds: n for beds, n in mix.items() if n}
+    if count > sum(mix.values()):
+        mix["unknown"] = count - sum(mix.values())
+
+    edges = [low + (high - low) * k / STATS_BUCKETS for k in range(STATS_BUCKETS)] if high > low else [low]
+    starts = [bisect_left(prices, edge, 0, count) for edge in edges] + [count]
+    edges.append(high)
+    histogram = [(edges[k], edges[k + 1], starts[k + 1] - starts[k]) for k in range(len(starts) - 1)]
+    percentiles = [quantile(prices, count, p) for p in range(101)]
+    return count, statsLines(count, low, high, total, quantiles, list(mix.items()), histogram, percentiles)
+
+
+# =======================================================================================
+# Structured queries (RAW_QUERY, see listing_query.py). Every index here - all rows,
+# cities, bedroom groups - is sorted by price, so each can bisect the query's price
+# range; the text index instead gives the rows holding the query's words. The
+# planner counts the rows each candidate index would scan for the query and uses
+# the one with the fewest; predicates that index doesn't answer are checked row
+# by row. In price order (or its reverse) rows from a price-sorted index are
+# merged in index order and the scan stops as soon as the page is full; any
+# other order, and any text scan, keeps only the top CURSOR + LIMIT rows in a heap.
+# =======================================================================================
+def queryPlan(index: ListingIndex, query: ListingQuery) -> tuple[str, int, object]:
+    # (index name, rows it scans, [(group, start, end), ...] or the text index's postings);
+    # ties go to the more specific index
+    candidates = []
+    if query.cities:
+        candidates.append(("city", [index.cities[city] for city in query.cities if city in index.cities]))
+    if query.bedrooms:
+        low, high = query.bedroomRange()
+        candidates.append(("bedrooms", [group for beds, group in index.bedrooms.items() if low <= beds <= high]))
+    candidates.append(("price", [index.all]))
+    plans = []
+    for name, groups in candidates:
+        ranges = [(group, *group.between(query.min_price, query.max_price)) for group in groups]
+        plans.append((name, sum(end - start for _, start, end in ranges), ranges))
+    if query.text:
+        groups = index.text.lookup(textTerms(query.text))
+        estimate = sum(map(len, groups[0])) if groups else 0  # the rarest term bounds the matches
+        if query.order == "PRICE" and query.limit is not None:
+            # a price-sorted scan stops once the page is full: about CURSOR + LIMIT rows
+            # over the share of rows that hold the words
+            stop = (query.offset + query.limit) * len(index.all) // max(estimate, 1)
+            plans = [(name, min(cost, stop), ranges) for name, cost, ranges in plans]
+        plans.append(("text", estimate, groups))
+    return min(plans, key=lambda plan: plan[1])
+
+
+def residualFilter(rows: Rows, query: ListingQuery, plan: str):
+    checks = []
+    if plan == "text":
+        checks.append(lambda position: query.min_price <= rows.numbers(position)[1] <= query.max_price)
+    if query.cities and plan != "city":
+        cities = set(query.cities)
+        checks.append(lambda position: rows.strings(position)[0].casefold() in cities)
+    if query.bedrooms and plan != "bedrooms":
+        low, high = query.bedroomRange()
+        checks.append(lambda position: rows.numbers(position)[2] != -1 and low <= rows.numbers(position)[2] <= high)
+    if query.address:
+        checks.append(lambda position: rows.strings(position)[1].casefold().startswith(query.address))
+    if query.text and plan != "text":
+        terms = textTerms(query.text)
+
+        def hasTerms(position):
+            words = set(addressTerms(rows.strings(position)[1]))
+            return all(term in words if not prefix else any(word.startswith(term) for word in words)
+                       for term, prefix in terms)
+
+        checks.append(hasTerms)
+    return lambda position: all(check(position) for check in checks)
+
+
+def scanRanges(rows: Rows, ranges: list[tuple[PriceIndex, int, int]], reverse: bool = False):
+    # positions in the ranges, merged into sort order (or its reverse); equal keys in position order
+    sources = [group.positions(start, end) for group, start, end in ranges if start < end]
+    if reverse:
+        sources = [reversed(source) for source in sources]
+    if len(sources) == 1:
+        return iter(sources[0])
+    return heapq.merge(*sources, key=lambda position: (rows.sortKey(position), position), reverse=reverse)
+
+
+def queryRawData(index: ListingIndex, query: ListingQuery) -> tuple[Columns, int | None]:
+    # the page of matches and the cursor of the next page, if any
+    rows = index.rows
+    plan, _, source = queryPlan(index, query)
+    stop = None if query.limit is None else query.offset + query.limit
+    if plan != "text" and query.order == "PRICE":
+        scan = scanRanges(rows, source, query.descending)
+        matches = filter(residualFilter(rows, query, plan), scan)
+        found = list(islice(matches, query.offset, None if stop is None else stop + 1))
+    else:
+        scan = index.text.search(source) if plan == "text" else scanRanges(rows, source)
+        matches = filter(residualFilter(rows, query, plan), scan)
+        key = orderKey(query)
+
+        def keyed():
+            # ties keep the LIST order, which is also position order, so DESC is the exact reverse of ASC
+            for position in matches:
+                if query.order == "PRICE":
+                    yield rows.sortKey(position), position
+                else:
+                    listing_id, price, bedrooms = rows.numbers(position)
+                    yield key(price, bedrooms, listing_id), position
+
+        if stop is None:
+            ordered = sorted(keyed(), reverse=query.descending)
+        else:
+            ordered = (heapq.nlargest if query.descending else heapq.nsmallest)(stop + 1, keyed())
+        found = [position for _, position in ordered[query.offset:]]
+    if stop is not None and len(found) > query.limit:
+        return Columns(rows, array("I", found[:query.limit])), stop
+    return Columns(rows, array("I", found)), None
+
+
+def textQuery(options: list[str]) -> ListingQuery:
+    # RAW_TEXT <words> [LIMIT n] [CURSOR c]: QUERY TEXT <words> in LIST order
+    words = list(options)
+    paging = []
+    while len(words) >= 2 and words[-2].upper() in ("LIMIT", "CURSOR") and words[-1].isdigit():
+        paging = words[-2:] + paging
+        del words[-2:]
+    offset, limit = parsePaging(paging)
+    text = " ".join(words).casefold()
+    if not textTerms(text):
+        raise ValueError("TEXT command requires at least one address word")
+    return ListingQuery(text=text, offset=offset, limit=limit)
 
 
 # =============================================================================
 # response formatting for application layer
 # =============================================================================
-def responseFormatter(rows: list[dict]) -> str:
-    msg = f"OK RESULT {len(rows)}\n"
-    for item in rows:
-        msg += (
-            f"id={item.get('id')};"
-            f"city={item.get('city')};"
-            f"address={item.get('address')};"
-            f"price={item.get('price')};"
-            f"bedrooms={item.get('bedrooms')}\n"
-        )
-    msg += "END\n"
-    return msg
+# a reply is a list of byte buffers; result replies reference the pre-encoded
+# lines (or binary records) directly so nothing is copied until the transport
+# writes them. On a binary connection, text replies travel in a TEXT frame.
+# =============================================================================
+def textReply(msg: str, binary: bool = False) -> list[bytes]:
+    if binary:
+        return [textFrame(ensureEnd(msg))]
+    return [ensureEnd(msg).encode("utf-8")]
+
+
+def responseFormatter(columns: Columns | None, start: int, end: int, version: int,
+                      next_cursor=None, binary: bool = False) -> list[bytes]:
+    started = time.perf_counter()
+    if binary:
+        if columns is None:
+            reply = resultFrame([], [], version, next_cursor)
+        else:
+            reply = resultFrame(columns.records(start, end), columns.strings(start, end), version, next_cursor)
+    else:
+        lines = columns.lines(start, end) if columns is not None else []
+        header = f"OK RESULT {end - start} VERSION {version}"
+        if next_cursor is not None:
+            header += f" NEXT {next_cursor}"
+        reply = [(header + "\n").encode("utf-8"), *lines, b"END\n"]
+    METRICS.since("format", started)
+    return reply
 
 
 # =============================================================================
 # Error handling for formats and commands
 # =============================================================================
-def formatError(message):
-    return ensureEnd(f"ERROR: {message}")
+def formatError(message, binary: bool = False) -> list[bytes]:
+    METRICS.count("errors")
+    return textReply(f"ERROR: {message}", binary)
 
 
 # =============================================================================
 # Command processing for application layer
 # =============================================================================
-def processCommand(line: str, listings: list[dict]) -> str:
+async def handleCommand(request: str, dataset: Dataset, binary: bool = False) -> list[bytes]:
+    # commands that wait on the files (writes, ADMIN) here; queries run on the current index
+    parts = request.split(None, 1)
+    command = parts[0].upper()
+    argument = parts[1] if len(parts) > 1 else ""
+    if command in ("RAW_PUT", "RAW_DELETE"):
+        return await writeCommand(command, argument, dataset, binary)
+    if command == "ADMIN":
+        if argument.upper().split() == ["RELOAD"]:
+            return await reloadCommand(dataset, binary)
+        if argument.upper().split() == ["COMPACT"]:
+            return await compactCommand(dataset, binary)
+        return formatError("ADMIN commands are RELOAD and COMPACT", binary)
+    if command == MULTI:
+        # a batch of queries, all answered from the same index
+        index = dataset.index
+        return [buf for query in multiQueries(request) for buf in processCommand(query, index, binary)]
+    return processCommand(request, dataset.index, binary)
+
+
+async def writeCommand(command: str, argument: str, dataset: Dataset, binary: bool = False) -> list[bytes]:
+    if dataset.wal is None:
+        return formatError("writes are disabled; start the data server with --wal <file>", binary)
+    try:
+        record = parseWrite(command, argument)
+    except ValueError as e:
+        return formatError(str(e), binary)
+    if record["listing"] is not None and dataset.owns is not None and not dataset.owns(record["listing"]):
+        return formatError(f"city {record['listing'].get('city')} belongs to another shard", binary)
+    try:
+        if not await dataset.write(record):
+            return formatError(f"listing {record['id']} not found", binary)
+    except OSError as e:
+        return formatError(f"write failed: {e}", binary)
+    verb = "DELETED" if record["listing"] is None else "PUT"
+    return textReply(f"OK {verb} {record['id']} VERSION {dataset.index.version}", binary)
+
+
+async def compactCommand(dataset: Dataset, binary: bool = False) -> list[bytes]:
+    if dataset.wal is None:
+        return formatError("there is no write-ahead log to compact; start the data server with --wal <file>", binary)
+    try:
+        folded = await dataset.compact()
+    except (OSError, ValueError) as e:
+        return formatError(f"compaction failed: {e}", binary)
+    return textReply(f"OK COMPACTED {folded} VERSION {dataset.index.version}", binary)
+
+
+async def reloadCommand(dataset: Dataset, binary: bool = False) -> list[bytes]:
+    # ADMIN RELOAD: apply the db file now instead of waiting for the watcher
+    try:
+        counts = await dataset.reload()
+    except (OSError, ValueError) as e:
+        return formatError(f"reload failed: {e}", binary)
+    return textReply(
+        f"OK RELOADED VERSION {dataset.index.version} "
+        f"ADDED {counts['added']} UPDATED {counts['updated']} REMOVED {counts['removed']}",
+        binary,
+    )
+
+
+def processCommand(line: str, index: ListingIndex, binary: bool = False) -> list[bytes]:
     parts = line.strip().split()  # split by whitespace
     if not parts:
-        return formatError("malformed command")
+        return formatError("malformed command", binary)
     command = parts[0].upper()
     
-    if command == "RAW_LIST":  # command from application layer to get all listings without formatting
-        if len(parts) != 1:
-            return formatError("malformed command")
-        return responseFormatter(listings)
+    if command == "RAW_PING":  # health check from the application layer's connection pool
+        return textReply(f"OK PONG VERSION {index.version}", binary)
+
+    elif command == "RAW_METRICS":  # this process's stage latencies and counters
+        lines = METRICS.report("data", {"version": index.version, "rows": len(index.all)})
+        return textReply("OK METRICS\n" + "\n".join(lines), binary)
+
+    elif command == "RAW_LIST":  # command from application layer to get all listings without formatting
+        try:
+            offset, limit = parsePaging(parts[1:])
+        except ValueError as e:
+            return formatError(str(e), binary)
+        start, end, next_cursor = pageSlice(len(index.all), offset, limit)
+        return responseFormatter(index.all, start, end, index.version, next_cursor, binary)
 
     elif command == "RAW_SEARCH":  # command from application layer to search listings without formatting
-        if len(parts) != 3:
-            return formatError("SEARCH command requires 2 arguments: city and max_price")
+        if len(parts) < 3:
+            return formatError("SEARCH command requires 2 arguments: city and max_price", binary)
 
         city = parts[1]
         try:  # checks if max_price is a valid number
             max_price = float(parts[2])
+            if math.isnan(max_price):  # bisects as if above every price
+                raise ValueError
         except ValueError:
-            return formatError("Invalid max_price value")
+            return formatError("Invalid max_price value", binary)
+        try:
+            offset, limit = parsePaging(parts[3:])
+        except ValueError as e:
+            return formatError(str(e), binary)
+
+        results, count = searchRawData(index, city, max_price)  # homes matching search criteria
+        start, end, next_cursor = pageSlice(count, offset, limit)
+        return responseFormatter(results, start, end, index.version, next_cursor, binary)  # return formatted response for application layer to prepare for client
+
+    elif command == "RAW_QUERY":  # structured query: several predicates, an order and paging
+        try:
+            query = parseListingQuery(line.strip().split(None, 1)[1] if len(parts) > 1 else "")
+        except ValueError as e:
+            return formatError(str(e), binary)
+        columns, next_cursor = queryRawData(index, query)
+        return responseFormatter(columns, 0, len(columns), index.version, next_cursor, binary)
+
+    elif command == "RAW_TEXT":  # address word search; word* matches a prefix
+        try:
+            query = textQuery(parts[1:])
+        except ValueError as e:
+            return formatError(str(e), binary)
+        columns, next_cursor = queryRawData(index, query)
+        return responseFormatter(columns, 0, len(columns), index.version, next_cursor, binary)
 
-        results = searchRawData(listings, city, max_price)  # list of homes matching search criteria
-        return responseFormatter(results)  # return formatted response for application layer to prepare for client
+    elif command == "RAW_STATS":  # aggregates over a city's (or every city's, *) listings under a max price
+        if len(parts) > 3:
+            return formatError("STATS command takes a city (or *) and an optional max_price", binary)
+        city = parts[1] if len(parts) > 1 else "*"
+        try:
+            max_price = float(parts[2]) if len(parts) > 2 else math.inf
+            if math.isnan(max_price):
+                raise ValueError
+        except ValueError:
+            return formatError("Invalid max_price value", binary)
+        count, lines = statsRawData(index, city, max_price)
+        return textReply(f"OK STATS {count} VERSION {index.version}\n" + "\n".join(lines), binary)
 
     else:
-        return formatError("unknown command")
+        return formatError("unknown command", binary)
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default=HOST, help ="IP address")
     ap.add_argument("--port", type=int, default=PORT)
-    ap.add_argument("--db", default="listings.json", required = True)
+    ap.add_argument("--db", default="listings.json", help="JSON listings file")
+    ap.add_argument("--snapshot", help="serve from a snapshot file made by --build-snapshot instead of parsing --db")
+    ap.add_argument("--build-snapshot", metavar="PATH",
+                    help="write a snapshot of --db to PATH and exit")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="number of worker processes sharing the listening socket")
+    ap.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL,
+                    help="seconds between checks of --db (and --wal) for changes to apply (0 = only on ADMIN RELOAD)")
+    ap.add_argument("--wal", help="write-ahead log file; enables RAW_PUT and RAW_DELETE")
+    ap.add_argument("--compact-bytes", type=int, default=COMPACT_BYTES,
+                    help="fold the write-ahead log into --db once it reaches this size")
+    ap.add_argument("--backlog", type=int, default=BACKLOG, help="pending connections the listening socket queues")
+    ap.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                    help="requests read but not yet answered before new ones are shed with ERROR: BUSY (0 = no limit)")
+    ap.add_argument("--rate-limit", type=float, default=RATE_LIMIT,
+                    help="requests per second allowed from each client host (0 = unlimited)")
+    ap.add_argument("--rate-burst", type=float, default=RATE_BURST,
+                    help="requests a client host may send at once above --rate-limit (default: one second's worth)")
+    ap.add_argument("--shards", nargs="+", metavar="HOST:PORT[=CITY,...]",
+                    help="the application server's shard map; this server loads only the cities "
+                         "of the shard matching --host:--port")
     args = ap.parse_args()
-    listings = loadJSON(args.db)
-    runServer(args.host, args.port, listings)
+    if args.workers > 1 and not hasattr(os, "fork"):
+        ap.error("--workers requires a platform with fork()")
+    if args.backlog < 1 or args.max_queue < 0 or args.rate_limit < 0 or args.rate_burst < 0:
+        ap.error("need --backlog >= 1 and --max-queue, --rate-limit, --rate-burst >= 0")
+    WORK.limit = args.max_queue
+    RATE_LIMITER.rate = args.rate_limit
+    RATE_LIMITER.burst = args.rate_burst or max(args.rate_limit, 1)
+    owns = None
+    if args.shards:
+        try:
+            owns = shardFilter(ShardMap(args.shards), args.host, args.port)
+        except ValueError as e:
+            ap.error(str(e))
+
+    if args.build_snapshot:
+        snapshot = buildSnapshot(shardSlice(loadJSON(args.db), owns), dataVersion(args.db))
+        writeSnapshot(args.build_snapshot, snapshot)
+        print(f"Wrote snapshot of {args.db} to {args.build_snapshot} ({len(snapshot)} bytes)")
+        return
+    if args.snapshot:
+        try:
+            index = loadSnapshot(args.snapshot)
+        except (OSError, ValueError) as e:
+            ap.error(f"cannot load snapshot {args.snapshot}: {e}")
+    else:
+        index = buildIndex(shardSlice(loadJSON(args.db), owns), dataVersion(args.db))
+    wal = WriteAheadLog(args.wal) if args.wal else None
+    dataset = Dataset(index, args.db, args.watch_interval, wal, args.snapshot, args.compact_bytes, owns)
+    if wal is not None:
+        liveKeys(index)  # built once here so workers share it and writes can check ids
+        dataset.applyLog()  # writes not yet folded into the db file
+    runServer(args.host, args.port, dataset, args.workers, args.backlog)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+import math
+import shlex
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+# =============================================================================
+# Structured listing queries, shared by the application and data layers:
+#
+#   QUERY [CITY <city>[,<city>...]] [MIN_PRICE <p>] [MAX_PRICE <p>]
+#         [MIN_BEDROOMS <n>] [MAX_BEDROOMS <n>] [ADDRESS <prefix>] [TEXT <words>]
+#         [ORDER PRICE|BEDROOMS|ID [ASC|DESC]] [LIMIT <n>] [CURSOR <cursor>]
+#
+# A listing matches when every predicate given holds (for CITY, any of the
+# cities). Cities and the address prefix are matched case-insensitively; quote a
+# prefix that contains spaces. TEXT matches listings whose address contains every
+# one of the words, in any order and case; a word ending in * matches any address
+# word starting with it (quote several words: TEXT "sunset bl*"). Only listings with a numeric price are queried.
+# ORDER PRICE ASC is the LIST order (price ascending, bedrooms descending) and
+# the default; the other ASC orders break ties in that order, and DESC is the
+# exact reverse of ASC. The data server answers it as RAW_QUERY <options>.
+# =============================================================================
+ORDER_KEYS = ("PRICE", "BEDROOMS", "ID")
+
+
+class ListingQuery(NamedTuple):
+    cities: Tuple[str, ...] = ()  # case-folded; empty matches any city
+    min_price: float = -math.inf
+    max_price: float = math.inf
+    min_bedrooms: Optional[int] = None
+    max_bedrooms: Optional[int] = None
+    address: str = ""  # case-folded prefix
+    text: str = ""  # case-folded address words
+    order: str = "PRICE"
+    descending: bool = False
+    offset: int = 0
+    limit: Optional[int] = None
+
+    @property
+    def bedrooms(self) -> bool:
+        return self.min_bedrooms is not None or self.max_bedrooms is not None
+
+    def bedroomRange(self) -> Tuple[float, float]:
+        low = -math.inf if self.min_bedrooms is None else self.min_bedrooms
+        high = math.inf if self.max_bedrooms is None else self.max_bedrooms
+        return low, high
+
+
+def parseListingQuery(options: str) -> ListingQuery:
+    # the options after QUERY / RAW_QUERY; raises ValueError with a message for the client
+    try:
+        tokens = shlex.split(options)
+    except ValueError as e:
+        raise ValueError(f"malformed query ({e})") from None
+    fields: dict = {}
+    seen = set()
+    i = 0
+    while i < len(tokens):
+        name = tokens[i].upper()
+        if name in seen:
+            raise ValueError(f"{name} is given more than once")
+        seen.add(name)
+        if i + 1 == len(tokens):
+            raise ValueError(f"{name} needs a value")
+        value = tokens[i + 1]
+        i += 2
+        try:
+            if name == "CITY":
+                fields["cities"] = tuple(dict.fromkeys(c.strip().casefold() for c in value.split(",") if c.strip()))
+                if not fields["cities"]:
+                    raise ValueError
+            elif name in ("MIN_PRICE", "MAX_PRICE"):
+                fields[name.lower()] = float(value)
+                if math.isnan(fields[name.lower()]):
+                    raise ValueError
+            elif name in ("MIN_BEDROOMS", "MAX_BEDROOMS"):
+                fields[name.lower()] = int(value)
+            elif name == "ADDRESS":
+                fields["address"] = value.casefold()
+            elif name == "TEXT":
+                fields["text"] = " ".join(value.casefold().split())
+                if not any(ch.isalnum() for ch in fields["text"]):
+                    raise ValueError("TEXT needs at least one word")
+            elif name == "ORDER":
+                fields["order"] = value.upper()
+                if fields["order"] not in ORDER_KEYS:
+                    raise ValueError
+                if i < len(tokens) and tokens[i].upper() in ("ASC", "DESC"):
+                    fields["descending"] = tokens[i].upper() == "DESC"
+                    i += 1
+            elif name == "LIMIT":
+                fields["limit"] = int(value)
+                if fields["limit"] <= 0:
+                    raise ValueError
+            elif name == "CURSOR":
+                fields["offset"] = int(value)
+                if fields["offset"] < 0:
+                    raise ValueError
+            else:
+                raise ValueError(f"unknown query option {name}")
+        except ValueError as e:
+            raise ValueError(str(e) or f"Invalid {name} value") from None
+    return ListingQuery(**fields)
+
+
+def queryClauses(options: str) -> List[str]:
+    # the option names of a query, tokenized as parseListingQuery does (values and
+    # ORDER's ASC/DESC skipped), even when the query is otherwise invalid
+    try:
+        tokens = shlex.split(options)
+    except ValueError:
+        return []
+    names = []
+    i = 0
+    while i < len(tokens):
+        names.append(tokens[i].upper())
+        i += 2
+        if names[-1] == "ORDER" and i < len(tokens) and tokens[i].upper() in ("ASC", "DESC"):
+            i += 1
+    return names
+
+
+def formatListingQuery(query: ListingQuery, offset: Optional[int] = None, limit: Optional[int] = None) -> str:
+    # the query's options in canonical form; offset/limit override the query's paging
+    offset = query.offset if offset is None else offset
+    limit = query.limit if limit is None else limit
+    parts: List[str] = []
+    if query.cities:
+        parts += ["CITY", shlex.quote(",".join(query.cities))]
+    if query.min_price != -math.inf:
+        parts += ["MIN_PRICE", repr(query.min_price)]
+    if query.max_price != math.inf:
+        parts += ["MAX_PRICE", repr(query.max_price)]
+    if query.min_bedrooms is not None:
+        parts += ["MIN_BEDROOMS", str(query.min_bedrooms)]
+    if query.max_bedrooms is not None:
+        parts += ["MAX_BEDROOMS", str(query.max_bedrooms)]
+    if query.address:
+        parts += ["ADDRESS", shlex.quote(query.address)]
+    if query.text:
+        parts += ["TEXT", shlex.quote(query.text)]
+    parts += ["ORDER", query.order, "DESC" if query.descending else "ASC"]
+    if limit is not None:
+        parts += ["LIMIT", str(limit)]
+    if offset:
+        parts += ["CURSOR", str(offset)]
+    return " ".join(parts)
+
+
+def orderKey(query: ListingQuery) -> Callable[[float, int, int], tuple]:
+    # sort key over (price, bedrooms, id) for an ASC order; rows of equal key keep the LIST order
+    if query.order == "BEDROOMS":
+        return lambda price, bedrooms, listing_id: (bedrooms,)
+    if query.order == "ID":
+        return lambda price, bedrooms, listing_id: (listing_id,)
+    return lambda price, bedrooms, listing_id: (price, -bedrooms)
@@ -0,0 +1,98 @@
+import os
+import time
+from array import array
+from typing import Dict, List
+
+# =============================================================================
+# Latency histograms and counters shared by the application and data layers.
+# A Histogram counts values (microseconds) in HDR-style log-linear buckets: each
+# value under 128 us has its own bucket, and every power of two above that is
+# split into 64, so a bucket is never wider than 1/64 of its values. Recording
+# is a few integer operations on a fixed array - nothing is allocated or sorted
+# on the request path - and percentiles are read by walking the buckets, only
+# when a METRICS command asks for them.
+# =============================================================================
+SUB_BUCKETS = 64  # buckets per power of two
+SUB_BUCKET_BITS = 6
+MAX_SHIFT = 34  # values up to 2^41 us (25 days); larger ones land in the last bucket
+BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+PERCENTILES = (50, 95, 99)
+
+
+def bucketOf(value: int) -> int:
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    if shift <= 0:
+        return value
+    return min(shift * SUB_BUCKETS + (value >> shift), BUCKETS - 1)
+
+
+def bucketTop(index: int) -> int:
+    # the largest value that lands in bucket `index`
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index - shift * SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = array("Q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0  # us
+        self.max = 0  # us
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1_000_000), 0)
+        self.counts[bucketOf(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> float:
+        # in seconds; the top of the bucket holding that rank, never above the largest value seen
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucketTop(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+
+class Metrics:
+    # one per process: stage -> Histogram, and plain counters
+    def __init__(self):
+        self.started = time.time()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(seconds)
+
+    def since(self, stage: str, started: float) -> float:
+        # records the time since `started` (perf_counter) and returns now
+        now = time.perf_counter()
+        self.observe(stage, now - started)
+        return now
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, source: str, extra: Dict[str, int] = None) -> List[str]:
+        # one line of counters, then one line per stage, each starting with `source`
+        counters = {"pid": os.getpid(), "uptime_s": round(time.time() - self.started, 1),
+                    **self.counters, **(extra or {})}
+        lines = [f"{source} " + " ".join(f"{name}={value}" for name, value in counters.items())]
+        for stage, histogram in self.histograms.items():
+            fields = [f"stage={stage}", f"count={histogram.count}",
+                      f"mean_ms={histogram.total / max(histogram.count, 1) / 1000:.3f}"]
+            fields += [f"p{p}_ms={histogram.percentile(p) * 1000:.3f}" for p in PERCENTILES]
+            fields.append(f"max_ms={histogram.max / 1000:.3f}")
+            lines.append(f"{source} " + " ".join(fields))
+        return lines
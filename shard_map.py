@@ -0,0 +1,50 @@
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+# =============================================================================
+# Shard map shared by the application and data layers. A shard is one data
+# server, written HOST:PORT, or a set of replicas of it, written
+# HOST:PORT+HOST:PORT+..., optionally followed by =CITY,CITY,... to give it
+# those cities outright. Every other city belongs to one of the shards without
+# a city list (to any shard, if they all have one), picked by a CRC32 of the
+# case-folded name, so both layers agree on who owns a city without talking to
+# each other. Both layers must be given the same list, in the same order.
+# =============================================================================
+class ShardMap:
+    def __init__(self, specs: List[str]):
+        self.replicas: List[List[Tuple[str, int]]] = []  # per shard, its replicas' endpoints
+        self.cities: Dict[str, int] = {}  # case-folded city -> shard, for explicit assignments
+        for shard, spec in enumerate(specs):
+            addresses, _, cities = spec.partition("=")
+            replicas = []
+            for address in addresses.split("+"):
+                host, sep, port = address.rpartition(":")
+                if not sep or not host or not port.isdigit():
+                    raise ValueError(f"shard {spec!r} is not HOST:PORT[+HOST:PORT...][=CITY,CITY,...]")
+                replicas.append((host, int(port)))
+            self.replicas.append(replicas)
+            for city in filter(None, (c.strip() for c in cities.split(","))):
+                if city.casefold() in self.cities:
+                    raise ValueError(f"city {city} is assigned to more than one shard")
+                self.cities[city.casefold()] = shard
+        if not self.replicas:
+            raise ValueError("the shard map needs at least one shard")
+        explicit = set(self.cities.values())
+        self.hashed = [s for s in range(len(self.replicas)) if s not in explicit] or list(range(len(self.replicas)))
+
+    def __len__(self) -> int:
+        return len(self.replicas)
+
+    def owner(self, city: str) -> int:
+        key = city.casefold()
+        shard = self.cities.get(key)
+        if shard is None:
+            shard = self.hashed[zlib.crc32(key.encode("utf-8")) % len(self.hashed)]
+        return shard
+
+    def find(self, host: str, port: int) -> Optional[int]:
+        # the shard a data server at host:port serves, as any of its replicas
+        for shard, replicas in enumerate(self.replicas):
+            if (host, port) in replicas:
+                return shard
+        return None
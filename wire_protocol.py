@@ -0,0 +1,318 @@
+import math
+import struct
+import sys
+import zlib
+from array import array
+from typing import List, NamedTuple, Optional, Tuple
+
+# =============================================================================
+# Binary wire protocol shared by the client, application and data layers.
+# A connection starts in the text protocol; sending HELLO BINARY and getting
+# back OK BINARY switches both directions of that connection to frames:
+#
+#   frame   = payload length (u32, big endian) | kind (u8) | payload
+#   TEXT    = utf-8 command, or a text reply exactly as the text protocol sends it
+#   RESULT  = header | string table | records | string refs
+#     header       data version (u64) | next cursor (i64, -1 on the last page)
+#                  | string count (u32) | row count (u32)
+#     string table per string: byte length (u32) | utf-8 bytes
+#     records      per row: id (i64) | price (f64) | bedrooms (i64)
+#     string refs  per row: city index (u32) | address index (u32)
+#
+# Each city/address string is sent once per frame, and numeric fields are
+# fixed width so the receiver unpacks them with struct instead of parsing text.
+#
+# HELLO BINARY COMPRESS asks for frames plus compression; OK BINARY COMPRESS
+# agrees to it (a plain OK BINARY doesn't). From then on either side may send a
+# frame of COMPRESS_MIN payload bytes or more as
+#
+#   COMPRESSED = zlib stream of the frame's kind (u8) | payload
+#
+# when that makes it smaller; readFrame / recvFrame hand back the frame inside.
+#
+# Either protocol can batch queries: RAW_MULTI <query> ; <query> ; ... is
+# answered with one reply per query, in order, exactly as if each had been sent
+# on its own.
+#
+# Any command may be prefixed with DEADLINE <ms>, the time its sender is still
+# willing to wait for the reply. A server that can't start on it in time answers
+# ERROR: DEADLINE EXCEEDED without running it, and sends what is left of the
+# budget on with the commands it issues to the tier below. A server with more
+# work than it can take on answers ERROR: BUSY instead of queueing it. Both are
+# owed once per query of a RAW_MULTI, like any other reply.
+#
+# A client that kept an earlier reply may prefix the command with
+# IF-NONE-MATCH <version>, the data version that reply carried; while the result
+# is still at that version the application server answers NOT MODIFIED VERSION
+# <version> instead of sending it again. DEADLINE, if any, comes first.
+# =============================================================================
+HELLO = "HELLO BINARY"
+HELLO_OK = "OK BINARY"
+
+FRAME_HEADER = struct.Struct(">IB")
+MAX_FRAME = 256 * 1024 * 1024
+KIND_TEXT = ord("T")
+KIND_RESULT = ord("R")
+KIND_COMPRESSED = ord("Z")
+
+HELLO_COMPRESS = "HELLO BINARY COMPRESS"
+HELLO_COMPRESS_OK = "OK BINARY COMPRESS"
+COMPRESS_MIN = 2048
+COMPRESS_LEVEL = 1  # the fastest; rows repeat the same cities and street names, so it still shrinks them well
+
+RESULT_HEADER = struct.Struct("<QqII")
+STRING_LENGTH = struct.Struct("<I")
+RECORD = struct.Struct("<qdq")
+NO_CURSOR = -1
+
+MULTI = "RAW_MULTI"
+MULTI_SEPARATOR = ";"
+
+DEADLINE = "DEADLINE"
+DEADLINE_EXCEEDED = "ERROR: DEADLINE EXCEEDED"
+BUSY = "ERROR: BUSY"
+
+IF_NONE_MATCH = "IF-NONE-MATCH"
+NOT_MODIFIED = "NOT MODIFIED"
+
+
+class Listing(NamedTuple):
+    id: object
+    city: str
+    address: str
+    price: object
+    bedrooms: object
+
+
+class ResultSet(NamedTuple):
+    rows: List[Listing]
+    version: int
+    next_cursor: Optional[int]
+
+
+# =============================================================================
+# Encoding
+# =============================================================================
+def recordFields(listing_id, price, bedrooms) -> Tuple[int, float, int]:
+    # the fixed-width numbers a RECORD carries; -1 / NaN stand in for non-numeric values
+    try:
+        listing_id = int(listing_id)
+    except (TypeError, ValueError):
+        listing_id = -1
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        price = float("nan")
+    try:
+        bedrooms = int(bedrooms)
+    except (TypeError, ValueError):
+        bedrooms = -1
+    return listing_id, price, bedrooms
+
+
+def packRecord(listing_id, price, bedrooms) -> bytes:
+    return RECORD.pack(*recordFields(listing_id, price, bedrooms))
+
+
+def frame(kind: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload), kind) + payload
+
+
+def textFrame(text: str) -> bytes:
+    return frame(KIND_TEXT, text.encode("utf-8"))
+
+
+def resultFrame(records: List[bytes], strings: List[Tuple[str, str]], version: int,
+                next_cursor: Optional[int] = None) -> List[bytes]:
+    # records: pre-packed RECORDs; strings: (city, address) for the same rows
+    table: dict = {}
+    refs = array("I")
+    for city, address in strings:
+        refs.append(table.setdefault(city, len(table)))
+        refs.append(table.setdefault(address, len(table)))
+    if sys.byteorder != "little":
+        refs.byteswap()
+    encoded = [s.encode("utf-8") for s in table]
+    string_table = b"".join(STRING_LENGTH.pack(len(s)) + s for s in encoded)
+    header = RESULT_HEADER.pack(version, NO_CURSOR if next_cursor is None else next_cursor,
+                                len(encoded), len(records))
+    body = [header, string_table, *records, refs.tobytes()]
+    length = sum(map(len, body))
+    return [FRAME_HEADER.pack(length, KIND_RESULT), *body]
+
+
+def compressFrame(buffers: List[bytes]) -> List[bytes]:
+    # one frame, as buffers starting with its header, sent COMPRESSED when that pays off
+    size = sum(map(len, buffers)) - FRAME_HEADER.size
+    if size < COMPRESS_MIN:
+        return buffers
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    chunks = [compressor.compress(memoryview(buffers[0])[FRAME_HEADER.size - 1:])]
+    chunks += [compressor.compress(buffer) for buffer in buffers[1:]]
+    chunks.append(compressor.flush())
+    payload = b"".join(chunks)
+    if len(payload) >= size:
+        return buffers
+    return [frame(KIND_COMPRESSED, payload)]
+
+
+def compressFrames(buffers: List[bytes]) -> List[bytes]:
+    # compressFrame for each frame of a reply (a RAW_MULTI reply holds several)
+    out, i = [], 0
+    while i < len(buffers):
+        if not len(buffers[i]):  # e.g. the string refs of an empty result
+            i += 1
+            continue
+        length, _ = FRAME_HEADER.unpack_from(buffers[i], 0)
+        end, size = i + 1, len(buffers[i])
+        while size < FRAME_HEADER.size + length:
+            size += len(buffers[end])
+            end += 1
+        out += compressFrame(buffers[i:end])
+        i = end
+    return out
+
+
+def multiCommand(queries: List[str]) -> str:
+    return f"{MULTI} " + f" {MULTI_SEPARATOR} ".join(query.strip() for query in queries)
+
+
+def multiQueries(cmd: str) -> List[str]:
+    # the queries of a RAW_MULTI, or [] for any other command; one reply comes back per query
+    name, _, rest = cmd.strip().partition(" ")
+    if name.upper() != MULTI:
+        return []
+    return [query.strip() for query in rest.split(MULTI_SEPARATOR)]
+
+
+def withDeadline(cmd: str, seconds: float) -> str:
+    return f"{DEADLINE} {max(math.ceil(seconds * 1000), 0)} {cmd.strip()}"
+
+
+def splitDeadline(cmd: str) -> Tuple[Optional[float], str]:
+    # (budget in seconds, or None without a DEADLINE prefix; the command itself)
+    name, _, rest = cmd.strip().partition(" ")
+    if name.upper() != DEADLINE:
+        return None, cmd.strip()
+    budget, _, rest = rest.strip().partition(" ")
+    if not budget.isdigit():
+        raise ValueError("DEADLINE takes a budget in milliseconds")
+    return int(budget) / 1000, rest.strip()
+
+
+def splitIfNoneMatch(cmd: str) -> Tuple[Optional[int], str]:
+    # (the version the sender already has, or None without IF-NONE-MATCH; the command itself)
+    name, _, rest = cmd.strip().partition(" ")
+    if name.upper() != IF_NONE_MATCH:
+        return None, cmd.strip()
+    version, _, rest = rest.strip().partition(" ")
+    if not version.isdigit():
+        raise ValueError("IF-NONE-MATCH takes a data version")
+    return int(version), rest.strip()
+
+
+def encodeRows(rows: List[Listing], version: int, next_cursor: Optional[int] = None) -> List[bytes]:
+    records = [packRecord(row.id, row.price, row.bedrooms) for row in rows]
+    strings = [(str(row.city), str(row.address)) for row in rows]
+    return resultFrame(records, strings, version, next_cursor)
+
+
+# =============================================================================
+# STATS replies: OK STATS <count> VERSION <v>, then one name=value field per
+# line, with numbers formatted the same way by the data server and by the
+# application server when it combines shards. A combined reply whose quantiles
+# are estimated has ESTIMATED after its version and an estimated= field naming
+# the estimated fields.
+# =============================================================================
+STATS_QUANTILES = (("p10", 10), ("p25", 25), ("median", 50), ("p75", 75), ("p90", 90))
+STATS_ESTIMATED = "ESTIMATED"
+
+
+def formatPrice(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.2f}"
+
+
+def statsLines(count: int, low: float, high: float, total: float, quantiles: List[float],
+               bedrooms: List[Tuple[object, int]], histogram: List[Tuple[float, float, int]],
+               percentiles: List[float]) -> List[str]:
+    # quantiles in STATS_QUANTILES order; histogram buckets as (low edge, high edge, count)
+    lines = [f"count={count}", f"min_price={formatPrice(low)}", f"max_price={formatPrice(high)}",
+             f"mean_price={total / count:.2f}", f"total_price={formatPrice(total)}"]
+    lines += [f"{name}_price={formatPrice(value)}" for (name, _), value in zip(STATS_QUANTILES, quantiles)]
+    lines.append("bedrooms=" + ",".join(f"{beds}:{n}" for beds, n in bedrooms))
+    lines.append("histogram=" + ",".join(f"{formatPrice(a)}-{formatPrice(b)}:{n}" for a, b, n in histogram))
+    lines.append("percentiles=" + ",".join(map(formatPrice, percentiles)))
+    return lines
+
+
+# =============================================================================
+# Decoding
+# =============================================================================
+def wholeNumber(value):
+    # prices travel as f64; show whole numbers the way the text protocol does
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def decodeResult(payload: bytes) -> ResultSet:
+    version, next_cursor, string_count, row_count = RESULT_HEADER.unpack_from(payload, 0)
+    offset = RESULT_HEADER.size
+    strings = []
+    for _ in range(string_count):
+        (length,) = STRING_LENGTH.unpack_from(payload, offset)
+        offset += STRING_LENGTH.size
+        strings.append(payload[offset:offset + length].decode("utf-8", errors="replace"))
+        offset += length
+    records_end = offset + row_count * RECORD.size
+    records = RECORD.iter_unpack(payload[offset:records_end])
+    refs = array("I")
+    refs.frombytes(payload[records_end:records_end + row_count * 2 * refs.itemsize])
+    if sys.byteorder != "little":
+        refs.byteswap()
+    rows = [
+        Listing(listing_id, strings[refs[2 * i]], strings[refs[2 * i + 1]], wholeNumber(price), bedrooms)
+        for i, (listing_id, price, bedrooms) in enumerate(records)
+    ]
+    return ResultSet(rows, version, None if next_cursor == NO_CURSOR else next_cursor)
+
+
+# =============================================================================
+# Reading frames: asyncio streams (servers) and blocking sockets (client)
+# =============================================================================
+def openFrame(kind: int, payload: bytes) -> Tuple[int, bytes]:
+    # the frame inside a COMPRESSED frame; any other frame as it is
+    if kind != KIND_COMPRESSED:
+        return kind, payload
+    inflater = zlib.decompressobj()
+    try:
+        inner = inflater.decompress(payload, MAX_FRAME + 1)
+    except zlib.error as e:
+        raise ValueError(f"corrupt compressed frame ({e})") from None
+    if len(inner) > MAX_FRAME or inflater.unconsumed_tail:
+        raise ValueError(f"compressed frame exceeds the {MAX_FRAME} byte limit")
+    if not inner or inner[0] == KIND_COMPRESSED:
+        raise ValueError("malformed compressed frame")
+    return inner[0], inner[1:]
+
+
+async def readFrame(reader) -> Tuple[int, bytes]:
+    length, kind = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes exceeds the {MAX_FRAME} byte limit")
+    return openFrame(kind, await reader.readexactly(length))
+
+
+def recvExactly(sock, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionResetError("connection closed mid-frame")
+        data += chunk
+    return bytes(data)
+
+
+def recvFrame(sock) -> Tuple[int, bytes]:
+    length, kind = FRAME_HEADER.unpack(recvExactly(sock, FRAME_HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes exceeds the {MAX_FRAME} byte limit")
+    return openFrame(kind, recvExactly(sock, length))